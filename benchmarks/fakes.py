@@ -0,0 +1,276 @@
+import asyncio
+import itertools
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Iterator, Optional, Union
+
+from roster_api.messaging.rabbitmq import MessageCodec, RabbitMQClient
+
+
+@dataclass
+class FakeKVMetadata:
+    key: bytes
+    create_revision: int
+    mod_revision: int
+    version: int
+
+
+@dataclass
+class FakeLeaseResponse:
+    TTL: int
+
+
+@dataclass
+class FakeLease:
+    # Leases only expire when told to, keys put with one are deleted along with it
+    id: int
+    ttl: int
+    client: "FakeEtcdClient"
+    expired: bool = False
+
+    def refresh(self) -> list[FakeLeaseResponse]:
+        return [FakeLeaseResponse(TTL=0 if self.expired else self.ttl)]
+
+    def revoke(self):
+        self.client._revoke(self.id)
+
+    def expire(self):
+        self.expired = True
+        self.client._revoke(self.id)
+
+
+class FakeCompare:
+    OPERATORS = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        ">": lambda a, b: a > b,
+    }
+
+    def __init__(self, key: str, target: str):
+        self.key = key
+        self.target = target
+        self.op = "=="
+        self.value = None
+
+    def _compare(self, op: str, value) -> "FakeCompare":
+        self.op = op
+        self.value = value
+        return self
+
+    def __eq__(self, value):
+        return self._compare("==", value)
+
+    def __ne__(self, value):
+        return self._compare("!=", value)
+
+    def __lt__(self, value):
+        return self._compare("<", value)
+
+    def __gt__(self, value):
+        return self._compare(">", value)
+
+    def evaluate(self, client: "FakeEtcdClient") -> bool:
+        value, metadata = client.store.get(self.key, (None, None))
+        if self.target == "value":
+            actual = value
+        else:
+            actual = getattr(metadata, self.target) if metadata else 0
+        return self.OPERATORS[self.op](actual, self.value)
+
+
+class FakeTransactions:
+    def value(self, key: str) -> FakeCompare:
+        return FakeCompare(key, "value")
+
+    def version(self, key: str) -> FakeCompare:
+        return FakeCompare(key, "version")
+
+    def create(self, key: str) -> FakeCompare:
+        return FakeCompare(key, "create_revision")
+
+    def mod(self, key: str) -> FakeCompare:
+        return FakeCompare(key, "mod_revision")
+
+    def put(self, key: str, value: Union[str, bytes], lease=None, prev_kv=False):
+        return "put", key, value, lease
+
+    def get(self, key: str):
+        return "get", key
+
+    def delete(self, key: str, prev_kv=False):
+        return "delete", key
+
+
+class FakeEtcdClient:
+    """An in-memory stand-in for the subset of etcd3.Etcd3Client used by the services.
+
+    Counts operations and bytes written, so benchmarks can report etcd load.
+    """
+
+    def __init__(self):
+        self.store: dict[str, tuple[bytes, FakeKVMetadata]] = {}
+        self.revision = 0
+        self.ops: defaultdict[str, int] = defaultdict(int)
+        self.bytes_written = 0
+        self.transactions = FakeTransactions()
+        self._lease_ids = itertools.count(1)
+        # Keys put with a lease, by lease ID
+        self.leased_keys: defaultdict[int, set[str]] = defaultdict(set)
+
+    @staticmethod
+    def _encode(value: Union[str, bytes]) -> bytes:
+        return value.encode("utf-8") if isinstance(value, str) else value
+
+    def lease(self, ttl: int) -> FakeLease:
+        self.ops["lease"] += 1
+        return FakeLease(id=next(self._lease_ids), ttl=ttl, client=self)
+
+    def _revoke(self, lease_id: int):
+        for key in self.leased_keys.pop(lease_id, set()):
+            self.delete(key)
+
+    def get(self, key: str) -> tuple[Optional[bytes], Optional[FakeKVMetadata]]:
+        self.ops["get"] += 1
+        return self.store.get(key, (None, None))
+
+    def get_prefix(self, key_prefix: str) -> Iterator[tuple[bytes, FakeKVMetadata]]:
+        self.ops["get_prefix"] += 1
+        for key in sorted(self.store):
+            if key.startswith(key_prefix):
+                yield self.store[key]
+
+    def put(self, key: str, value: Union[str, bytes], lease=None, prev_kv=False):
+        self.ops["put"] += 1
+        if lease is not None:
+            self.leased_keys[lease.id].add(key)
+        value = self._encode(value)
+        self.revision += 1
+        self.bytes_written += len(key) + len(value)
+        _, current = self.store.get(key, (None, None))
+        self.store[key] = (
+            value,
+            FakeKVMetadata(
+                key=key.encode("utf-8"),
+                create_revision=current.create_revision if current else self.revision,
+                mod_revision=self.revision,
+                version=current.version + 1 if current else 1,
+            ),
+        )
+
+    def put_if_not_exists(self, key: str, value: Union[str, bytes], lease=None) -> bool:
+        if key in self.store:
+            self.ops["put_if_not_exists"] += 1
+            return False
+        self.put(key, value, lease=lease)
+        return True
+
+    def delete(self, key: str, prev_kv=False, return_response=False) -> bool:
+        self.ops["delete"] += 1
+        if key not in self.store:
+            return False
+        self.revision += 1
+        del self.store[key]
+        return True
+
+    def transaction(self, compare, success=None, failure=None):
+        self.ops["transaction"] += 1
+        succeeded = all(comparison.evaluate(self) for comparison in compare)
+        responses = []
+        for op, key, *args in (success if succeeded else failure) or []:
+            if op == "put":
+                value, lease = args
+                self.put(key, value, lease=lease)
+                responses.append(None)
+            elif op == "get":
+                responses.append([self.store[key]] if key in self.store else [])
+            elif op == "delete":
+                responses.append(self.delete(key))
+        return succeeded, responses
+
+
+class FakeRabbitMQClient(RabbitMQClient):
+    """An in-memory stand-in for RabbitMQClient.
+
+    Queues are consumed one message at a time in priority order (FIFO within a priority),
+    and messages still pass through the codec so its cost is included in measurements.
+    Messages whose callbacks fail are requeued once on queues registered with requeue.
+    """
+
+    def __init__(self, codec: Optional[MessageCodec] = None):
+        super().__init__(codec=codec)
+        self.queues: dict[str, asyncio.PriorityQueue] = {}
+        self.messages_published = 0
+        self.bytes_published = 0
+        self._sequence = itertools.count()
+        # Sequence numbers of messages which were requeued after a failure
+        self._redelivered: set[int] = set()
+
+    def _get_queue(self, queue_name: str) -> asyncio.PriorityQueue:
+        if queue_name not in self.queues:
+            self.queues[queue_name] = asyncio.PriorityQueue()
+        return self.queues[queue_name]
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        for queue_name in list(self.active_queues):
+            consumer, _ = self.active_queues.pop(queue_name)
+            consumer.cancel()
+
+    async def declare_queue(
+        self, queue_name: str, max_priority: int = 0, durable: bool = False
+    ):
+        if durable:
+            self.durable_queues.add(queue_name)
+        self._get_queue(queue_name)
+        self.declared_queues.add(queue_name)
+
+    async def _publish(
+        self,
+        queue_name: str,
+        message: bytes,
+        content_type: str,
+        priority: Optional[int] = None,
+        compress: bool = False,
+    ):
+        if compress:
+            body, content_encoding = self.codec.encode(message)
+        else:
+            body, content_encoding = message, None
+        self.messages_published += 1
+        self.bytes_published += len(body)
+        self._get_queue(queue_name).put_nowait(
+            (-(priority or 0), next(self._sequence), body, content_encoding)
+        )
+
+    async def _setup_queue_consumer(self, queue_name: str):
+        queue = self._get_queue(queue_name)
+        return asyncio.create_task(self._consume(queue_name, queue)), queue
+
+    async def _consume(self, queue_name: str, queue: asyncio.PriorityQueue):
+        while True:
+            item = await queue.get()
+            _, sequence, body, content_encoding = item
+            redelivered = sequence in self._redelivered
+            self._redelivered.discard(sequence)
+            callbacks = self.callbacks.get(queue_name, [])
+            try:
+                decoded = self.codec.decode(body, content_encoding)
+                await asyncio.gather(*[callback(decoded) for callback in callbacks])
+            except Exception:
+                if queue_name in self.requeue_queues and not redelivered:
+                    self._redelivered.add(sequence)
+                    queue.put_nowait(item)
+            finally:
+                queue.task_done()
+
+    async def deregister_callback(self, queue_name: str, callback: callable):
+        if queue_name in self.callbacks and callback in self.callbacks[queue_name]:
+            self.callbacks[queue_name].remove(callback)
+
+        if not self.callbacks.get(queue_name):
+            consumer, _ = self.active_queues.pop(queue_name, (None, None))
+            if consumer is not None:
+                consumer.cancel()
@@ -0,0 +1,299 @@
+"""Benchmarks the WorkflowRouter against in-memory etcd and RabbitMQ fakes.
+
+Synthetic workflows are `depth` layers of `width` steps, where each step depends on
+two steps of the previous layer, and synthetic agents answer every trigger_action.
+
+Usage:
+    python -m benchmarks.workflow_router
+    python -m benchmarks.workflow_router --records 200 --width 8 --depth 8 --agents 4
+"""
+import argparse
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from roster_api import constants
+from roster_api.db import etcd
+from roster_api.messaging import rabbitmq
+from roster_api.messaging.workflow import WorkflowRouter
+from roster_api.models.common import TypedArgument
+from roster_api.models.team import Layout, Member, Role, TeamSpec
+from roster_api.models.workflow import (
+    WorkflowActionReportPayload,
+    WorkflowFinishEvent,
+    WorkflowMessage,
+    WorkflowSpec,
+    WorkflowStep,
+)
+from roster_api.services.team import TeamService
+from roster_api.services.workflow import WorkflowService
+from roster_api.util.sharding import get_workflow_router_queue_for_record
+
+from .fakes import FakeEtcdClient, FakeRabbitMQClient
+
+ROLE = "Worker"
+TEAM = "BenchmarkTeam"
+
+
+def build_workflow(width: int, depth: int) -> WorkflowSpec:
+    steps = {}
+    for layer in range(depth):
+        for column in range(width):
+            if layer == 0:
+                input_map = {"seed": "workflow.seed"}
+            else:
+                # Fan in from two steps of the previous layer
+                input_map = {
+                    "left": f"L{layer - 1}S{column}.out",
+                    "right": f"L{layer - 1}S{(column + 1) % width}.out",
+                }
+            output_map = {"out": f"result{column}"} if layer == depth - 1 else {}
+            steps[f"L{layer}S{column}"] = WorkflowStep(
+                role=ROLE, action="Work", inputMap=input_map, outputMap=output_map
+            )
+    return WorkflowSpec(
+        name=f"Benchmark{width}x{depth}",
+        description="A synthetic workflow for benchmarking the router.",
+        team=TEAM,
+        inputs=[TypedArgument(name="seed", type="text")],
+        outputs=[TypedArgument(name=f"result{i}", type="text") for i in range(width)],
+        steps=steps,
+    )
+
+
+def build_team(num_agents: int) -> TeamSpec:
+    agents = [f"benchmark-agent-{i}" for i in range(num_agents)]
+    return TeamSpec(
+        name=TEAM,
+        type="benchmark",
+        description="Synthetic agents which answer every trigger.",
+        layout=Layout(roles=[Role(name=ROLE, description="Does the work.")]),
+        members={ROLE: Member(identity="benchmark", agent=agents[0], pool=agents[1:])},
+    )
+
+
+@dataclass
+class BenchmarkResult:
+    width: int
+    depth: int
+    records: int
+    elapsed: float
+    messages: int
+    message_bytes: int
+    etcd_bytes_written: int
+    etcd_ops: dict[str, int]
+    latencies: list[float] = field(default_factory=list)
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def summary(self) -> str:
+        steps = self.width * self.depth * self.records
+        return (
+            f"{self.width:>3}x{self.depth:<3} records={self.records:<5} "
+            f"steps/s={steps / self.elapsed:>8.1f} "
+            f"msgs/s={self.messages / self.elapsed:>8.1f} "
+            f"sched p50={self.percentile(0.5) * 1000:>7.2f}ms "
+            f"p95={self.percentile(0.95) * 1000:>7.2f}ms "
+            f"p99={self.percentile(0.99) * 1000:>7.2f}ms "
+            f"etcd={self.etcd_bytes_written / 1024:>9.1f}KiB "
+            f"({self.etcd_bytes_written / steps:>7.0f}B/step, "
+            f"{self.etcd_ops['get']} gets, {self.etcd_ops['put']} puts)"
+        )
+
+
+class SyntheticAgents:
+    """Answers trigger_action messages with a report, after an optional delay.
+
+    Scheduling latency is measured from the moment the last dependency of a step
+    reported (or the record was initiated) until its trigger reaches an agent.
+    """
+
+    def __init__(
+        self,
+        workflow_spec: WorkflowSpec,
+        team_spec: TeamSpec,
+        rmq_client: FakeRabbitMQClient,
+        delay: float = 0.0,
+    ):
+        self.workflow_spec = workflow_spec
+        self.agents = team_spec.members[ROLE].get_agents()
+        self.rmq = rmq_client
+        self.delay = delay
+        self.initiated_at: dict[str, float] = {}
+        self.reported_at: dict[tuple[str, str], float] = {}
+        self.latencies: list[float] = []
+        self._callbacks = {}
+
+    def _queue_name(self, agent: str) -> str:
+        return f"default:actor:agent:{agent}"
+
+    async def setup(self):
+        for agent in self.agents:
+            callback = self._handle_message
+            self._callbacks[agent] = callback
+            await self.rmq.register_callback(self._queue_name(agent), callback)
+
+    async def teardown(self):
+        for agent, callback in self._callbacks.items():
+            await self.rmq.deregister_callback(self._queue_name(agent), callback)
+
+    def _ready_at(self, record_id: str, step: str) -> Optional[float]:
+        step_details = self.workflow_spec.steps[step]
+        dependencies = step_details.get_dependencies()
+        if not dependencies:
+            return self.initiated_at.get(record_id)
+        reported = [self.reported_at.get((record_id, dep)) for dep in dependencies]
+        if None in reported:
+            return None
+        return max(reported)
+
+    async def _handle_message(self, body: bytes):
+        message = WorkflowMessage(**rabbitmq.loads_json(body))
+        if message.kind != "trigger_action":
+            return
+        trigger = message.read_contents()
+        ready_at = self._ready_at(message.id, trigger.step)
+        if ready_at is not None:
+            self.latencies.append(time.perf_counter() - ready_at)
+        if self.delay:
+            asyncio.create_task(self._report(message, trigger))
+        else:
+            await self._report(message, trigger)
+
+    async def _report(self, message: WorkflowMessage, trigger):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        report = WorkflowActionReportPayload(
+            step=trigger.step,
+            action=trigger.action,
+            outputs={"out": {"type": "text", "value": f"{trigger.step} done"}},
+            attempt=trigger.attempt,
+        )
+        self.reported_at[(message.id, trigger.step)] = time.perf_counter()
+        await self.rmq.publish_json(
+            get_workflow_router_queue_for_record(message.id),
+            WorkflowMessage(
+                id=message.id,
+                workflow=message.workflow,
+                kind=WorkflowActionReportPayload.KEY,
+                data=report.dict(),
+            ).dict(),
+        )
+
+
+async def run_benchmark(
+    width: int,
+    depth: int,
+    records: int,
+    num_agents: int = 1,
+    agent_delay: float = 0.0,
+    concurrency: int = 0,
+) -> BenchmarkResult:
+    # The services resolve their clients through these module-level singletons
+    etcd_client = FakeEtcdClient()
+    rmq_client = FakeRabbitMQClient()
+    etcd.ETCD_CLIENT = etcd_client
+    rabbitmq.RABBITMQ_CLIENT = rmq_client
+
+    workflow_spec = build_workflow(width, depth)
+    team_spec = build_team(num_agents)
+    TeamService().create_team(team_spec)
+    workflow_service = WorkflowService()
+    workflow_service.create_workflow(workflow_spec)
+
+    router = WorkflowRouter(rmq_client=rmq_client)
+    agents = SyntheticAgents(workflow_spec, team_spec, rmq_client, delay=agent_delay)
+    finished: dict[str, asyncio.Future] = {}
+
+    async def on_finish(event: WorkflowFinishEvent):
+        future = finished.get(event.workflow_record.id)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    router.add_workflow_finish_listener(on_finish)
+    await router.setup()
+    await agents.setup()
+
+    # Reset counters so only the workflow executions are measured
+    etcd_client.bytes_written = 0
+    etcd_client.ops.clear()
+    semaphore = asyncio.Semaphore(concurrency or records)
+
+    async def execute(i: int):
+        async with semaphore:
+            record_id = await workflow_service.initiate_workflow(
+                workflow_spec.name, {"seed": str(i)}
+            )
+            agents.initiated_at[record_id] = time.perf_counter()
+            finished[record_id] = asyncio.get_running_loop().create_future()
+            await finished[record_id]
+
+    messages_before = rmq_client.messages_published
+    bytes_before = rmq_client.bytes_published
+    started_at = time.perf_counter()
+    await asyncio.gather(*[execute(i) for i in range(records)])
+    elapsed = time.perf_counter() - started_at
+
+    await agents.teardown()
+    await router.teardown()
+    await rmq_client.disconnect()
+    return BenchmarkResult(
+        width=width,
+        depth=depth,
+        records=records,
+        elapsed=elapsed,
+        messages=rmq_client.messages_published - messages_before,
+        message_bytes=rmq_client.bytes_published - bytes_before,
+        etcd_bytes_written=etcd_client.bytes_written,
+        etcd_ops=dict(etcd_client.ops),
+        latencies=agents.latencies,
+    )
+
+
+DEFAULT_SHAPES = [(1, 4), (4, 4), (16, 2), (4, 16), (8, 8)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=50)
+    parser.add_argument("--width", type=int, help="Only run this workflow width.")
+    parser.add_argument("--depth", type=int, help="Only run this workflow depth.")
+    parser.add_argument("--agents", type=int, default=1)
+    parser.add_argument(
+        "--agent-delay", type=float, default=0.0, help="Seconds agents spend per step."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="Max records in flight (0 starts them all at once).",
+    )
+    args = parser.parse_args()
+    logging.getLogger(constants.LOGGER_NAME).setLevel(logging.WARNING)
+
+    if args.width or args.depth:
+        shapes = [(args.width or 1, args.depth or 1)]
+    else:
+        shapes = DEFAULT_SHAPES
+    for width, depth in shapes:
+        result = asyncio.run(
+            run_benchmark(
+                width,
+                depth,
+                args.records,
+                num_agents=args.agents,
+                agent_delay=args.agent_delay,
+                concurrency=args.concurrency,
+            )
+        )
+        print(result.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -54,7 +54,7 @@ async def chat_prompt_agent(
 async def initiate_workflow(args: InitiateWorkflowArgs):
     try:
         return await WorkflowService().initiate_workflow(
-            workflow_name=args.workflow, inputs=args.inputs
+            workflow_name=args.workflow, inputs=args.inputs, priority=args.priority
         )
     except errors.WorkflowNotFoundError as e:
         logger.error(e.message)
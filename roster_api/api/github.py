@@ -1,18 +1,34 @@
+import json
+
 from fastapi import APIRouter, Depends, HTTPException, Request
-from roster_api import errors
 from roster_api.github.app import RosterGithubApp
+from roster_api.github.service import verify_webhook_signature
 from roster_api.singletons import get_roster_github_app
 
 router = APIRouter()
 
 
-@router.post("")
+@router.post("", status_code=202)
 async def handle_webhook(
     request: Request, github_app: RosterGithubApp = Depends(get_roster_github_app)
 ):
-    webhook_payload = await request.json()
+    # Github gives up on a webhook after 10 seconds, so payloads are only
+    #   verified and queued here, then handled in the background
+    body = await request.body()
+    if not verify_webhook_signature(
+        body, request.headers.get("X-Hub-Signature-256", "")
+    ):
+        raise HTTPException(status_code=401)
 
     try:
-        await github_app.handle_webhook_payload(webhook_payload)
-    except errors.GithubWebhookError:
+        webhook_payload = json.loads(body)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400)
+    if not isinstance(webhook_payload, dict):
         raise HTTPException(status_code=400)
+
+    await github_app.enqueue_webhook(
+        webhook_payload,
+        delivery_id=request.headers.get("X-GitHub-Delivery", ""),
+        event=request.headers.get("X-GitHub-Event", ""),
+    )
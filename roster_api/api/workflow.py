@@ -3,7 +3,11 @@ import logging
 from fastapi import APIRouter, HTTPException
 from roster_api import constants, errors
 from roster_api.models.workflow import WorkflowSpec
-from roster_api.services.workflow import WorkflowRecordService, WorkflowService
+from roster_api.services.workflow import (
+    WorkflowAdmissionService,
+    WorkflowRecordService,
+    WorkflowService,
+)
 
 router = APIRouter()
 
@@ -55,16 +59,29 @@ def list_workflow_records(workflow_name: str = ""):
 @router.get("/workflow-records/{name}/{id}", tags=["WorkflowRecord"])
 def get_workflow_record(name: str, id: str):
     try:
-        return WorkflowRecordService().get_workflow_record(
+        workflow_record = WorkflowRecordService().get_workflow_record(
             workflow_name=name, record_id=id
         )
+        return WorkflowAdmissionService().update_queue_status(workflow_record)
+    except errors.WorkflowRecordNotFoundError as e:
+        raise HTTPException(status_code=404, detail=e.message)
+
+
+@router.post(
+    "/workflow-records/{name}/{id}/cancel",
+    status_code=202,
+    tags=["WorkflowRecord", "Command"],
+)
+async def cancel_workflow_record(name: str, id: str):
+    try:
+        return await WorkflowService().cancel_workflow(workflow_name=name, record_id=id)
     except errors.WorkflowRecordNotFoundError as e:
         raise HTTPException(status_code=404, detail=e.message)
 
 
 @router.delete("/workflow-records/{name}/{id}", tags=["WorkflowRecord"])
-def delete_workflow_record(name: str, id: str):
-    deleted = WorkflowRecordService().delete_workflow_record(
+async def delete_workflow_record(name: str, id: str):
+    deleted = await WorkflowService().delete_workflow_record(
         workflow_name=name, record_id=id
     )
     if not deleted:
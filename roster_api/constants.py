@@ -7,3 +7,15 @@ EXECUTION_TYPE_HEADER = "X-Roster-Execution-Type"
 # TODO: proper namespace support, callsites should prepend 'default' or other
 WORKFLOW_ROUTER_QUEUE = "default:actor:roster-admin:workflow-router"
 WORKSPACE_QUEUE = "default:actor:roster-admin:workspace-manager"
+# Durable, so webhooks accepted by the API survive restarts until processed
+GITHUB_WEBHOOK_QUEUE = "default:actor:roster-admin:github-app"
+
+# NOTE: agents must declare their inbox queues with the same x-max-priority
+AGENT_INBOX_MAX_PRIORITY = 10
+DEFAULT_TRIGGER_ACTION_PRIORITY = 1
+DEFAULT_TOOL_RESPONSE_PRIORITY = 5
+# Cancellations jump ahead of any triggers still queued for the record
+CANCEL_WORKFLOW_PRIORITY = AGENT_INBOX_MAX_PRIORITY
+
+# Records waiting for a concurrency slot run in order of priority (0 to max)
+MAX_WORKFLOW_PRIORITY = 1000
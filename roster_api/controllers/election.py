@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import socket
+from typing import Awaitable, Callable, Optional
+
+import etcd3
+from roster_api import constants, settings
+from roster_api.db.etcd import get_etcd_client
+
+logger = logging.getLogger(constants.LOGGER_NAME)
+
+
+def _default_candidate_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# NOTE: the leader holds a key on a lease which it keeps alive, if it dies or
+#   loses contact with etcd the lease (and key) expire and another candidate takes over
+class LeaderElection:
+    KEY_PREFIX = "/leaders"
+
+    def __init__(
+        self,
+        name: str,
+        on_elected: Callable[[], Awaitable[None]],
+        on_demoted: Callable[[], Awaitable[None]],
+        candidate_id: str = "",
+        ttl: int = settings.LEADER_LEASE_TTL,
+        etcd_client: Optional[etcd3.Etcd3Client] = None,
+    ):
+        self.name = name
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.candidate_id = candidate_id or _default_candidate_id()
+        self.ttl = ttl
+        self.etcd_client: etcd3.Etcd3Client = etcd_client or get_etcd_client()
+        self.is_leader = False
+        self._lease: Optional[etcd3.Lease] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.KEY_PREFIX}/{self.name}"
+
+    @property
+    def interval(self) -> float:
+        # Refresh well within the TTL so a single slow round trip can't lose the lease
+        return self.ttl / 3
+
+    async def start(self):
+        if self._task is not None:
+            raise RuntimeError(f"Election {self.name} already running")
+        self._task = asyncio.create_task(self._campaign())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._resign()
+
+    def _try_acquire(self, lease: etcd3.Lease) -> bool:
+        succeeded, _ = self.etcd_client.transaction(
+            compare=[self.etcd_client.transactions.version(self.key) == 0],
+            success=[
+                self.etcd_client.transactions.put(
+                    self.key, self.candidate_id, lease=lease
+                )
+            ],
+            failure=[],
+        )
+        return succeeded
+
+    def _keep_alive(self, lease: etcd3.Lease) -> bool:
+        responses = lease.refresh()
+        return bool(responses) and responses[0].TTL > 0
+
+    async def _campaign(self):
+        while True:
+            try:
+                if self.is_leader:
+                    still_leader = await asyncio.to_thread(
+                        self._keep_alive, self._lease
+                    )
+                    if not still_leader:
+                        logger.warning("Lost leadership of %s", self.name)
+                        await self._resign()
+                else:
+                    lease = await asyncio.to_thread(self.etcd_client.lease, self.ttl)
+                    if await asyncio.to_thread(self._try_acquire, lease):
+                        self._lease = lease
+                        self.is_leader = True
+                        logger.info(
+                            "Elected leader of %s (%s)", self.name, self.candidate_id
+                        )
+                        await self.on_elected()
+                    else:
+                        await asyncio.to_thread(lease.revoke)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug("(election) Error in election %s: %s", self.name, e)
+                if self.is_leader:
+                    # Can't confirm the lease is still held, so stop acting as leader
+                    await self._resign()
+            await asyncio.sleep(self.interval)
+
+    async def _resign(self):
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        try:
+            await self.on_demoted()
+        except Exception as e:
+            logger.error("Error while stepping down as leader of %s: %s", self.name, e)
+        lease, self._lease = self._lease, None
+        if lease is not None:
+            try:
+                await asyncio.to_thread(lease.revoke)
+            except Exception as e:
+                logger.debug(
+                    "(election) Failed to revoke lease for %s: %s", self.name, e
+                )
+        logger.info("Stepped down as leader of %s", self.name)
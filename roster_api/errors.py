@@ -150,6 +150,21 @@ class WorkflowRecordNotFoundError(WorkflowRecordError):
         self.record = record
 
 
+class WorkflowRecordConflictError(WorkflowRecordError):
+    """Exception raised when a WorkflowRecord was changed by another writer."""
+
+    def __init__(
+        self,
+        message="The specified WorkflowRecord was changed concurrently.",
+        details=None,
+        workflow=None,
+        record=None,
+    ):
+        super().__init__(message, details)
+        self.workflow = workflow
+        self.record = record
+
+
 class ListenerDisconnectedError(RosterAPIError):
     """Exception raised when a listener is disconnected."""
 
@@ -364,5 +379,31 @@ class WorkspaceNotFoundError(WorkspaceError):
         self.workspace = workspace
 
 
+class WorkspaceTimeoutError(WorkspaceError):
+    """Exception raised when a git operation on a Workspace times out."""
+
+    def __init__(
+        self,
+        message="A git operation on the Workspace timed out.",
+        details=None,
+        workspace=None,
+    ):
+        super().__init__(message, details)
+        self.workspace = workspace
+
+
+class WorkspaceInterruptedError(WorkspaceError):
+    """Exception raised when a git operation on a Workspace is interrupted."""
+
+    def __init__(
+        self,
+        message="A git operation on the Workspace was interrupted.",
+        details=None,
+        workspace=None,
+    ):
+        super().__init__(message, details)
+        self.workspace = workspace
+
+
 class GithubWebhookError(RosterAPIError):
     """Exception raised for GitHub webhook-related errors"""
@@ -1,9 +1,15 @@
+import asyncio
 import json
 import logging
 from typing import Optional
 
-from roster_api import constants
+import etcd3
+import pydantic
+from roster_api import constants, errors, settings
+from roster_api.db.etcd import get_etcd_client
+from roster_api.messaging.rabbitmq import RabbitMQClient, get_rabbitmq, loads_json
 from roster_api.messaging.workflow import WorkflowRouter
+from roster_api.models.github import GithubWebhookMessage
 from roster_api.models.outputs import CodeOutput
 from roster_api.models.workflow import WorkflowFinishEvent
 from roster_api.models.workspace import (
@@ -15,6 +21,7 @@ from roster_api.models.workspace import (
 from roster_api.services.workflow import WorkflowService
 from roster_api.services.workspace import WorkspaceService
 from roster_api.singletons import get_workflow_router, get_workspace_manager
+from roster_api.util.lru import LRUCache
 from roster_api.workspace.manager import WorkspaceManager
 
 from .service import GithubService
@@ -23,22 +30,128 @@ logger = logging.getLogger(constants.LOGGER_NAME)
 
 
 class RosterGithubApp:
+    DELIVERY_KEY_PREFIX = "/github/deliveries"
+
     def __init__(
         self,
         workflow_router: Optional[WorkflowRouter] = None,
         workspace_manager: Optional[WorkspaceManager] = None,
+        rmq_client: Optional[RabbitMQClient] = None,
+        etcd_client: Optional[etcd3.Etcd3Client] = None,
     ):
         self.workflow_router = workflow_router or get_workflow_router()
         self.workspace_manager = workspace_manager or get_workspace_manager()
+        self.rmq = rmq_client or get_rabbitmq()
+        self.etcd_client: etcd3.Etcd3Client = etcd_client or get_etcd_client()
+        # Github redelivers webhooks which time out, so handled deliveries are
+        #   remembered in etcd (shared by every process, for a limited time)
+        #   and the most recent ones here, to skip the lookup
+        self.handled_deliveries: LRUCache[str, bool] = LRUCache(
+            settings.GITHUB_WEBHOOK_DEDUPE_WINDOW
+        )
 
     async def setup(self):
         self.workflow_router.add_workflow_finish_listener(self.handle_workflow_finish)
+        await self.rmq.declare_queue(constants.GITHUB_WEBHOOK_QUEUE, durable=True)
+        # Webhooks which fail to be handled are retried once
+        await self.rmq.register_callback(
+            constants.GITHUB_WEBHOOK_QUEUE, self._handle_webhook_message, requeue=True
+        )
 
     async def teardown(self):
+        await self.rmq.deregister_callback(
+            constants.GITHUB_WEBHOOK_QUEUE, self._handle_webhook_message
+        )
         self.workflow_router.remove_workflow_finish_listener(
             self.handle_workflow_finish
         )
 
+    async def enqueue_webhook(
+        self, payload: dict, delivery_id: str = "", event: str = ""
+    ):
+        # Webhooks are handled by whichever process runs the controllers,
+        #   the API only needs to hand them over before responding
+        await self.rmq.declare_queue(constants.GITHUB_WEBHOOK_QUEUE, durable=True)
+        await self.rmq.publish_json(
+            constants.GITHUB_WEBHOOK_QUEUE,
+            GithubWebhookMessage(
+                delivery_id=delivery_id, event=event, payload=payload
+            ).dict(),
+            compress=True,
+        )
+
+    async def _handle_webhook_message(self, message: bytes):
+        try:
+            webhook_message = GithubWebhookMessage(**loads_json(message))
+        except (json.JSONDecodeError, TypeError, pydantic.ValidationError) as e:
+            logger.error("(roster-gha) Failed to decode webhook message: %s", e)
+            return
+
+        delivery_id = webhook_message.delivery_id
+        if delivery_id and not await self._claim_delivery(delivery_id):
+            logger.debug("(roster-gha) Dropping redelivered webhook %s", delivery_id)
+            return
+
+        # Deliveries are claimed before they are handled, so a redelivery arriving
+        #   meanwhile is dropped. A failure gives the claim up and raises, so the
+        #   message is requeued. An invalid payload would fail again.
+        try:
+            await self.handle_webhook_payload(webhook_message.payload)
+        except errors.GithubWebhookError as e:
+            logger.warning(
+                "(roster-gha) Invalid webhook payload (%s): %s", delivery_id, e
+            )
+        except Exception as e:
+            logger.error(
+                "(roster-gha) Failed to handle webhook (%s): %s", delivery_id, e
+            )
+            if delivery_id:
+                await self._release_delivery(delivery_id)
+            raise
+
+    def _get_delivery_key(self, delivery_id: str) -> str:
+        return f"{self.DELIVERY_KEY_PREFIX}/{delivery_id}"
+
+    async def _claim_delivery(self, delivery_id: str) -> bool:
+        # Only one process (and one attempt) gets to handle each delivery
+        if delivery_id in self.handled_deliveries:
+            return False
+        key = self._get_delivery_key(delivery_id)
+
+        def _claim() -> bool:
+            value, _ = self.etcd_client.get(key)
+            if value is not None:
+                return False
+            # The key is removed along with its lease once the TTL passes
+            lease = self.etcd_client.lease(settings.GITHUB_WEBHOOK_DEDUPE_TTL)
+            transactions = self.etcd_client.transactions
+            succeeded, _ = self.etcd_client.transaction(
+                compare=[transactions.version(key) == 0],
+                success=[transactions.put(key, "", lease=lease)],
+                failure=[],
+            )
+            if not succeeded:
+                lease.revoke()
+            return succeeded
+
+        claimed = await asyncio.to_thread(_claim)
+        self.handled_deliveries.put(delivery_id, True)
+        return claimed
+
+    async def _release_delivery(self, delivery_id: str):
+        self.handled_deliveries.pop(delivery_id)
+        try:
+            await asyncio.to_thread(
+                self.etcd_client.delete, self._get_delivery_key(delivery_id)
+            )
+        except Exception as e:
+            # The requeued message will be dropped as a redelivery
+            logger.warning(
+                "(roster-gha) Failed to release webhook delivery %s: %s",
+                delivery_id,
+                e,
+            )
+
     async def handle_webhook_payload(self, payload: dict):
         github_service = GithubService.from_webhook_payload(payload=payload)
 
@@ -46,6 +159,8 @@ class RosterGithubApp:
             "opened",
             "reopened",
         ]:
+            # Start fetching the repository straight away, while the payload is handled
+            self.workspace_manager.prewarm(github_service)
             await self.handle_issue_created(
                 github_service=github_service, payload=payload
             )
@@ -66,8 +181,9 @@ class RosterGithubApp:
             logger.error("(roster-gha) Failed to parse issue title from payload")
             return
 
-        base_hash = await self.workspace_manager.get_base_hash(
-            github_service=github_service, branch="main"
+        # The base hash and codebase tree come from the same fetch of main
+        snapshot = await self.workspace_manager.get_snapshot(
+            github_service=github_service
         )
         workspace = Workspace(
             name=f"issue-{issue_number}",
@@ -76,7 +192,7 @@ class RosterGithubApp:
                 installation_id=github_service.installation_id,
                 repository_name=github_service.repository_name,
                 branch_name=f"issue-{issue_number}",
-                base_hash=base_hash,
+                base_hash=snapshot.base_hash,
             ),
         )
         WorkspaceService().update_or_create_workspace(workspace=workspace)
@@ -84,13 +200,18 @@ class RosterGithubApp:
             workflow_name="ImplementFeature",  # TODO: make this configurable
             inputs={
                 "change_request": f"Title: {issue_title}\n\nRequest:\n{issue_body}",
-                "codebase_tree": await self.workspace_manager.build_codebase_tree(
-                    github_service=github_service
-                ),
+                "codebase_tree": snapshot.codebase_tree,
             },
             workspace_name=workspace.name,
         )
-        await github_service.handle_issue_created(payload=payload)
+        # The workflow has been started, so a failure from here on must not
+        #   requeue the webhook (which would start another)
+        try:
+            await github_service.handle_issue_created(payload=payload)
+        except Exception as e:
+            logger.error(
+                "(roster-gha) Failed to respond to issue %s: %s", issue_number, e
+            )
 
     async def handle_issue_comment(self, github_service: GithubService, payload: dict):
         await github_service.handle_issue_comment(payload=payload)
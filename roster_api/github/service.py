@@ -1,3 +1,5 @@
+import hashlib
+import hmac
 import logging
 from typing import Optional
 
@@ -24,6 +26,16 @@ def _github_auth(
     )
 
 
+def verify_webhook_signature(
+    body: bytes, signature: str, secret: str = settings.GITHUB_APP_WEBHOOK_SECRET
+) -> bool:
+    # Github signs the raw request body with the webhook secret (X-Hub-Signature-256)
+    if not secret:
+        return True
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(f"sha256={expected}", signature)
+
+
 class GithubService:
     def __init__(
         self,
@@ -6,6 +6,7 @@ import uvicorn
 from fastapi import APIRouter, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from roster_api.controllers.election import LeaderElection
 from roster_api.db.postgres import setup_postgres, teardown_postgres
 from roster_api.messaging.rabbitmq import setup_rabbitmq, teardown_rabbitmq
 from roster_api.singletons import (
@@ -61,24 +62,51 @@ workspace_manager = get_workspace_manager()
 roster_github_app = get_roster_github_app()
 
 
-async def setup():
-    setup_logging()
-    await asyncio.gather(setup_postgres(), setup_rabbitmq())
-    # NOTE: etcd uses a separate Thread due to blocking I/O
-    #   currently does not kill the main thread on connection error (but probably should)
-    setup_watchers()
+async def setup_controllers():
     # Other high-level controllers, actors setup here
     # TODO: consider moving within roster_orchestration?
     await asyncio.gather(workflow_message_router.setup(), workspace_manager.setup())
     await roster_github_app.setup()
 
 
-async def teardown():
+async def teardown_controllers():
     # Other high-level controllers, actors teardown here
     await roster_github_app.teardown()
     await asyncio.gather(
         workflow_message_router.teardown(), workspace_manager.teardown()
     )
+
+
+# NOTE: with leader election, only one replica runs the controllers at a time,
+#   while every replica continues to serve the HTTP API
+controller_election = (
+    LeaderElection(
+        name="controllers",
+        on_elected=setup_controllers,
+        on_demoted=teardown_controllers,
+    )
+    if settings.LEADER_ELECTION
+    else None
+)
+
+
+async def setup():
+    setup_logging()
+    await asyncio.gather(setup_postgres(), setup_rabbitmq())
+    # NOTE: etcd uses a separate Thread due to blocking I/O
+    #   currently does not kill the main thread on connection error (but probably should)
+    setup_watchers()
+    if controller_election is not None:
+        await controller_election.start()
+    else:
+        await setup_controllers()
+
+
+async def teardown():
+    if controller_election is not None:
+        await controller_election.stop()
+    else:
+        await teardown_controllers()
     teardown_watchers()
     await asyncio.gather(teardown_postgres(), teardown_rabbitmq())
 
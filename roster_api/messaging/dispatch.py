@@ -0,0 +1,65 @@
+import logging
+from collections import Counter
+from typing import Optional
+
+from roster_api import constants
+from roster_api.models.team import Member
+from roster_api.util.sharding import get_shard
+
+logger = logging.getLogger(constants.LOGGER_NAME)
+
+
+# NOTE: outstanding work is only tracked for triggers sent by this process,
+#   so with several router shards each one balances its own share of the load.
+class AgentDispatcher:
+    def __init__(self):
+        # Triggers sent minus reports received, per agent
+        self.outstanding: Counter[str] = Counter()
+        # The agent running each (record ID, step) which has not reported yet
+        self.assignments: dict[tuple[str, str], str] = {}
+        self._next_index: dict[str, int] = {}
+
+    def _rotate(self, member: Member, agents: list[str]) -> list[str]:
+        # Start from a different agent each time so ties are spread around the pool
+        index = self._next_index.get(member.agent, 0) % len(agents)
+        self._next_index[member.agent] = index + 1
+        return agents[index:] + agents[:index]
+
+    def choose(
+        self, member: Member, record_id: str, step: str, sticky: bool = False
+    ) -> str:
+        agents = member.get_agents()
+        if len(agents) == 1:
+            agent = agents[0]
+        elif sticky:
+            # Consistent per record, and stable across restarts and router shards
+            agent = agents[get_shard(f"{record_id}:{member.agent}", len(agents))]
+        elif member.dispatch == "round_robin":
+            agent = self._rotate(member, agents)[0]
+        else:
+            if member.dispatch != "least_loaded":
+                logger.debug(
+                    "(dispatch) Unknown dispatch '%s', using least_loaded",
+                    member.dispatch,
+                )
+            agent = min(self._rotate(member, agents), key=self.outstanding.__getitem__)
+        self.assign(record_id, step, agent)
+        return agent
+
+    def assign(self, record_id: str, step: str, agent: str):
+        # A retried step is no longer outstanding on the agent which ran it before
+        self.release(record_id, step)
+        self.assignments[(record_id, step)] = agent
+        self.outstanding[agent] += 1
+
+    def release(self, record_id: str, step: str) -> Optional[str]:
+        agent = self.assignments.pop((record_id, step), None)
+        if agent is not None:
+            self.outstanding[agent] -= 1
+            if self.outstanding[agent] <= 0:
+                del self.outstanding[agent]
+        return agent
+
+    def release_record(self, record_id: str):
+        for _, step in [key for key in self.assignments if key[0] == record_id]:
+            self.release(record_id, step)
@@ -3,8 +3,13 @@ from typing import Optional
 
 from roster_api import constants, errors
 from roster_api.messaging.rabbitmq import RabbitMQClient, get_rabbitmq
+from roster_api.models.team import TeamResource
 from roster_api.models.tool import ToolMessage
-from roster_api.models.workflow import WorkflowActionTriggerPayload, WorkflowMessage
+from roster_api.models.workflow import (
+    WorkflowActionTriggerPayload,
+    WorkflowCancelPayload,
+    WorkflowMessage,
+)
 from roster_api.services.team import TeamService
 
 logger = logging.getLogger(constants.LOGGER_NAME)
@@ -26,18 +31,44 @@ class AgentInbox:
         cls, team: str, role: str, namespace: str = "default", **init_kwargs
     ) -> "AgentInbox":
         team_resource = TeamService().get_team(team, namespace=namespace)
+        return cls.from_team_resource(
+            team_resource, role, namespace=namespace, **init_kwargs
+        )
+
+    @classmethod
+    def from_team_resource(
+        cls,
+        team_resource: TeamResource,
+        role: str,
+        namespace: str = "default",
+        agent: str = "",
+        **init_kwargs,
+    ) -> "AgentInbox":
         team_members = team_resource.spec.members
         role_member = team_members.get(role)
         if not role_member:
             raise errors.AgentNotFoundError()
-        return cls(name=role_member.agent, namespace=namespace, **init_kwargs)
+        # A specific agent can be chosen from the member's pool
+        if agent and agent not in role_member.get_agents():
+            raise errors.AgentNotFoundError(agent=agent)
+        return cls(name=agent or role_member.agent, namespace=namespace, **init_kwargs)
 
     @property
     def queue_name(self) -> str:
         return f"{self.namespace}:actor:agent:{self.name}"
 
+    async def _publish(self, message: dict, priority: int):
+        await self.rmq_client.declare_queue(
+            self.queue_name, max_priority=constants.AGENT_INBOX_MAX_PRIORITY
+        )
+        await self.rmq_client.publish_json(self.queue_name, message, priority=priority)
+
     async def trigger_action(
-        self, workflow_name: str, record_id: str, payload: WorkflowActionTriggerPayload
+        self,
+        workflow_name: str,
+        record_id: str,
+        payload: WorkflowActionTriggerPayload,
+        priority: int = constants.DEFAULT_TRIGGER_ACTION_PRIORITY,
     ):
         message = WorkflowMessage(
             id=record_id,
@@ -46,7 +77,21 @@ class AgentInbox:
             data=payload.dict(),
         )
         logger.debug("(agent-inbox) Triggering action: %s", payload)
-        await self.rmq_client.publish_json(self.queue_name, message.dict())
+        await self._publish(message.dict(), priority=priority)
+
+    async def cancel_workflow(
+        self, workflow_name: str, record_id: str, payload: WorkflowCancelPayload
+    ):
+        # NOTE: RabbitMQ can't remove specific messages from a queue,
+        #   so agents are expected to drop any queued triggers for a cancelled record
+        message = WorkflowMessage(
+            id=record_id,
+            workflow=workflow_name,
+            kind=WorkflowCancelPayload.KEY,
+            data=payload.dict(),
+        )
+        logger.debug("(agent-inbox) Cancelling workflow record: %s", record_id)
+        await self._publish(message.dict(), priority=constants.CANCEL_WORKFLOW_PRIORITY)
 
     async def send_tool_response(
         self,
@@ -54,6 +99,7 @@ class AgentInbox:
         tool: str,
         data: Optional[dict] = None,
         error: str = "",
+        priority: int = constants.DEFAULT_TOOL_RESPONSE_PRIORITY,
     ):
         message = ToolMessage(
             id=invocation_id,
@@ -69,4 +115,4 @@ class AgentInbox:
             data,
             error,
         )
-        await self.rmq_client.publish_json(self.queue_name, message.dict())
+        await self._publish(message.dict(), priority=priority)
@@ -1,18 +1,117 @@
 import asyncio
+import gzip
 import json
 import logging
-from typing import Optional
+from typing import Any, Optional, Union
 
-from aio_pika import IncomingMessage, Message, connect
+from aio_pika import DeliveryMode, IncomingMessage, Message, connect
 from aio_pika.abc import AbstractQueue
+from aio_pika.exceptions import ChannelPreconditionFailed
 from roster_api import constants, errors, settings
 from roster_api.util.async_helpers import make_async
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 RABBITMQ_CLIENT: Optional["RabbitMQClient"] = None
 
+JSON_CONTENT_TYPE = "application/json"
+TEXT_CONTENT_TYPE = "text/plain"
+
 logger = logging.getLogger(constants.LOGGER_NAME)
 
 
+def dumps_json(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+
+def loads_json(data: Union[bytes, str]) -> Any:
+    # NOTE: orjson.JSONDecodeError subclasses json.JSONDecodeError,
+    #   so callers only need to handle the stdlib exception
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class GzipCompressor:
+    encoding = "gzip"
+
+    def compress(self, data: bytes) -> bytes:
+        return gzip.compress(data, compresslevel=6)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+
+class ZstdCompressor:
+    encoding = "zstd"
+
+    def __init__(self, level: int = 3):
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        # Frames written by ZstdCompressor.compress always include the content size
+        return self._decompressor.decompress(data)
+
+
+def _available_compressors() -> dict[str, Union[GzipCompressor, ZstdCompressor]]:
+    compressors = {GzipCompressor.encoding: GzipCompressor()}
+    if zstandard is not None:
+        compressors[ZstdCompressor.encoding] = ZstdCompressor()
+    return compressors
+
+
+# NOTE: bodies above the compression threshold are compressed and the algorithm
+#   is recorded in the AMQP content_encoding header. Messages without a
+#   content_encoding pass through untouched, so plain messages stay readable.
+#   Only messages published with compress=True are compressed, since consumers
+#   outside of this process (e.g. agents) may not read content_encoding.
+class MessageCodec:
+    def __init__(
+        self,
+        compression: str = settings.RABBITMQ_COMPRESSION,
+        compression_threshold: int = settings.RABBITMQ_COMPRESSION_THRESHOLD,
+    ):
+        self.compressors = _available_compressors()
+        if compression and compression not in self.compressors:
+            logger.warning(
+                "(rmq) Compression '%s' unavailable, falling back to gzip",
+                compression,
+            )
+            compression = GzipCompressor.encoding
+        self.compressor = self.compressors.get(compression) if compression else None
+        self.compression_threshold = compression_threshold
+
+    def encode(self, body: bytes) -> tuple[bytes, Optional[str]]:
+        if self.compressor is None or len(body) < self.compression_threshold:
+            return body, None
+        return self.compressor.compress(body), self.compressor.encoding
+
+    def decode(self, body: bytes, content_encoding: Optional[str] = None) -> bytes:
+        if not content_encoding:
+            return body
+        try:
+            compressor = self.compressors[content_encoding]
+        except KeyError:
+            raise errors.RosterAPIError(
+                f"Unsupported message content encoding: {content_encoding}"
+            )
+        return compressor.decompress(body)
+
+
 def get_rabbitmq() -> "RabbitMQClient":
     global RABBITMQ_CLIENT
     if RABBITMQ_CLIENT is not None:
@@ -52,16 +151,23 @@ class RabbitMQClient:
         username: str = settings.RABBITMQ_USER,
         password: str = settings.RABBITMQ_PASSWORD,
         vhost: str = settings.RABBITMQ_VHOST,
+        codec: Optional[MessageCodec] = None,
     ):
         self.connection = None
         self.channel = None
         self.callbacks = {}
         self.active_queues = {}
+        self.declared_queues = set()
+        # Queues which survive broker restarts, messages to them are persisted
+        self.durable_queues = set()
+        # Queues whose messages go back on the queue (once) when a callback fails
+        self.requeue_queues = set()
         self.host = host
         self.port = port
         self.username = username
         self.password = password
         self.vhost = vhost
+        self.codec = codec or MessageCodec()
 
     async def connect(self):
         self.connection = await connect(
@@ -79,26 +185,100 @@ class RabbitMQClient:
         else:
             logger.warning("RabbitMQ connection is not open, cannot close")
 
-    async def _publish(self, queue_name: str, message: bytes):
+    async def declare_queue(
+        self, queue_name: str, max_priority: int = 0, durable: bool = False
+    ):
+        if durable:
+            self.durable_queues.add(queue_name)
+        if queue_name in self.declared_queues:
+            return
+
+        arguments = {"x-max-priority": max_priority} if max_priority else None
+        # Use a throwaway channel, since a failed declaration closes the channel
+        channel = await self.connection.channel()
+        try:
+            await channel.declare_queue(
+                queue_name, durable=durable, arguments=arguments
+            )
+        except ChannelPreconditionFailed:
+            logger.warning(
+                "Queue %s already exists with different arguments, "
+                "it must be deleted to enable message priorities",
+                queue_name,
+            )
+        finally:
+            if not channel.is_closed:
+                await channel.close()
+        self.declared_queues.add(queue_name)
+
+    async def _publish(
+        self,
+        queue_name: str,
+        message: bytes,
+        content_type: str,
+        priority: Optional[int] = None,
+        compress: bool = False,
+    ):
+        if compress:
+            body, content_encoding = self.codec.encode(message)
+        else:
+            body, content_encoding = message, None
         await self.channel.default_exchange.publish(
-            Message(body=message), routing_key=queue_name
+            Message(
+                body=body,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                priority=priority,
+                delivery_mode=DeliveryMode.PERSISTENT
+                if queue_name in self.durable_queues
+                else None,
+            ),
+            routing_key=queue_name,
         )
 
-    async def publish(self, queue_name: str, message: str):
+    async def publish(
+        self,
+        queue_name: str,
+        message: str,
+        priority: Optional[int] = None,
+        compress: bool = False,
+    ):
         logger.debug("(rmq) Publishing to queue %s: %s", queue_name, message)
-        await self._publish(queue_name, message.encode())
+        await self._publish(
+            queue_name,
+            message.encode(),
+            TEXT_CONTENT_TYPE,
+            priority=priority,
+            compress=compress,
+        )
 
-    async def publish_json(self, queue_name: str, message: dict):
+    async def publish_json(
+        self,
+        queue_name: str,
+        message: dict,
+        priority: Optional[int] = None,
+        compress: bool = False,
+    ):
         logger.debug("(rmq) Publishing to queue %s: %s", queue_name, message)
-        await self._publish(queue_name, json.dumps(message).encode())
+        await self._publish(
+            queue_name,
+            dumps_json(message),
+            JSON_CONTENT_TYPE,
+            priority=priority,
+            compress=compress,
+        )
 
-    async def register_callback(self, queue_name: str, callback: callable):
+    async def register_callback(
+        self, queue_name: str, callback: callable, requeue: bool = False
+    ):
         # If callback is sync, wrap it into an async function.
         if not asyncio.iscoroutinefunction(callback):
             callback = make_async(callback)
+        if requeue:
+            self.requeue_queues.add(queue_name)
 
         # Register the callback.
-        # NOTE: Callbacks must accept single string argument (decoded message body).
+        # NOTE: Callbacks must accept single bytes argument (decompressed message body).
         if queue_name not in self.callbacks:
             self.callbacks[queue_name] = []
         self.callbacks[queue_name].append(callback)
@@ -111,18 +291,27 @@ class RabbitMQClient:
     async def _setup_queue_consumer(
         self, queue_name: str
     ) -> tuple[str, "AbstractQueue"]:
-        queue = await self.channel.declare_queue(queue_name)
+        queue = await self.channel.declare_queue(
+            queue_name, durable=queue_name in self.durable_queues
+        )
         consumer_tag = await queue.consume(self._create_message_handler(queue_name))
         return consumer_tag, queue
 
     def _create_message_handler(self, queue_name: str):
         async def handle_message(message: IncomingMessage):
-            # Context manager handles acknowledgement
-            async with message.process():
+            # Context manager handles acknowledgement, a message which fails again
+            #   after being requeued is dropped so it can't be redelivered forever
+            requeue = queue_name in self.requeue_queues and not message.redelivered
+            async with message.process(requeue=requeue):
+                try:
+                    body = self.codec.decode(message.body, message.content_encoding)
+                except (errors.RosterAPIError, OSError, ValueError) as e:
+                    logger.error(
+                        "(rmq) Failed to decode message on queue %s: %s", queue_name, e
+                    )
+                    return
                 callbacks = self.callbacks.get(queue_name, [])
-                await asyncio.gather(
-                    *[callback(message.body.decode()) for callback in callbacks]
-                )
+                await asyncio.gather(*[callback(body) for callback in callbacks])
 
         return handle_message
 
@@ -133,6 +322,6 @@ class RabbitMQClient:
 
         # If it's the last callback for the queue, stop consuming from the queue.
         if not self.callbacks.get(queue_name):  # No more callbacks for this queue.
-            consumer_tag, queue = self.active_queues.pop(queue_name, None)
+            consumer_tag, queue = self.active_queues.pop(queue_name, (None, None))
             if consumer_tag:
                 await queue.cancel(consumer_tag)
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from roster_api import constants, errors, settings
+from roster_api.models.workflow import WorkflowMessage, WorkflowRecord
+from roster_api.services.workflow import WorkflowRecordService
+from roster_api.util.lru import LRUCache
+
+logger = logging.getLogger(constants.LOGGER_NAME)
+
+# Reports by idempotency key, along with the message which carried them
+PendingReports = list[tuple[str, WorkflowMessage]]
+
+
+class CachedRecord:
+    def __init__(self, record: WorkflowRecord, revision: Optional[int] = None):
+        self.record = record
+        # The etcd revision this copy of the record is based on (None if unknown)
+        self.revision = revision
+        self.dirty = False
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        # Reports applied to the record since it was last written
+        self.pending_reports: PendingReports = []
+
+
+# NOTE: only the router which owns a record's shard may cache it,
+#   writes are checked against the cached revision so changes made elsewhere
+#   (e.g. deleting the record) are detected rather than overwritten.
+#   Changes held back for coalescing are lost if the process dies before they flush.
+#   Reports are handed to on_written once the record holding them is written, or to
+#   on_conflict (with the record as cached) if the write conflicts, so they can be
+#   applied again to the copy in etcd.
+class WorkflowRecordCache:
+    def __init__(
+        self,
+        capacity: int = settings.WORKFLOW_RECORD_CACHE_SIZE,
+        flush_delay: float = settings.WORKFLOW_RECORD_FLUSH_DELAY,
+        record_service: Optional[WorkflowRecordService] = None,
+        on_written: Optional[Callable[[WorkflowRecord, PendingReports], None]] = None,
+        on_conflict: Optional[Callable[[WorkflowRecord, PendingReports], None]] = None,
+    ):
+        self.flush_delay = flush_delay
+        self.record_service = record_service or WorkflowRecordService()
+        self.on_written = on_written
+        self.on_conflict = on_conflict
+        self.entries: LRUCache[str, CachedRecord] = LRUCache(capacity)
+
+    def __contains__(self, record_id: str) -> bool:
+        return record_id in self.entries
+
+    def get(self, workflow_name: str, record_id: str) -> WorkflowRecord:
+        entry = self.entries.get(record_id)
+        if entry is not None:
+            return entry.record
+        record, revision = self.record_service.get_workflow_record_revision(
+            workflow_name, record_id
+        )
+        self._add(CachedRecord(record, revision))
+        return record
+
+    def add(self, record: WorkflowRecord, revision: Optional[int] = None):
+        self._add(CachedRecord(record, revision))
+
+    def _add(self, entry: CachedRecord):
+        for record_id, evicted in self.entries.put(entry.record.id, entry):
+            try:
+                self._flush_entry(evicted)
+            except Exception as e:
+                logger.warning("Failed to write workflow record %s: %s", record_id, e)
+
+    def mark_dirty(
+        self,
+        record: WorkflowRecord,
+        report: Optional[tuple[str, WorkflowMessage]] = None,
+    ):
+        # Changes are written after a short delay, so several close together
+        #   are coalesced into a single write
+        entry = self.entries.get(record.id)
+        if entry is None:
+            entry = CachedRecord(record)
+            self._add(entry)
+        entry.dirty = True
+        if report is not None:
+            entry.pending_reports.append(report)
+        if not self.flush_delay:
+            self._flush_entry(entry)
+        elif entry.flush_handle is None:
+            entry.flush_handle = asyncio.get_running_loop().call_later(
+                self.flush_delay, self._flush_later, record.id
+            )
+
+    def flush(self, record_id: str):
+        # Raises WorkflowRecordNotFoundError or WorkflowRecordConflictError
+        #   (after dropping the cached record) if the write fails
+        entry = self.entries.get(record_id)
+        if entry is not None:
+            self._flush_entry(entry)
+
+    def _flush_entry(self, entry: CachedRecord):
+        if entry.flush_handle is not None:
+            entry.flush_handle.cancel()
+            entry.flush_handle = None
+        if not entry.dirty:
+            return
+        reports, entry.pending_reports = entry.pending_reports, []
+        try:
+            entry.revision = self.record_service.update_workflow_record_revision(
+                entry.record, revision=entry.revision
+            )
+        except errors.WorkflowRecordNotFoundError:
+            # Deleted, so there is nothing to apply the reports to
+            self.entries.pop(entry.record.id)
+            raise
+        except errors.WorkflowRecordConflictError:
+            # The copy in etcd wins, the next read will load it again
+            self.entries.pop(entry.record.id)
+            if reports and self.on_conflict is not None:
+                self.on_conflict(entry.record, reports)
+            raise
+        entry.dirty = False
+        if reports and self.on_written is not None:
+            self.on_written(entry.record, reports)
+
+    def _flush_later(self, record_id: str):
+        entry = self.entries.get(record_id)
+        if entry is None:
+            return
+        entry.flush_handle = None
+        try:
+            self._flush_entry(entry)
+        except Exception as e:
+            logger.warning(
+                "Failed to write workflow record %s / %s: %s",
+                entry.record.name,
+                record_id,
+                e,
+            )
+
+    def evict(self, record_id: str):
+        # Flushes pending changes before forgetting the record
+        entry = self.entries.pop(record_id)
+        if entry is not None:
+            self._flush_entry(entry)
+
+    def flush_all(self):
+        for record_id in list(self.entries):
+            try:
+                self.flush(record_id)
+            except Exception as e:
+                logger.warning("Failed to write workflow record %s: %s", record_id, e)
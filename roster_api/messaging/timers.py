@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from roster_api import constants, settings
+from roster_api.models.workflow import StepTimer
+from roster_api.services.workflow import StepTimerService
+from roster_api.util.timer_wheel import HierarchicalTimerWheel
+
+logger = logging.getLogger(constants.LOGGER_NAME)
+
+
+# NOTE: deadlines are persisted in etcd so they survive restarts,
+#   while the in-memory wheel decides when they fire.
+class StepTimers:
+    def __init__(
+        self,
+        on_expired: Callable[[StepTimer], Awaitable[None]],
+        tick: float = settings.STEP_TIMER_TICK,
+        timer_service: Optional[StepTimerService] = None,
+    ):
+        self.on_expired = on_expired
+        self.tick = tick
+        self.timer_service = timer_service or StepTimerService()
+        self.timers: dict[str, StepTimer] = {}
+        self.wheel = HierarchicalTimerWheel(tick=tick, now=time.time())
+        self._task: Optional[asyncio.Task] = None
+
+    async def setup(self, owns: Callable[[StepTimer], bool] = lambda timer: True):
+        # Restore the timers for records owned by this process,
+        #   any deadlines which passed while it was down fire on the first tick
+        for timer in self.timer_service.list_timers():
+            if owns(timer):
+                self._schedule_in_memory(timer)
+        logger.debug("(step-timers) Restored %s timers", len(self.timers))
+        self._task = asyncio.create_task(self._run())
+
+    async def teardown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.timers.clear()
+        self.wheel = HierarchicalTimerWheel(tick=self.tick, now=time.time())
+
+    def _schedule_in_memory(self, timer: StepTimer):
+        self.timers[timer.key] = timer
+        self.wheel.schedule(timer.key, timer.deadline)
+
+    def schedule(self, timer: StepTimer):
+        self.timer_service.put_timer(timer)
+        self._schedule_in_memory(timer)
+
+    def cancel(self, record_id: str, step: str, kind: str = "timeout"):
+        timer_key = f"{record_id}/{step}/{kind}"
+        if self.timers.pop(timer_key, None) is None:
+            return
+        self.wheel.cancel(timer_key)
+        self.timer_service.delete_timer(timer_key)
+
+    def cancel_record(self, record_id: str):
+        for timer_key in [
+            key for key in self.timers if key.startswith(f"{record_id}/")
+        ]:
+            self.timers.pop(timer_key)
+            self.wheel.cancel(timer_key)
+            self.timer_service.delete_timer(timer_key)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            for timer_key in self.wheel.advance(time.time()):
+                timer = self.timers.pop(timer_key, None)
+                if timer is None:
+                    continue
+                try:
+                    await self.on_expired(timer)
+                    self.timer_service.delete_timer(timer_key)
+                except Exception as e:
+                    logger.error("Failed to expire step timer %s: %s", timer_key, e)
@@ -1,27 +1,53 @@
 import asyncio
 import json
 import logging
+import time
 from typing import Awaitable, Callable, Optional
 
-from roster_api import constants, errors
+from pydantic import BaseModel
+
+from roster_api import constants, errors, settings
 from roster_api.constants import WORKFLOW_ROUTER_QUEUE
+from roster_api.messaging.dispatch import AgentDispatcher
 from roster_api.messaging.inbox import AgentInbox
-from roster_api.messaging.rabbitmq import RabbitMQClient, get_rabbitmq
+from roster_api.messaging.rabbitmq import RabbitMQClient, get_rabbitmq, loads_json
+from roster_api.messaging.record_cache import WorkflowRecordCache
+from roster_api.messaging.timers import StepTimers
+from roster_api.models.common import TypedResult
+from roster_api.models.team import TeamResource
 from roster_api.models.workflow import (
     InitiateWorkflowPayload,
+    MapStepProgress,
     StepResult,
     StepRunStatus,
+    StepTimer,
     WorkflowActionReportPayload,
     WorkflowActionTriggerPayload,
+    WorkflowAdmitPayload,
+    WorkflowCancelPayload,
     WorkflowFinishEvent,
     WorkflowMessage,
     WorkflowRecord,
+    WorkflowRecordAdmission,
     WorkflowSpec,
     WorkflowStartEvent,
     WorkflowStep,
+    WorkflowStepRetryPayload,
+    map_step_key,
+    parse_map_step_key,
 )
 from roster_api.services.team import TeamService
-from roster_api.services.workflow import WorkflowRecordService, WorkflowService
+from roster_api.services.workflow import (
+    WorkflowAdmissionService,
+    WorkflowRecordService,
+    WorkflowService,
+)
+from roster_api.util.lru import LRUCache
+from roster_api.util.sharding import (
+    get_shard,
+    get_workflow_router_queue,
+    get_workflow_router_queue_for_record,
+)
 
 logger = logging.getLogger(constants.LOGGER_NAME)
 
@@ -35,25 +61,256 @@ def _workflow_inputs_are_valid(workflow_spec: WorkflowSpec, payload_inputs: dict
     )
 
 
+def _step_is_ready(workflow_record: WorkflowRecord, step_details: WorkflowStep):
+    return all(dep in workflow_record.context for dep in step_details.inputMap.values())
+
+
+def _workflow_is_finished(workflow_record: WorkflowRecord):
+    return all(
+        output.name in workflow_record.outputs or output.name in workflow_record.errors
+        for output in workflow_record.spec.outputs
+    )
+
+
+def _resolve_step(
+    workflow_spec: WorkflowSpec, step_key: str
+) -> tuple[str, Optional[int], WorkflowStep]:
+    # Resolves a step or a chunk of a map step (raises KeyError if neither)
+    if step_key in workflow_spec.steps:
+        return step_key, None, workflow_spec.steps[step_key]
+    step_name, chunk = parse_map_step_key(step_key)
+    step_details = workflow_spec.steps[step_name]
+    if chunk is None or step_details.map is None:
+        raise KeyError(step_key)
+    return step_name, chunk, step_details
+
+
+def _map_step_output_names(workflow_spec: WorkflowSpec, step: str) -> list[str]:
+    # The outputs of a map step which are used elsewhere in the workflow
+    output_names = list(workflow_spec.steps[step].outputMap)
+    for dependent in workflow_spec.get_derived_state().dependents[step]:
+        for dep_name in workflow_spec.steps[dependent].inputMap.values():
+            dep_step_name, _, output_name = dep_name.partition(".")
+            if dep_step_name == step and output_name not in output_names:
+                output_names.append(output_name)
+    return output_names
+
+
+def _downstream_output_names(workflow_spec: WorkflowSpec, step: str) -> set[str]:
+    # The workflow outputs produced by the step or any step which depends on it
+    dependents = workflow_spec.get_derived_state().dependents
+    output_names = set()
+    visited = {step}
+    pending = [step]
+    while pending:
+        step_name = pending.pop()
+        output_names.update(workflow_spec.steps[step_name].outputMap.values())
+        for dependent in dependents.get(step_name, []):
+            if dependent not in visited:
+                visited.add(dependent)
+                pending.append(dependent)
+    return output_names
+
+
+def _gather_map_step(
+    workflow_record: WorkflowRecord, step: str, step_details: WorkflowStep
+) -> Optional[dict[str, TypedResult]]:
+    # Collects the outputs of each chunk into lists (in chunk order),
+    #   returns None until every chunk has succeeded
+    progress = workflow_record.map_progress.get(step)
+    if progress is not None:
+        num_chunks = progress.chunks
+    else:
+        # Dispatched before progress was recorded, so the input is split again
+        input_value = workflow_record.context[
+            step_details.inputMap[step_details.map.input]
+        ].value
+        num_chunks = len(step_details.map.split(input_value))
+    chunk_outputs = []
+    for chunk in range(num_chunks):
+        run_status = workflow_record.run_status.get(map_step_key(step, chunk))
+        if run_status is None or not run_status.results or run_status.results[-1].error:
+            return None
+        chunk_outputs.append(run_status.results[-1].outputs)
+
+    if chunk_outputs:
+        output_names = list(
+            dict.fromkeys(name for outputs in chunk_outputs for name in outputs)
+        )
+    else:
+        output_names = _map_step_output_names(workflow_record.spec, step)
+    return {
+        output_name: TypedResult(
+            type="list",
+            value=json.dumps(
+                [
+                    outputs[output_name].value if output_name in outputs else ""
+                    for outputs in chunk_outputs
+                ]
+            ),
+        )
+        for output_name in output_names
+    }
+
+
+def _is_first_success(run_status: StepRunStatus) -> bool:
+    # Whether the latest result is the first successful one
+    #   (a timed out attempt may still report after a retry has succeeded)
+    return (
+        bool(run_status.results)
+        and not run_status.results[-1].error
+        and sum(not result.error for result in run_status.results) == 1
+    )
+
+
+def _record_step_result(
+    workflow_record: WorkflowRecord,
+    step_key: str,
+    step_details: WorkflowStep,
+    outputs: dict[str, TypedResult],
+    error: str = "",
+    idempotency_key: str = "",
+    chunk: Optional[int] = None,
+) -> bool:
+    # Returns whether the step has failed for good (and will not be retried)
+    # Chunk outputs stay in the run status until they are gathered for the map step
+    if chunk is None:
+        # Errors are only recorded once the step is out of retries, below
+        if not error:
+            for output_key, output_value in outputs.items():
+                if output_key in step_details.outputMap:
+                    workflow_output_key = step_details.outputMap[output_key]
+                    workflow_record.outputs[workflow_output_key] = output_value
+
+        action_outputs = {
+            f"{step_key}.{output_key}": output_value
+            for output_key, output_value in outputs.items()
+        }
+        workflow_record.context.update(action_outputs)
+
+    # Update the action's run status in the workflow record
+    run_status = workflow_record.run_status.get(step_key, StepRunStatus())
+    run_status.runs += 1
+    run_status.results.append(
+        StepResult(outputs=outputs, error=error, idempotency_key=idempotency_key)
+    )
+    workflow_record.run_status[step_key] = run_status
+
+    if not error:
+        return False
+    # Map steps are retried chunk by chunk, never as a whole
+    is_map_step = step_details.map is not None and chunk is None
+    if not is_map_step and step_details.runConfig.num_retries >= run_status.runs:
+        return False
+    if chunk is None:
+        # Out of retries, so nothing downstream of this step can complete
+        #   (independent branches of the workflow carry on)
+        logger.warning(
+            "Step %s for workflow %s / %s failed after %s runs: %s",
+            step_key,
+            workflow_record.name,
+            workflow_record.id,
+            run_status.runs,
+            error,
+        )
+        failed_outputs = _downstream_output_names(workflow_record.spec, step_key)
+        for output in workflow_record.spec.outputs:
+            if (
+                output.name in failed_outputs
+                and output.name not in workflow_record.outputs
+            ):
+                workflow_record.errors.setdefault(
+                    output.name, f"Step {step_key} failed: {error}"
+                )
+    return True
+
+
 # NOTE: because the queue scope includes the namespace,
 #   an instance of WorkflowRouter is 1:1 with namespace
 #   Should consider removing namespace from roster-admin queues (or using a constant)
-#   or consider how to manage potentially many concurrent WorkflowRouters for each cluster
+# Workflow messages are partitioned across WORKFLOW_ROUTER_SHARDS queues by record ID,
+#   and each shard must be consumed by exactly one WorkflowRouter instance.
+#   All messages for a record land on the same shard, so they are handled in order.
 class WorkflowRouter:
-    def __init__(self, rmq_client: Optional[RabbitMQClient] = None):
+    def __init__(
+        self,
+        rmq_client: Optional[RabbitMQClient] = None,
+        shards: Optional[list[int]] = None,
+        num_shards: int = settings.WORKFLOW_ROUTER_SHARDS,
+    ):
         self.rmq: RabbitMQClient = rmq_client or get_rabbitmq()
+        self.num_shards = max(num_shards, 1)
+        owned_shards = shards or settings.WORKFLOW_ROUTER_OWNED_SHARDS
+        self.shards: list[int] = sorted(
+            {shard for shard in owned_shards if 0 <= shard < self.num_shards}
+            if owned_shards
+            else range(self.num_shards)
+        )
+        self.step_timers = StepTimers(on_expired=self._handle_step_timer)
+        self.dispatcher = AgentDispatcher()
+        self.records = WorkflowRecordCache(
+            on_written=self._reports_written, on_conflict=self._reapply_reports
+        )
+        # Recently written reports by (record ID, idempotency key), so duplicates
+        #   can be dropped without reading the record (which is checked otherwise)
+        self.applied_reports: LRUCache[tuple[str, str], bool] = LRUCache(
+            settings.WORKFLOW_REPORT_DEDUPE_WINDOW
+        )
         self.workflow_start_listeners = []
         self.workflow_finish_listeners = []
 
+    @property
+    def queue_names(self) -> list[str]:
+        return [
+            get_workflow_router_queue(shard, num_shards=self.num_shards)
+            for shard in self.shards
+        ]
+
+    @property
+    def relays_unsharded_queue(self) -> bool:
+        # Publishers which are not shard-aware (e.g. agent reports) still use the
+        #   original queue, so the owner of shard 0 forwards them to the right shard
+        return self.num_shards > 1 and 0 in self.shards
+
+    def owns_record(self, record_id: str) -> bool:
+        return get_shard(record_id, self.num_shards) in self.shards
+
     async def setup(self) -> None:
-        await self.rmq.register_callback(WORKFLOW_ROUTER_QUEUE, self.route)
+        await self.step_timers.setup(
+            owns=lambda timer: self.owns_record(timer.record_id)
+        )
+        for queue_name in self.queue_names:
+            await self.rmq.register_callback(queue_name, self.route)
+        if self.relays_unsharded_queue:
+            await self.rmq.register_callback(WORKFLOW_ROUTER_QUEUE, self.relay)
 
     async def teardown(self) -> None:
-        await self.rmq.deregister_callback(WORKFLOW_ROUTER_QUEUE, self.route)
+        if self.relays_unsharded_queue:
+            await self.rmq.deregister_callback(WORKFLOW_ROUTER_QUEUE, self.relay)
+        for queue_name in self.queue_names:
+            await self.rmq.deregister_callback(queue_name, self.route)
+        await self.step_timers.teardown()
+        self.records.flush_all()
+
+    async def relay(self, message: bytes) -> None:
+        try:
+            data = loads_json(message)
+            record_id = data["id"]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            logger.debug(
+                "(workflow-router) Failed to relay workflow message: %s", message
+            )
+            return
 
-    async def route(self, message: str) -> None:
+        await self.rmq.publish_json(
+            get_workflow_router_queue_for_record(record_id, num_shards=self.num_shards),
+            data,
+            compress=True,
+        )
+
+    async def route(self, message: bytes) -> None:
         try:
-            data = json.loads(message)
+            data = loads_json(message)
             message = WorkflowMessage(**data)
             payload = message.read_contents()
         except json.JSONDecodeError:
@@ -75,44 +332,171 @@ class WorkflowRouter:
             await self._handle_initiate_workflow(message, payload)
         elif message.kind == WorkflowActionReportPayload.KEY:
             await self._handle_action_report(message, payload)
+        elif message.kind == WorkflowStepRetryPayload.KEY:
+            await self._handle_step_retry(message, payload)
+        elif message.kind == WorkflowCancelPayload.KEY:
+            await self._handle_cancel_workflow(message, payload)
+        elif message.kind == WorkflowAdmitPayload.KEY:
+            await self._handle_admit_workflow(message, payload)
 
-    async def _trigger_action(
-        self,
-        workflow_record: WorkflowRecord,
-        step: str,
-        step_details: WorkflowStep,
-    ):
+    def _get_team(self, workflow_record: WorkflowRecord) -> Optional[TeamResource]:
         workflow_spec = workflow_record.spec
         # Retrieve the TeamResource associated with this Workflow
         # WARNING: default namespace
         try:
-            team_resource = TeamService().get_team(workflow_spec.team)
+            return TeamService().get_team(workflow_spec.team)
         except errors.TeamNotFoundError:
             logger.debug("(workflow-router) Team not found")
             logger.warning(
-                "Tried to trigger step %s (%s) for workflow %s / %s, but team %s not found",
-                step,
-                step_details.action,
+                "Tried to trigger steps for workflow %s / %s, but team %s not found",
                 workflow_spec.name,
                 workflow_record.id,
                 workflow_spec.team,
             )
-            return
+            return None
 
-        # Map workflow context to action inputs
+    async def _trigger_action(
+        self,
+        workflow_record: WorkflowRecord,
+        team_resource: TeamResource,
+        step: str,
+        step_details: WorkflowStep,
+        inputs: dict[str, str],
+    ):
+        workflow_spec = workflow_record.spec
+        step_run_status = workflow_record.run_status.get(step, StepRunStatus())
+        attempt = step_run_status.runs + 1
         trigger_payload = WorkflowActionTriggerPayload(
             step=step,
             action=step_details.action,
-            inputs={
-                k: workflow_record.context[v].value
-                for k, v in step_details.inputMap.items()
-            },
+            inputs=inputs,
             role_context=team_resource.get_role_description(step_details.role),
+            attempt=attempt,
+        )
+        # Choose an agent from the role's pool
+        role_member = team_resource.spec.members.get(step_details.role)
+        if role_member is None:
+            raise errors.AgentNotFoundError()
+        agent = self.dispatcher.choose(
+            role_member,
+            workflow_record.id,
+            step,
+            sticky=step_details.runConfig.sticky,
         )
         # Trigger the action by sending a message to the agent's inbox
-        await AgentInbox.from_role(
-            workflow_spec.team, step_details.role, rmq_client=self.rmq
-        ).trigger_action(workflow_spec.name, workflow_record.id, trigger_payload)
+        try:
+            await AgentInbox.from_team_resource(
+                team_resource, step_details.role, agent=agent, rmq_client=self.rmq
+            ).trigger_action(
+                workflow_spec.name,
+                workflow_record.id,
+                trigger_payload,
+                priority=workflow_spec.priorities.trigger_action,
+            )
+        except Exception:
+            self.dispatcher.release(workflow_record.id, step)
+            raise
+        if step_details.runConfig.timeout:
+            self.step_timers.schedule(
+                StepTimer(
+                    workflow=workflow_spec.name,
+                    record_id=workflow_record.id,
+                    step=step,
+                    action=step_details.action,
+                    attempt=attempt,
+                    deadline=time.time() + step_details.runConfig.timeout,
+                )
+            )
+
+    async def _trigger_actions(
+        self,
+        workflow_record: WorkflowRecord,
+        steps: list[str],
+        team_resource: Optional[TeamResource] = None,
+    ):
+        if not steps:
+            return
+
+        # The team is resolved once and shared by all triggers in this routing decision
+        if team_resource is None:
+            team_resource = self._get_team(workflow_record)
+        if team_resource is None:
+            return
+
+        workflow_spec = workflow_record.spec
+        triggers: list[tuple[str, WorkflowStep, dict[str, str]]] = []
+        for step in steps:
+            step_name, chunk, step_details = _resolve_step(workflow_spec, step)
+            # Map workflow context to action inputs
+            inputs = {
+                k: workflow_record.context[v].value
+                for k, v in step_details.inputMap.items()
+            }
+            if step_details.map is None:
+                triggers.append((step, step_details, inputs))
+                continue
+
+            # Map steps run one action per chunk of their list input
+            map_input = step_details.map.input
+            chunk_inputs = step_details.map.split(inputs[map_input])
+            if chunk is not None:
+                triggers.append(
+                    (step, step_details, {**inputs, map_input: chunk_inputs[chunk]})
+                )
+                continue
+
+            # The chunk count is kept so reports never split the input again
+            workflow_record.map_progress[step_name] = MapStepProgress(
+                chunks=len(chunk_inputs)
+            )
+            self.records.mark_dirty(workflow_record)
+            if not chunk_inputs:
+                # Nothing to map over, so the step reports empty lists straight away
+                await self._publish_workflow_message(
+                    workflow_record.id,
+                    workflow_record.name,
+                    WorkflowActionReportPayload.KEY,
+                    WorkflowActionReportPayload(
+                        step=step_name,
+                        action=step_details.action,
+                        outputs=_gather_map_step(
+                            workflow_record, step_name, step_details
+                        ),
+                        attempt=1,
+                    ),
+                )
+            else:
+                triggers.extend(
+                    (
+                        map_step_key(step_name, i),
+                        step_details,
+                        {**inputs, map_input: chunk_input},
+                    )
+                    for i, chunk_input in enumerate(chunk_inputs)
+                )
+
+        results = await asyncio.gather(
+            *[
+                self._trigger_action(
+                    workflow_record=workflow_record,
+                    team_resource=team_resource,
+                    step=step,
+                    step_details=step_details,
+                    inputs=inputs,
+                )
+                for step, step_details, inputs in triggers
+            ],
+            return_exceptions=True,
+        )
+        for (step, _, _), result in zip(triggers, results):
+            if isinstance(result, Exception):
+                logger.warning(
+                    "Failed to trigger step %s for workflow %s / %s: %s",
+                    step,
+                    workflow_spec.name,
+                    workflow_record.id,
+                    result,
+                )
 
     async def _handle_initiate_workflow(
         self, message: WorkflowMessage, payload: InitiateWorkflowPayload
@@ -131,12 +515,37 @@ class WorkflowRouter:
             )
             return
 
+        # Records only run while their workflow and team are under their limits,
+        #   otherwise they wait in a queue until a running record completes
+        workflow_limit = workflow_spec.max_concurrent_records
+        try:
+            team_resource = TeamService().get_team(workflow_spec.team)
+            team_limit = team_resource.spec.max_concurrent_records
+        except errors.TeamNotFoundError:
+            team_resource = None
+            team_limit = 0
+        admission = WorkflowRecordAdmission(
+            controlled=bool(workflow_limit or team_limit), priority=payload.priority
+        )
+        admitted = not admission.controlled or WorkflowAdmissionService().try_admit(
+            workflow_spec.team,
+            workflow_spec.name,
+            message.id,
+            workflow_limit=workflow_limit,
+            team_limit=team_limit,
+        )
+        if not admitted:
+            admission.queued_at = time.time()
+
         # Create a WorkflowRecord to hold state on this workflow execution
         try:
             workflow_record = WorkflowRecordService().create_workflow_record(
                 workflow_spec=workflow_spec,
                 inputs=payload.inputs,
                 workspace_name=payload.workspace,
+                record_id=message.id,
+                status="running" if admitted else "pending",
+                admission=admission,
             )
         except errors.WorkflowRecordAlreadyExistsError:
             logger.debug("(workflow-router) Workflow record already exists")
@@ -146,39 +555,66 @@ class WorkflowRouter:
                 payload.inputs,
             )
             return
+        self.records.add(workflow_record)
+
+        if not admitted:
+            pending_record = admission.get_pending_record(
+                workflow_spec.name, workflow_record.id
+            )
+            pending_record.workflow_limit = workflow_limit
+            pending_record.team_limit = team_limit
+            WorkflowAdmissionService().enqueue(workflow_spec.team, pending_record)
+            logger.info(
+                "Workflow %s / %s is waiting to run", message.workflow, message.id
+            )
+            # A slot may have been released after try_admit but before the enqueue,
+            #   in which case nothing else would admit this record
+            await self._admit_pending(workflow_spec.team)
+            return
+
+        await self._start_workflow(workflow_record, team_resource=team_resource)
 
+    async def _start_workflow(
+        self,
+        workflow_record: WorkflowRecord,
+        team_resource: Optional[TeamResource] = None,
+    ):
         workflow_spec_snapshot = workflow_record.spec
         # Notify listeners that the workflow has started
         asyncio.create_task(
             self._notify_workflow_started(workflow_record=workflow_record)
         )
 
-        for step_name, step_details in workflow_spec_snapshot.steps.items():
-            # If all dependencies are satisfied, trigger the action
-            if all(
-                [
-                    dep in workflow_record.context
-                    for dep in step_details.inputMap.values()
-                ]
-            ):
+        # Only steps which depend solely on workflow inputs can be ready at this point
+        derived_state = workflow_spec_snapshot.get_derived_state()
+        ready_steps = []
+        for step_name in derived_state.initial_steps:
+            step_details = workflow_spec_snapshot.steps[step_name]
+            if _step_is_ready(workflow_record, step_details):
                 logger.debug(
                     "(workflow-router) Triggering step %s (%s)",
                     step_name,
                     step_details.action,
                 )
-                await self._trigger_action(
-                    workflow_record=workflow_record,
-                    step=step_name,
-                    step_details=step_details,
-                )
+                ready_steps.append(step_name)
+        await self._trigger_actions(
+            workflow_record, ready_steps, team_resource=team_resource
+        )
 
     async def _handle_action_report(
         self, message: WorkflowMessage, payload: WorkflowActionReportPayload
     ):
-        try:
-            workflow_record = WorkflowRecordService().get_workflow_record(
-                message.workflow, message.id
+        idempotency_key = payload.idempotency_key
+        if (message.id, idempotency_key) in self.applied_reports:
+            logger.debug(
+                "(workflow-router) Dropping duplicate report %s for %s",
+                idempotency_key,
+                message.id,
             )
+            return
+
+        try:
+            workflow_record = self.records.get(message.workflow, message.id)
         except errors.WorkflowRecordNotFoundError:
             logger.debug("(workflow-router) Workflow record not found")
             logger.warning(
@@ -191,7 +627,7 @@ class WorkflowRouter:
 
         workflow_spec = workflow_record.spec
         try:
-            output_map = workflow_spec.steps[payload.step].outputMap
+            step_name, chunk, step_details = _resolve_step(workflow_spec, payload.step)
         except KeyError:
             logger.debug("(workflow-router) Step not found")
             logger.warning(
@@ -203,86 +639,423 @@ class WorkflowRouter:
             )
             return
 
+        if workflow_record.status != "running":
+            logger.debug(
+                "(workflow-router) Ignoring report %s for %s workflow record %s",
+                payload.step,
+                workflow_record.status,
+                message.id,
+            )
+            return
+
+        run_status = workflow_record.run_status.get(payload.step, StepRunStatus())
+        if run_status.has_result(idempotency_key):
+            logger.debug(
+                "(workflow-router) Dropping duplicate report %s for %s",
+                idempotency_key,
+                message.id,
+            )
+            self.applied_reports.put((message.id, idempotency_key), True)
+            return
+
+        # The step has reported, so it can no longer time out
+        #   and is no longer outstanding work for its agent
+        self.step_timers.cancel(message.id, payload.step)
+        self.dispatcher.release(message.id, payload.step)
+
         # Update the workflow record with the action's results
-        if payload.error:
-            workflow_record.errors.update(
-                {output_key: payload.error for output_key in output_map.keys()}
+        step_failed = _record_step_result(
+            workflow_record,
+            payload.step,
+            step_details,
+            outputs=payload.outputs,
+            error=payload.error,
+            idempotency_key=idempotency_key,
+            chunk=chunk,
+        )
+
+        # Only the reported step (for retries) and the steps consuming its outputs
+        #   can have changed readiness, chunks of a map step are gathered into
+        #   the map step's result once they have all succeeded
+        derived_state = workflow_spec.get_derived_state()
+        if chunk is None:
+            candidate_steps = [payload.step, *derived_state.dependents[payload.step]]
+        elif step_name in workflow_record.run_status:
+            # The map step already has a result, so late chunks change nothing
+            candidate_steps = []
+        elif step_failed:
+            _record_step_result(
+                workflow_record,
+                step_name,
+                step_details,
+                outputs={},
+                error=f"Chunk {chunk} failed: {payload.error}",
             )
+            candidate_steps = []
         else:
-            for output_key, output_value in payload.outputs.items():
-                if output_key in output_map:
-                    workflow_output_key = output_map[output_key]
-                    workflow_record.outputs[workflow_output_key] = output_value
+            # Chunks are only gathered once the last of them has succeeded
+            progress = workflow_record.map_progress.get(step_name)
+            if progress is not None and _is_first_success(
+                workflow_record.run_status[payload.step]
+            ):
+                progress.succeeded += 1
+            if progress is not None and progress.succeeded < progress.chunks:
+                gathered_outputs = None
+            else:
+                gathered_outputs = _gather_map_step(
+                    workflow_record, step_name, step_details
+                )
+            if gathered_outputs is None:
+                candidate_steps = [payload.step]
+            else:
+                _record_step_result(
+                    workflow_record, step_name, step_details, outputs=gathered_outputs
+                )
+                candidate_steps = derived_state.dependents[step_name]
 
-        action_outputs = {
-            f"{payload.step}.{output_key}": output_value
-            for output_key, output_value in payload.outputs.items()
-        }
-        workflow_record.context.update(action_outputs)
+        # Determine whether the workflow is finished
+        workflow_finished = _workflow_is_finished(workflow_record)
+        if workflow_finished:
+            workflow_record.status = "finished"
 
-        # Update the action's run status in the workflow record
-        run_status = workflow_record.run_status.get(payload.step, StepRunStatus())
-        run_status.runs += 1
-        run_status.results.append(
-            StepResult(outputs=payload.outputs, error=payload.error)
+        # Changes are written behind, coalescing reports which arrive close together.
+        #   The report only counts as applied once the record holding it is written
+        self.records.mark_dirty(workflow_record, report=(idempotency_key, message))
+
+        if workflow_finished:
+            # Finished records are written straight away and no longer cached
+            if self._flush_record(workflow_record, evict=True):
+                asyncio.create_task(
+                    self._notify_workflow_finished(workflow_record=workflow_record)
+                )
+                await self._release_admission(workflow_record)
+            return
+
+        ready_steps = []
+        retry_timers = []
+        for step_key in candidate_steps:
+            _, step_chunk, step_details = _resolve_step(workflow_spec, step_key)
+            if not _step_is_ready(workflow_record, step_details):
+                continue
+
+            step_run_config = step_details.runConfig
+            step_run_status = workflow_record.run_status.get(step_key, StepRunStatus())
+            action_failed = (
+                step_run_status.results and step_run_status.results[-1].error
+            )
+
+            if step_run_status.runs == 0:
+                # If the action hasn't been triggered yet, trigger it
+                ready_steps.append(step_key)
+            elif (
+                action_failed
+                and (step_details.map is None or step_chunk is not None)
+                and step_run_config.num_retries >= step_run_status.runs
+            ):
+                # If the action errored, and we haven't reached the max number of retries,
+                # trigger the action again (after backing off, if configured)
+                retry_delay = step_run_config.get_retry_delay(
+                    attempt=step_run_status.runs
+                )
+                if retry_delay > 0:
+                    logger.debug(
+                        "(workflow-router) Retrying step %s in %.1fs",
+                        step_key,
+                        retry_delay,
+                    )
+                    retry_timers.append(
+                        StepTimer(
+                            workflow=workflow_spec.name,
+                            record_id=workflow_record.id,
+                            step=step_key,
+                            action=step_details.action,
+                            kind="retry",
+                            deadline=time.time() + retry_delay,
+                        )
+                    )
+                else:
+                    ready_steps.append(step_key)
+        if not ready_steps and not retry_timers:
+            return
+
+        # Downstream steps (and retries) must only ever act on written state
+        if not self._flush_record(workflow_record):
+            return
+        for retry_timer in retry_timers:
+            self.step_timers.schedule(retry_timer)
+        await self._trigger_actions(workflow_record, ready_steps)
+
+    def _reports_written(
+        self,
+        workflow_record: WorkflowRecord,
+        reports: list[tuple[str, WorkflowMessage]],
+    ):
+        for idempotency_key, _ in reports:
+            if idempotency_key:
+                self.applied_reports.put((workflow_record.id, idempotency_key), True)
+
+    def _reapply_reports(
+        self,
+        workflow_record: WorkflowRecord,
+        reports: list[tuple[str, WorkflowMessage]],
+    ):
+        # The record was changed elsewhere before these reports were written,
+        #   so they are routed again and applied to the record as it is in etcd
+        for idempotency_key, _ in reports:
+            self.applied_reports.pop((workflow_record.id, idempotency_key))
+        logger.warning(
+            "Workflow record %s / %s changed before %s report(s) were written, applying them again",
+            workflow_record.name,
+            workflow_record.id,
+            len(reports),
+        )
+        asyncio.create_task(
+            self._republish_messages([message for _, message in reports])
         )
-        workflow_record.run_status[payload.step] = run_status
 
-        # Update the workflow record in etcd
+    async def _republish_messages(self, messages: list[WorkflowMessage]):
+        for message in messages:
+            try:
+                await self.rmq.publish_json(
+                    get_workflow_router_queue_for_record(
+                        message.id, num_shards=self.num_shards
+                    ),
+                    message.dict(),
+                    compress=True,
+                )
+            except Exception as e:
+                logger.error(
+                    "Failed to route report for workflow %s / %s again: %s",
+                    message.workflow,
+                    message.id,
+                    e,
+                )
+
+    def _flush_record(self, workflow_record: WorkflowRecord, evict: bool = False):
+        try:
+            if evict:
+                self.records.evict(workflow_record.id)
+            else:
+                self.records.flush(workflow_record.id)
+        except (
+            errors.WorkflowRecordNotFoundError,
+            errors.WorkflowRecordConflictError,
+        ) as e:
+            logger.debug("(workflow-router) Failed to write workflow record: %s", e)
+            logger.warning(
+                "Tried to update workflow record %s / %s, but %s",
+                workflow_record.name,
+                workflow_record.id,
+                e.message.lower(),
+            )
+            return False
+        return True
+
+    async def _handle_step_retry(
+        self, message: WorkflowMessage, payload: WorkflowStepRetryPayload
+    ):
         try:
-            WorkflowRecordService().update_workflow_record(workflow_record)
+            workflow_record = self.records.get(message.workflow, message.id)
         except errors.WorkflowRecordNotFoundError:
             logger.debug("(workflow-router) Workflow record not found")
             logger.warning(
-                "Tried to update workflow record %s / %s, but record not found",
+                "Tried to retry step %s for workflow %s / %s, but record not found",
+                payload.step,
                 message.workflow,
                 message.id,
             )
             return
 
-        # Determine whether the workflow is finished
-        required_outputs = {output.name for output in workflow_spec.outputs}
-        if (
-            workflow_record.outputs.keys() | workflow_record.errors.keys()
-            == required_outputs
-        ):
-            asyncio.create_task(
-                self._notify_workflow_finished(workflow_record=workflow_record)
+        try:
+            step_name, chunk, _ = _resolve_step(workflow_record.spec, payload.step)
+        except KeyError:
+            logger.debug("(workflow-router) Step not found: %s", payload.step)
+            return
+        step_run_status = workflow_record.run_status.get(payload.step, StepRunStatus())
+        still_failed = step_run_status.results and step_run_status.results[-1].error
+        map_step_finished = (
+            chunk is not None and step_name in workflow_record.run_status
+        )
+        if not still_failed or map_step_finished or workflow_record.status != "running":
+            logger.debug(
+                "(workflow-router) Skipping retry of step %s, no longer needed",
+                payload.step,
             )
             return
 
-        # Otherwise, trigger the appropriate action messages
-        for step_name, step_details in workflow_spec.steps.items():
-            dependencies_satisfied = all(
-                [
-                    dep in workflow_record.context
-                    for dep in step_details.inputMap.values()
-                ]
+        await self._trigger_actions(workflow_record, [payload.step])
+
+    async def _handle_cancel_workflow(
+        self, message: WorkflowMessage, payload: WorkflowCancelPayload
+    ):
+        try:
+            workflow_record = self.records.get(message.workflow, message.id)
+        except errors.WorkflowRecordNotFoundError:
+            logger.warning(
+                "Tried to cancel workflow %s / %s, but record not found",
+                message.workflow,
+                message.id,
             )
-            if not dependencies_satisfied:
-                continue
+            return
 
-            step_run_config = step_details.runConfig
-            step_run_status = workflow_record.run_status.get(step_name, StepRunStatus())
-            action_failed = (
-                step_run_status.results and step_run_status.results[-1].error
+        if workflow_record.status == "pending":
+            # Never started, so it only has to leave the queue
+            WorkflowAdmissionService().dequeue(
+                workflow_record.spec.team,
+                workflow_record.admission.get_pending_record(
+                    workflow_record.name, workflow_record.id
+                ),
+            )
+            workflow_record.status = "cancelled"
+            self.records.mark_dirty(workflow_record)
+            if self._flush_record(workflow_record, evict=True):
+                logger.info("Cancelled workflow %s / %s", message.workflow, message.id)
+            return
+        if workflow_record.status != "running":
+            logger.debug(
+                "(workflow-router) Workflow record %s already %s",
+                message.id,
+                workflow_record.status,
             )
+            return
 
-            if step_run_status.runs == 0:
-                # If the action hasn't been triggered yet, trigger it
-                await self._trigger_action(
-                    workflow_record=workflow_record,
-                    step=step_name,
-                    step_details=step_details,
+        workflow_record.status = "cancelled"
+        self.records.mark_dirty(workflow_record)
+        if not self._flush_record(workflow_record, evict=True):
+            return
+        await self._release_admission(workflow_record)
+        # No timeouts or retries should fire for a cancelled record
+        self.step_timers.cancel_record(workflow_record.id)
+        self.dispatcher.release_record(workflow_record.id)
+        logger.info("Cancelled workflow %s / %s", message.workflow, message.id)
+
+        # Tell every agent with unfinished steps in this record to stop working on it
+        team_resource = self._get_team(workflow_record)
+        if team_resource is None:
+            return
+        workflow_spec = workflow_record.spec
+        roles = set()
+        for step_name, step_details in workflow_spec.steps.items():
+            step_run_status = workflow_record.run_status.get(step_name)
+            if (
+                step_run_status is None
+                or not step_run_status.results
+                or step_run_status.results[-1].error
+            ):
+                roles.add(step_details.role)
+        agent_inboxes = {}
+        for role in roles:
+            role_member = team_resource.spec.members.get(role)
+            if role_member is None:
+                continue
+            for agent in role_member.get_agents():
+                agent_inboxes[agent] = AgentInbox.from_team_resource(
+                    team_resource, role, agent=agent, rmq_client=self.rmq
                 )
-            elif action_failed and step_run_config.num_retries >= step_run_status.runs:
-                # If the action errored, and we haven't reached the max number of retries,
-                # trigger the action again
-                await self._trigger_action(
-                    workflow_record=workflow_record,
-                    step=step_name,
-                    step_details=step_details,
+        await asyncio.gather(
+            *[
+                agent_inbox.cancel_workflow(
+                    workflow_spec.name, workflow_record.id, payload
                 )
+                for agent_inbox in agent_inboxes.values()
+            ]
+        )
+
+    async def _handle_admit_workflow(
+        self, message: WorkflowMessage, payload: WorkflowAdmitPayload
+    ):
+        try:
+            workflow_record = self.records.get(message.workflow, message.id)
+        except errors.WorkflowRecordNotFoundError:
+            logger.warning(
+                "Tried to start workflow %s / %s, but record not found",
+                message.workflow,
+                message.id,
+            )
+            if payload.team:
+                # Deleted while it was being admitted, so give the slot back
+                await self._release_slot(payload.team, message.workflow, message.id)
+            return
+
+        if workflow_record.status == "cancelled":
+            # Cancelled while it was being admitted, so give the slot back
+            await self._release_admission(workflow_record)
+            return
+        if workflow_record.status != "pending":
+            logger.debug(
+                "(workflow-router) Workflow record %s already %s",
+                message.id,
+                workflow_record.status,
+            )
+            return
+
+        admission = workflow_record.admission
+        admission.admitted_at = time.time()
+        admission.wait_time = admission.admitted_at - admission.queued_at
+        workflow_record.status = "running"
+        self.records.mark_dirty(workflow_record)
+        if not self._flush_record(workflow_record):
+            return
+        logger.info(
+            "Starting workflow %s / %s after waiting %.1fs",
+            message.workflow,
+            message.id,
+            admission.wait_time,
+        )
+        await self._start_workflow(workflow_record)
+
+    async def _release_admission(self, workflow_record: WorkflowRecord):
+        if not workflow_record.admission.controlled:
+            return
+        await self._release_slot(
+            workflow_record.spec.team, workflow_record.name, workflow_record.id
+        )
+
+    async def _release_slot(self, team: str, workflow_name: str, record_id: str):
+        # Free the record's slot, then start whichever queued records now fit
+        WorkflowAdmissionService().release(team, workflow_name, record_id)
+        await self._admit_pending(team)
+
+    async def _admit_pending(self, team: str):
+        for pending_record in WorkflowAdmissionService().admit_pending(team):
+            await self._publish_workflow_message(
+                pending_record.record_id,
+                pending_record.workflow,
+                WorkflowAdmitPayload.KEY,
+                WorkflowAdmitPayload(team=team),
+            )
+
+    async def _handle_step_timer(self, timer: StepTimer):
+        # Timers fire by publishing to the record's shard, so they follow the same
+        #   paths as other messages and stay ordered with the record's other messages
+        if timer.kind == "retry":
+            kind = WorkflowStepRetryPayload.KEY
+            payload = WorkflowStepRetryPayload(step=timer.step)
+        else:
+            # Timeouts are reported like any other action error (and may be retried)
+            logger.debug("(workflow-router) Step timed out: %s", timer.key)
+            kind = WorkflowActionReportPayload.KEY
+            payload = WorkflowActionReportPayload(
+                step=timer.step,
+                action=timer.action,
+                error=f"Step {timer.step} timed out",
+                attempt=timer.attempt,
+            )
+        await self._publish_workflow_message(
+            timer.record_id, timer.workflow, kind, payload
+        )
+
+    async def _publish_workflow_message(
+        self, record_id: str, workflow: str, kind: str, payload: BaseModel
+    ):
+        message = WorkflowMessage(
+            id=record_id, workflow=workflow, kind=kind, data=payload.dict()
+        )
+        await self.rmq.publish_json(
+            get_workflow_router_queue_for_record(record_id, num_shards=self.num_shards),
+            message.dict(),
+            compress=True,
+        )
 
     async def _notify_workflow_started(self, workflow_record: WorkflowRecord):
         results = await asyncio.gather(
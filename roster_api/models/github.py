@@ -0,0 +1,24 @@
+from pydantic import BaseModel, Field
+
+
+class GithubWebhookMessage(BaseModel):
+    delivery_id: str = Field(
+        default="",
+        description="The unique ID of the webhook delivery (X-GitHub-Delivery)",
+    )
+    event: str = Field(
+        default="", description="The kind of event which triggered the webhook"
+    )
+    payload: dict = Field(
+        default_factory=dict, description="The payload of the webhook"
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "delivery_id": "72d3162e-cc78-11e3-81ab-4c9367dc0958",
+                "event": "issues",
+                "payload": {"action": "opened", "issue": {"number": 1}},
+            }
+        }
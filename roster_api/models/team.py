@@ -39,6 +39,14 @@ class Layout(BaseModel):
 class Member(BaseModel):
     identity: str = Field(description="The identity of the member.")
     agent: str = Field(description="The agent running this member.")
+    pool: list[str] = Field(
+        default_factory=list,
+        description="Further agents which share the work of this member.",
+    )
+    dispatch: str = Field(
+        default="least_loaded",
+        description="How work is spread across the agents ('least_loaded' or 'round_robin').",
+    )
 
     class Config:
         validate_assignment = True
@@ -46,9 +54,14 @@ class Member(BaseModel):
             "example": {
                 "identity": "Alice",
                 "agent": "agent1",
+                "pool": ["agent2", "agent3"],
+                "dispatch": "least_loaded",
             }
         }
 
+    def get_agents(self) -> list[str]:
+        return list(dict.fromkeys([self.agent, *self.pool]))
+
 
 class Workflow(BaseModel):
     name: str = Field(description="A name to identify the workflow.")
@@ -89,6 +102,11 @@ class TeamSpec(BaseModel):
     members: dict[str, Member] = Field(
         default_factory=dict, description="The members of the team."
     )
+    max_concurrent_records: int = Field(
+        default=0,
+        ge=0,
+        description="The most workflow records the team may run at once (0 is unlimited).",
+    )
 
     class Config:
         validate_assignment = True
@@ -102,6 +120,7 @@ class TeamSpec(BaseModel):
                     "member1": Member.Config.schema_extra["example"],
                     "member2": Member.Config.schema_extra["example"],
                 },
+                "max_concurrent_records": 10,
             }
         }
 
@@ -1,12 +1,15 @@
+import json
 import logging
+import random
+import re
 import uuid
-from typing import ClassVar
+from typing import ClassVar, Optional
 
 from pydantic import BaseModel, Field, constr
 from roster_api import constants
 from roster_api.models.base import RosterResource
 from roster_api.models.common import TypedArgument, TypedResult
-from roster_api.util.graph_ops import sort_dependencies
+from roster_api.util.graph_ops import reverse_dependencies, sort_dependencies
 
 logger = logging.getLogger(constants.LOGGER_NAME)
 
@@ -16,15 +19,115 @@ class StepRunConfig(BaseModel):
         default=0,
         description="The number of times to retry the Step if it fails.",
     )
+    timeout: float = Field(
+        default=0,
+        ge=0,
+        description="Seconds to wait for the Step to report before it fails (0 waits forever).",
+    )
+    backoff_base: float = Field(
+        default=2.0,
+        ge=0,
+        description="Seconds to wait before the first retry, doubling for each further retry (0 retries immediately).",
+    )
+    backoff_max: float = Field(
+        default=300.0,
+        ge=0,
+        description="The maximum number of seconds to wait before a retry.",
+    )
+    jitter: float = Field(
+        default=0.5,
+        ge=0,
+        le=1,
+        description="The fraction of each retry delay which is randomized.",
+    )
+    sticky: bool = Field(
+        default=False,
+        description="Whether to run on the same agent as other sticky steps of the role in this record.",
+    )
 
     class Config:
         validate_assignment = True
         schema_extra = {
             "example": {
                 "num_retries": 3,
+                "timeout": 600,
+                "backoff_base": 2.0,
+                "backoff_max": 300.0,
+                "jitter": 0.5,
+                "sticky": False,
+            }
+        }
+
+    def get_retry_delay(self, attempt: int) -> float:
+        # Exponential backoff, randomly shortened by up to `jitter` of the delay
+        #   so that retries of many failed steps don't arrive in lockstep
+        if not self.backoff_base or attempt < 1:
+            return 0.0
+        delay = min(self.backoff_max, self.backoff_base * 2 ** min(attempt - 1, 32))
+        return delay * (1 - self.jitter * random.random())
+
+
+class MessagePriorityConfig(BaseModel):
+    trigger_action: int = Field(
+        default=constants.DEFAULT_TRIGGER_ACTION_PRIORITY,
+        ge=0,
+        le=constants.AGENT_INBOX_MAX_PRIORITY,
+        description="The priority of action triggers sent to agent inboxes.",
+    )
+    tool_response: int = Field(
+        default=constants.DEFAULT_TOOL_RESPONSE_PRIORITY,
+        ge=0,
+        le=constants.AGENT_INBOX_MAX_PRIORITY,
+        description="The priority of tool responses sent to agent inboxes.",
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "trigger_action": 1,
+                "tool_response": 5,
+            }
+        }
+
+
+class StepMapConfig(BaseModel):
+    input: str = Field(
+        description="The action input (from the inputMap) holding the list to map over."
+    )
+    chunk_size: int = Field(
+        default=1,
+        ge=1,
+        description="The number of list items passed to each action run.",
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "input": "files",
+                "chunk_size": 10,
             }
         }
 
+    def split(self, value: str) -> list[str]:
+        # Lists are JSON arrays, anything else is treated as one item per line.
+        #   Each chunk is passed as a JSON array, unless chunks hold a single item
+        #   in which case the item itself is passed.
+        try:
+            items = json.loads(value)
+        except json.JSONDecodeError:
+            items = None
+        if not isinstance(items, list):
+            items = [line for line in value.splitlines() if line.strip()]
+        items = [item if isinstance(item, str) else json.dumps(item) for item in items]
+        if self.chunk_size == 1:
+            return items
+        return [
+            json.dumps(items[i : i + self.chunk_size])
+            for i in range(0, len(items), self.chunk_size)
+        ]
+
 
 class WorkflowStep(BaseModel):
     role: str = Field(description="The role that executes the action.")
@@ -42,6 +145,10 @@ class WorkflowStep(BaseModel):
         default_factory=StepRunConfig,
         description="The run configuration for the action.",
     )
+    map: Optional[StepMapConfig] = Field(
+        default=None,
+        description="Runs the action once per chunk of a list input, gathering outputs into lists.",
+    )
 
     class Config:
         validate_assignment = True
@@ -52,10 +159,15 @@ class WorkflowStep(BaseModel):
                 "inputMap": {"code": "Code.code"},
                 "outputMap": {"pull_request": "workflow.feature_pull_request"},
                 "runConfig": StepRunConfig.Config.schema_extra["example"],
+                "map": None,
             }
         }
 
     def get_dependencies(self) -> set[str]:
+        if self.map is not None and self.map.input not in self.inputMap:
+            raise ValueError(
+                f"Could not map step over '{self.map.input}', input not found: {self}"
+            )
         deps = set()
         for dep_name in self.inputMap.values():
             # TODO: factor workflow variable namespacing into shared utility
@@ -73,18 +185,34 @@ class WorkflowDerivedState(BaseModel):
     sorted_steps: list[str] = Field(
         default_factory=list, description="The sorted order of steps in the workflow."
     )
+    initial_steps: list[str] = Field(
+        default_factory=list,
+        description="The steps which only depend on workflow inputs, in sorted order.",
+    )
+    dependents: dict[str, list[str]] = Field(
+        default_factory=dict,
+        description="Maps each step to the steps which consume its outputs.",
+    )
 
     class Config:
         validate_assignment = True
         schema_extra = {
             "example": {
                 "sorted_steps": ["step1", "step2"],
+                "initial_steps": ["step1"],
+                "dependents": {"step1": ["step2"], "step2": []},
             }
         }
 
     @classmethod
     def build(cls, spec: "WorkflowSpec") -> "WorkflowDerivedState":
-        return cls(sorted_steps=sort_dependencies(spec.get_dependency_graph()))
+        graph = spec.get_dependency_graph()
+        sorted_steps = [step for step in sort_dependencies(graph) if step in spec.steps]
+        return cls(
+            sorted_steps=sorted_steps,
+            initial_steps=[step for step in sorted_steps if not graph[step]],
+            dependents=reverse_dependencies(graph, order=sorted_steps),
+        )
 
 
 class WorkflowSpec(BaseModel):
@@ -100,6 +228,15 @@ class WorkflowSpec(BaseModel):
     steps: dict[str, WorkflowStep] = Field(
         default_factory=dict, description="The steps in the workflow."
     )
+    priorities: MessagePriorityConfig = Field(
+        default_factory=MessagePriorityConfig,
+        description="The priorities of messages sent to agents for this workflow.",
+    )
+    max_concurrent_records: int = Field(
+        default=0,
+        ge=0,
+        description="The most records of this workflow which may run at once (0 is unlimited).",
+    )
     derived_state: WorkflowDerivedState = Field(
         default_factory=WorkflowDerivedState,
         description="The derived state from the workflow spec.",
@@ -124,6 +261,8 @@ class WorkflowSpec(BaseModel):
                     "step1": WorkflowStep.Config.schema_extra["example"],
                     "step2": WorkflowStep.Config.schema_extra["example"],
                 },
+                "priorities": MessagePriorityConfig.Config.schema_extra["example"],
+                "max_concurrent_records": 5,
                 "derived_state": WorkflowDerivedState.Config.schema_extra["example"],
             }
         }
@@ -131,6 +270,12 @@ class WorkflowSpec(BaseModel):
     def update_derived_state(self):
         self.derived_state = WorkflowDerivedState.build(spec=self)
 
+    def get_derived_state(self) -> WorkflowDerivedState:
+        # Specs stored before the scheduling fields were added are rebuilt lazily
+        if len(self.derived_state.dependents) != len(self.steps):
+            self.update_derived_state()
+        return self.derived_state
+
     def get_dependency_graph(self) -> dict[str, set[str]]:
         workflow_graph = {}
         for step_name, step in self.steps.items():
@@ -182,6 +327,12 @@ class InitiateWorkflowArgs(BaseModel):
     inputs: dict[str, str] = Field(
         default_factory=dict, description="The inputs to the workflow."
     )
+    priority: int = Field(
+        default=0,
+        ge=0,
+        le=constants.MAX_WORKFLOW_PRIORITY,
+        description="Records waiting to run are started in order of priority (highest first).",
+    )
 
     class Config:
         validate_assignment = True
@@ -189,6 +340,7 @@ class InitiateWorkflowArgs(BaseModel):
             "example": {
                 "workflow": "WorkflowName",
                 "inputs": {"input1": "value1", "input2": "value2"},
+                "priority": 0,
             }
         }
 
@@ -199,6 +351,12 @@ class InitiateWorkflowPayload(BaseModel):
     workspace: str = Field(
         default="", description="The workspace in which the workflow is operating."
     )
+    priority: int = Field(
+        default=0,
+        ge=0,
+        le=constants.MAX_WORKFLOW_PRIORITY,
+        description="The priority of the record while it waits to run.",
+    )
 
     class Config:
         validate_assignment = True
@@ -206,10 +364,49 @@ class InitiateWorkflowPayload(BaseModel):
             "example": {
                 "inputs": {"input1": "value1", "input2": "value2"},
                 "workspace": "WorkspaceName",
+                "priority": 0,
             }
         }
 
 
+class WorkflowAdmitPayload(BaseModel):
+    KEY: ClassVar[str] = "admit_workflow"
+
+    team: str = Field(
+        default="",
+        description="The team whose running records the record was admitted to.",
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {"example": {"team": "TeamName"}}
+
+
+MAP_STEP_KEY_PATTERN = re.compile(r"^(?P<step>.+)\[(?P<chunk>\d+)\]$")
+
+
+def map_step_key(step: str, chunk: int) -> str:
+    # Each chunk of a map step is triggered, reported and retried as its own step
+    return f"{step}[{chunk}]"
+
+
+def parse_map_step_key(step_key: str) -> tuple[str, Optional[int]]:
+    match = MAP_STEP_KEY_PATTERN.match(step_key)
+    if match is None:
+        return step_key, None
+    return match.group("step"), int(match.group("chunk"))
+
+
+def report_idempotency_key(step: str, attempt: int = 0, invocation_id: str = "") -> str:
+    # The first report for an attempt wins (e.g. a timeout beats a late agent report),
+    #   agents which don't echo the attempt are deduplicated by their invocation ID
+    if attempt:
+        return f"{step}:attempt:{attempt}"
+    if invocation_id:
+        return f"{step}:invocation:{invocation_id}"
+    return ""
+
+
 class WorkflowActionReportPayload(BaseModel):
     KEY: ClassVar[str] = "report_action"
     step: str = Field(
@@ -223,6 +420,14 @@ class WorkflowActionReportPayload(BaseModel):
         default="",
         description="An error message if the Action failed to execute.",
     )
+    attempt: int = Field(
+        default=0,
+        description="The attempt number from the trigger being reported (0 if unknown).",
+    )
+    invocation_id: str = Field(
+        default="",
+        description="An identifier chosen by the agent for this Action invocation.",
+    )
 
     class Config:
         validate_assignment = True
@@ -235,6 +440,40 @@ class WorkflowActionReportPayload(BaseModel):
                     "output2": {"type": "text", "value": "value2"},
                 },
                 "error": "",
+                "attempt": 1,
+                "invocation_id": "123e4567-e89b-12d3-a456-426614174000",
+            }
+        }
+
+    @property
+    def idempotency_key(self) -> str:
+        return report_idempotency_key(self.step, self.attempt, self.invocation_id)
+
+
+class WorkflowCancelPayload(BaseModel):
+    KEY: ClassVar[str] = "cancel_workflow"
+    reason: str = Field(
+        default="", description="Why the workflow record was cancelled."
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "reason": "Cancelled by user",
+            }
+        }
+
+
+class WorkflowStepRetryPayload(BaseModel):
+    KEY: ClassVar[str] = "retry_step"
+    step: str = Field(description="The name of the Step to retry.")
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "step": "StepName",
             }
         }
 
@@ -251,6 +490,10 @@ class WorkflowActionTriggerPayload(BaseModel):
     role_context: str = Field(
         description="A description of the Role which is performing the Action."
     )
+    attempt: int = Field(
+        default=1,
+        description="The attempt number of this Step, to be echoed in the report.",
+    )
 
     class Config:
         validate_assignment = True
@@ -260,6 +503,7 @@ class WorkflowActionTriggerPayload(BaseModel):
                 "action": "ActionName",
                 "inputs": {"input1": "value1", "input2": "value2"},
                 "role_context": "A description of the role",
+                "attempt": 1,
             }
         }
 
@@ -268,6 +512,9 @@ WORKFLOW_MESSAGE_PAYLOADS = [
     InitiateWorkflowPayload,
     WorkflowActionReportPayload,
     WorkflowActionTriggerPayload,
+    WorkflowStepRetryPayload,
+    WorkflowCancelPayload,
+    WorkflowAdmitPayload,
 ]
 MESSAGE_PAYLOADS_BY_KIND = {
     payload.KEY: payload for payload in WORKFLOW_MESSAGE_PAYLOADS
@@ -313,6 +560,10 @@ class StepResult(BaseModel):
         default="",
         description="An error message if the action failed to execute.",
     )
+    idempotency_key: str = Field(
+        default="",
+        description="Identifies the report which produced this result (if known).",
+    )
 
     class Config:
         validate_assignment = True
@@ -323,6 +574,7 @@ class StepResult(BaseModel):
                     "output2": {"type": "text", "value": "value2"},
                 },
                 "error": "",
+                "idempotency_key": "StepName:attempt:1",
             }
         }
 
@@ -349,6 +601,76 @@ class StepRunStatus(BaseModel):
             }
         }
 
+    def has_result(self, idempotency_key: str) -> bool:
+        return bool(idempotency_key) and any(
+            result.idempotency_key == idempotency_key for result in self.results
+        )
+
+
+class MapStepProgress(BaseModel):
+    chunks: int = Field(
+        description="The number of chunks the list input was split into when dispatched."
+    )
+    succeeded: int = Field(
+        default=0,
+        description="The number of chunks which have succeeded.",
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "chunks": 4,
+                "succeeded": 1,
+            }
+        }
+
+
+class WorkflowRecordAdmission(BaseModel):
+    controlled: bool = Field(
+        default=False,
+        description="Whether the record counts towards concurrency limits.",
+    )
+    priority: int = Field(
+        default=0, description="The priority of the record while it waits to run."
+    )
+    queued_at: float = Field(
+        default=0, description="When the record started waiting to run (if it did)."
+    )
+    admitted_at: float = Field(
+        default=0, description="When the record stopped waiting to run."
+    )
+    queue_position: int = Field(
+        default=0,
+        description="The position of the record in the queue (1 is next, 0 if not queued).",
+    )
+    wait_time: float = Field(
+        default=0, description="Seconds the record has waited (or waited) to run."
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "controlled": True,
+                "priority": 0,
+                "queued_at": 1700000000.0,
+                "admitted_at": 0,
+                "queue_position": 3,
+                "wait_time": 42.0,
+            }
+        }
+
+    def get_pending_record(
+        self, workflow_name: str, record_id: str
+    ) -> "PendingWorkflowRecord":
+        return PendingWorkflowRecord(
+            workflow=workflow_name,
+            record_id=record_id,
+            priority=self.priority,
+            queued_at=self.queued_at,
+        )
+
 
 class WorkflowRecord(BaseModel):
     id: str = Field(
@@ -362,6 +684,14 @@ class WorkflowRecord(BaseModel):
     workspace: str = Field(
         default="", description="The name of the associated workspace (if any)."
     )
+    status: str = Field(
+        default="running",
+        description="The status of the execution (pending, running, finished or cancelled).",
+    )
+    admission: WorkflowRecordAdmission = Field(
+        default_factory=WorkflowRecordAdmission,
+        description="How the record was admitted to run under concurrency limits.",
+    )
     outputs: dict[str, TypedResult] = Field(
         default_factory=dict, description="The final outputs of the workflow."
     )
@@ -376,6 +706,10 @@ class WorkflowRecord(BaseModel):
         default_factory=dict,
         description="The run status of the actions in the workflow.",
     )
+    map_progress: dict[str, MapStepProgress] = Field(
+        default_factory=dict,
+        description="The progress of each dispatched map step through its chunks.",
+    )
 
     class Config:
         validate_assignment = True
@@ -385,6 +719,8 @@ class WorkflowRecord(BaseModel):
                 "name": "WorkflowName",
                 "spec": WorkflowSpec.Config.schema_extra["example"],
                 "workspace": "my-branch-workspace",
+                "status": "running",
+                "admission": WorkflowRecordAdmission.Config.schema_extra["example"],
                 "outputs": {
                     "output1": {"type": "text", "value": "value1"},
                     "output2": {"type": "text", "value": "value2"},
@@ -397,10 +733,123 @@ class WorkflowRecord(BaseModel):
                 "run_status": {
                     "ActionName": StepRunStatus.Config.schema_extra["example"],
                 },
+                "map_progress": {
+                    "MapStepName": MapStepProgress.Config.schema_extra["example"],
+                },
             }
         }
 
 
+class PendingWorkflowRecord(BaseModel):
+    workflow: str = Field(description="The name of the workflow.")
+    record_id: str = Field(description="The ID of the workflow record.")
+    priority: int = Field(
+        default=0, description="The priority of the record while it waits to run."
+    )
+    queued_at: float = Field(description="When the record started waiting to run.")
+    workflow_limit: int = Field(
+        default=0, description="The concurrency limit of the workflow (0 is unlimited)."
+    )
+    team_limit: int = Field(
+        default=0, description="The concurrency limit of the team (0 is unlimited)."
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "workflow": "WorkflowName",
+                "record_id": "123e4567-e89b-12d3-a456-426614174000",
+                "priority": 0,
+                "queued_at": 1700000000.0,
+                "workflow_limit": 5,
+                "team_limit": 10,
+            }
+        }
+
+    @property
+    def queue_key(self) -> str:
+        # Sorts by priority (highest first), then by arrival
+        return f"{constants.MAX_WORKFLOW_PRIORITY - self.priority:04d}/{self.queued_at:017.6f}/{self.record_id}"
+
+
+class WorkflowAdmissionState(BaseModel):
+    running: dict[str, list[str]] = Field(
+        default_factory=dict,
+        description="The IDs of the records admitted to run, by workflow.",
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "running": {
+                    "WorkflowName": ["123e4567-e89b-12d3-a456-426614174000"],
+                },
+            }
+        }
+
+    def count(self, workflow: str = "") -> int:
+        if workflow:
+            return len(self.running.get(workflow, []))
+        return sum(len(record_ids) for record_ids in self.running.values())
+
+    def is_admitted(self, workflow: str, record_id: str) -> bool:
+        return record_id in self.running.get(workflow, [])
+
+    def can_admit(self, workflow: str, workflow_limit: int = 0, team_limit: int = 0):
+        if workflow_limit and self.count(workflow) >= workflow_limit:
+            return False
+        return not team_limit or self.count() < team_limit
+
+    def admit(self, workflow: str, record_id: str):
+        if not self.is_admitted(workflow, record_id):
+            self.running.setdefault(workflow, []).append(record_id)
+
+    def release(self, workflow: str, record_id: str) -> bool:
+        if not self.is_admitted(workflow, record_id):
+            return False
+        self.running[workflow].remove(record_id)
+        if not self.running[workflow]:
+            del self.running[workflow]
+        return True
+
+
+class StepTimer(BaseModel):
+    workflow: str = Field(description="The name of the workflow.")
+    record_id: str = Field(description="The ID of the workflow record.")
+    step: str = Field(description="The step which is running.")
+    action: str = Field(description="The action which the step is running.")
+    kind: str = Field(
+        default="timeout",
+        description="What happens at the deadline ('timeout' or 'retry').",
+    )
+    attempt: int = Field(
+        default=0, description="The attempt of the step which this timer refers to."
+    )
+    deadline: float = Field(
+        description="The time (seconds since the epoch) at which the timer fires."
+    )
+
+    class Config:
+        validate_assignment = True
+        schema_extra = {
+            "example": {
+                "workflow": "WorkflowName",
+                "record_id": "123e4567-e89b-12d3-a456-426614174000",
+                "step": "StepName",
+                "action": "ActionName",
+                "kind": "timeout",
+                "attempt": 1,
+                "deadline": 1700000000.0,
+            }
+        }
+
+    @property
+    def key(self) -> str:
+        return f"{self.record_id}/{self.step}/{self.kind}"
+
+
 # TODO: narrow these to specific fields?
 class WorkflowStartEvent(BaseModel):
     workflow_record: WorkflowRecord
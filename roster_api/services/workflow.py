@@ -1,15 +1,25 @@
 import logging
+import time
 import uuid
-from typing import Optional
+from typing import Callable, Optional
 
 import etcd3
 from roster_api import constants, errors
-from roster_api.constants import WORKFLOW_ROUTER_QUEUE
 from roster_api.db.etcd import get_etcd_client
 from roster_api.messaging.rabbitmq import RabbitMQClient, get_rabbitmq
 from roster_api.models.common import TypedResult
-from roster_api.models.workflow import WorkflowRecord, WorkflowResource, WorkflowSpec
+from roster_api.models.workflow import (
+    PendingWorkflowRecord,
+    StepTimer,
+    WorkflowAdmissionState,
+    WorkflowAdmitPayload,
+    WorkflowRecord,
+    WorkflowRecordAdmission,
+    WorkflowResource,
+    WorkflowSpec,
+)
 from roster_api.util.serialization import deserialize_from_etcd, serialize
+from roster_api.util.sharding import get_workflow_router_queue_for_record
 
 logger = logging.getLogger(constants.LOGGER_NAME)
 
@@ -82,23 +92,97 @@ class WorkflowService:
         return deleted
 
     async def initiate_workflow(
-        self, workflow_name: str, inputs: dict, workspace_name: str = ""
-    ):
+        self,
+        workflow_name: str,
+        inputs: dict,
+        workspace_name: str = "",
+        priority: int = 0,
+    ) -> str:
         workflow = self.get_workflow(workflow_name)
+        # The record ID is assigned here so the message lands on the router shard
+        #   which will own the record for its whole lifetime
+        record_id = str(uuid.uuid4())
         logger.debug(
             "Sent message to initiate workflow %s with inputs: %s",
             workflow_name,
             inputs,
         )
         await self.rmq.publish_json(
-            WORKFLOW_ROUTER_QUEUE,
+            get_workflow_router_queue_for_record(record_id),
             {
-                "id": str(uuid.uuid4()),
+                "id": record_id,
                 "workflow": workflow.spec.name,
                 "kind": "initiate_workflow",
-                "data": {"inputs": inputs, "workspace": workspace_name},
+                "data": {
+                    "inputs": inputs,
+                    "workspace": workspace_name,
+                    "priority": priority,
+                },
+            },
+            compress=True,
+        )
+        return record_id
+
+    async def cancel_workflow(
+        self, workflow_name: str, record_id: str, reason: str = ""
+    ) -> WorkflowRecord:
+        workflow_record = WorkflowRecordService(
+            etcd_client=self.etcd_client
+        ).get_workflow_record(workflow_name, record_id)
+        # The router which owns the record applies the cancellation,
+        #   so it can't race with reports being applied to the record
+        await self.rmq.publish_json(
+            get_workflow_router_queue_for_record(record_id),
+            {
+                "id": record_id,
+                "workflow": workflow_name,
+                "kind": "cancel_workflow",
+                "data": {"reason": reason},
             },
+            compress=True,
         )
+        logger.debug(
+            "Sent message to cancel workflow %s / %s", workflow_name, record_id
+        )
+        # The cancellation is applied asynchronously, so the record returned
+        #   is only marked as cancelling (this status is never stored)
+        if workflow_record.status in ("pending", "running"):
+            workflow_record.status = "cancelling"
+        return workflow_record
+
+    async def delete_workflow_record(self, workflow_name: str, record_id: str) -> bool:
+        record_service = WorkflowRecordService(etcd_client=self.etcd_client)
+        try:
+            workflow_record = record_service.get_workflow_record(
+                workflow_name, record_id
+            )
+        except errors.WorkflowRecordNotFoundError:
+            return False
+        deleted = record_service.delete_workflow_record(workflow_name, record_id)
+        if not deleted or not workflow_record.admission.controlled:
+            return deleted
+
+        # A deleted record must not keep its place in the queue or its running slot
+        admission_service = WorkflowAdmissionService(etcd_client=self.etcd_client)
+        team = workflow_record.spec.team
+        if workflow_record.status == "pending":
+            admission_service.dequeue(
+                team,
+                workflow_record.admission.get_pending_record(workflow_name, record_id),
+            )
+        admission_service.release(team, workflow_name, record_id)
+        for pending_record in admission_service.admit_pending(team):
+            await self.rmq.publish_json(
+                get_workflow_router_queue_for_record(pending_record.record_id),
+                {
+                    "id": pending_record.record_id,
+                    "workflow": pending_record.workflow,
+                    "kind": WorkflowAdmitPayload.KEY,
+                    "data": WorkflowAdmitPayload(team=team).dict(),
+                },
+                compress=True,
+            )
+        return deleted
 
 
 class WorkflowRecordService:
@@ -128,6 +212,9 @@ class WorkflowRecordService:
         workflow_spec: WorkflowSpec,
         inputs: Optional[dict] = None,
         workspace_name: str = "",
+        record_id: Optional[str] = None,
+        status: str = "running",
+        admission: Optional[WorkflowRecordAdmission] = None,
         namespace: str = DEFAULT_NAMESPACE,
     ) -> WorkflowRecord:
         # NOTE: implied that inputs are validated, might want to move that here
@@ -143,7 +230,11 @@ class WorkflowRecordService:
             spec=workflow_spec,
             context=context,
             workspace=workspace_name,
+            status=status,
+            admission=admission or WorkflowRecordAdmission(),
         )
+        if record_id:
+            workflow_record.id = record_id
         record_key = self._get_record_key(
             workflow_name, workflow_record.id, namespace=namespace
         )
@@ -174,6 +265,21 @@ class WorkflowRecordService:
             )
         return deserialize_from_etcd(WorkflowRecord, record_data)
 
+    def get_workflow_record_revision(
+        self, workflow_name: str, record_id: str, namespace: str = DEFAULT_NAMESPACE
+    ) -> tuple[WorkflowRecord, int]:
+        # Also returns the revision at which the record was last modified
+        record_key = self._get_record_key(workflow_name, record_id, namespace=namespace)
+        record_data, record_metadata = self.etcd_client.get(record_key)
+        if not record_data:
+            raise errors.WorkflowRecordNotFoundError(
+                workflow=workflow_name, record=record_id
+            )
+        return (
+            deserialize_from_etcd(WorkflowRecord, record_data),
+            record_metadata.mod_revision,
+        )
+
     def list_workflow_records(
         self, workflow_name: str = "", namespace: str = DEFAULT_NAMESPACE
     ) -> list[WorkflowRecord]:
@@ -205,6 +311,44 @@ class WorkflowRecordService:
         )
         return workflow_record
 
+    def update_workflow_record_revision(
+        self,
+        workflow_record: WorkflowRecord,
+        revision: Optional[int] = None,
+        namespace: str = DEFAULT_NAMESPACE,
+    ) -> int:
+        # Only writes if the record is unchanged since the given revision
+        #   (or just exists, without one), and returns the new revision
+        record_key = self._get_record_key(
+            workflow_record.name, workflow_record.id, namespace=namespace
+        )
+        transactions = self.etcd_client.transactions
+        if revision:
+            compare = [transactions.mod(record_key) == revision]
+        else:
+            compare = [transactions.version(record_key) > 0]
+        succeeded, responses = self.etcd_client.transaction(
+            compare=compare,
+            success=[
+                transactions.put(record_key, serialize(workflow_record)),
+                transactions.get(record_key),
+            ],
+            failure=[transactions.get(record_key)],
+        )
+        if not succeeded:
+            if not responses or not responses[0]:
+                raise errors.WorkflowRecordNotFoundError(
+                    workflow=workflow_record.name, record=workflow_record.id
+                )
+            raise errors.WorkflowRecordConflictError(
+                workflow=workflow_record.name, record=workflow_record.id
+            )
+        logger.debug(
+            "Updated Workflow Record %s / %s", workflow_record.name, workflow_record.id
+        )
+        _, record_metadata = responses[1][0]
+        return record_metadata.mod_revision
+
     def delete_workflow_record(
         self, workflow_name: str, record_id: str, namespace: str = DEFAULT_NAMESPACE
     ) -> bool:
@@ -213,3 +357,216 @@ class WorkflowRecordService:
         if deleted:
             logger.debug("Deleted Workflow Record %s / %s", workflow_name, record_id)
         return deleted
+
+
+class StepTimerService:
+    KEY_PREFIX = "/timers/steps"
+    DEFAULT_NAMESPACE = "default"
+
+    def __init__(self, etcd_client: Optional[etcd3.Etcd3Client] = None):
+        self.etcd_client: etcd3.Etcd3Client = etcd_client or get_etcd_client()
+
+    def _get_base_key(self, namespace: str = DEFAULT_NAMESPACE) -> str:
+        return f"{self.KEY_PREFIX}/{namespace}"
+
+    def _get_timer_key(self, timer_key: str, namespace: str = DEFAULT_NAMESPACE) -> str:
+        return f"{self._get_base_key(namespace=namespace)}/{timer_key}"
+
+    def put_timer(
+        self, timer: StepTimer, namespace: str = DEFAULT_NAMESPACE
+    ) -> StepTimer:
+        self.etcd_client.put(
+            self._get_timer_key(timer.key, namespace=namespace), serialize(timer)
+        )
+        logger.debug("Set StepTimer %s (deadline: %s)", timer.key, timer.deadline)
+        return timer
+
+    def list_timers(self, namespace: str = DEFAULT_NAMESPACE) -> list[StepTimer]:
+        timer_data = self.etcd_client.get_prefix(
+            self._get_base_key(namespace=namespace)
+        )
+        return [deserialize_from_etcd(StepTimer, data) for data, _ in timer_data]
+
+    def delete_timer(self, timer_key: str, namespace: str = DEFAULT_NAMESPACE) -> bool:
+        deleted = self.etcd_client.delete(
+            self._get_timer_key(timer_key, namespace=namespace)
+        )
+        if deleted:
+            logger.debug("Deleted StepTimer %s", timer_key)
+        return deleted
+
+
+class WorkflowAdmissionService:
+    KEY_PREFIX = "/admission/workflows"
+    DEFAULT_NAMESPACE = "default"
+
+    def __init__(self, etcd_client: Optional[etcd3.Etcd3Client] = None):
+        self.etcd_client: etcd3.Etcd3Client = etcd_client or get_etcd_client()
+
+    def _get_team_key(self, team: str, namespace: str = DEFAULT_NAMESPACE) -> str:
+        return f"{self.KEY_PREFIX}/{namespace}/{team}"
+
+    def _get_running_key(self, team: str, namespace: str = DEFAULT_NAMESPACE) -> str:
+        return f"{self._get_team_key(team, namespace=namespace)}/running"
+
+    def _get_queue_key(
+        self, team: str, queue_key: str = "", namespace: str = DEFAULT_NAMESPACE
+    ) -> str:
+        return f"{self._get_team_key(team, namespace=namespace)}/pending/{queue_key}"
+
+    def _update_running(
+        self,
+        team: str,
+        update: Callable[[WorkflowAdmissionState], bool],
+        namespace: str = DEFAULT_NAMESPACE,
+    ) -> bool:
+        # The running records of a team are kept under one key, so admissions
+        #   from every router are checked against the limits atomically
+        running_key = self._get_running_key(team, namespace=namespace)
+        transactions = self.etcd_client.transactions
+        while True:
+            state_data, state_metadata = self.etcd_client.get(running_key)
+            if state_data:
+                state = deserialize_from_etcd(WorkflowAdmissionState, state_data)
+                compare = [transactions.mod(running_key) == state_metadata.mod_revision]
+            else:
+                state = WorkflowAdmissionState()
+                compare = [transactions.version(running_key) == 0]
+            if not update(state):
+                return False
+            succeeded, _ = self.etcd_client.transaction(
+                compare=compare,
+                success=[transactions.put(running_key, serialize(state))],
+                failure=[],
+            )
+            if succeeded:
+                return True
+            logger.debug(
+                "(admission) Running records of team %s changed, retrying", team
+            )
+
+    def try_admit(
+        self,
+        team: str,
+        workflow_name: str,
+        record_id: str,
+        workflow_limit: int = 0,
+        team_limit: int = 0,
+        namespace: str = DEFAULT_NAMESPACE,
+    ) -> bool:
+        # Returns whether the record is admitted (which it may already have been)
+        already_admitted = False
+
+        def update(state: WorkflowAdmissionState) -> bool:
+            nonlocal already_admitted
+            already_admitted = state.is_admitted(workflow_name, record_id)
+            if already_admitted or not state.can_admit(
+                workflow_name, workflow_limit, team_limit
+            ):
+                return False
+            state.admit(workflow_name, record_id)
+            return True
+
+        admitted = self._update_running(team, update, namespace=namespace)
+        return admitted or already_admitted
+
+    def release(
+        self,
+        team: str,
+        workflow_name: str,
+        record_id: str,
+        namespace: str = DEFAULT_NAMESPACE,
+    ) -> bool:
+        return self._update_running(
+            team,
+            lambda state: state.release(workflow_name, record_id),
+            namespace=namespace,
+        )
+
+    def enqueue(
+        self,
+        team: str,
+        pending_record: PendingWorkflowRecord,
+        namespace: str = DEFAULT_NAMESPACE,
+    ):
+        queue_key = self._get_queue_key(
+            team, pending_record.queue_key, namespace=namespace
+        )
+        self.etcd_client.put(queue_key, serialize(pending_record))
+        logger.debug(
+            "Queued WorkflowRecord %s / %s",
+            pending_record.workflow,
+            pending_record.record_id,
+        )
+
+    def dequeue(
+        self,
+        team: str,
+        pending_record: PendingWorkflowRecord,
+        namespace: str = DEFAULT_NAMESPACE,
+    ) -> bool:
+        queue_key = self._get_queue_key(
+            team, pending_record.queue_key, namespace=namespace
+        )
+        return self.etcd_client.delete(queue_key)
+
+    def list_pending(
+        self, team: str, namespace: str = DEFAULT_NAMESPACE
+    ) -> list[PendingWorkflowRecord]:
+        # Keys sort in queue order
+        queue_data = self.etcd_client.get_prefix(
+            self._get_queue_key(team, namespace=namespace)
+        )
+        return [
+            deserialize_from_etcd(PendingWorkflowRecord, data) for data, _ in queue_data
+        ]
+
+    def admit_pending(
+        self, team: str, namespace: str = DEFAULT_NAMESPACE
+    ) -> list[PendingWorkflowRecord]:
+        # Admits as many queued records as the limits allow, in queue order,
+        #   skipping any held back by the limit of their own workflow
+        pending_records = self.list_pending(team, namespace=namespace)
+        if not pending_records:
+            return []
+
+        admitted = []
+
+        def update(state: WorkflowAdmissionState) -> bool:
+            admitted.clear()
+            for pending_record in pending_records:
+                if state.can_admit(
+                    pending_record.workflow,
+                    pending_record.workflow_limit,
+                    pending_record.team_limit,
+                ):
+                    state.admit(pending_record.workflow, pending_record.record_id)
+                    admitted.append(pending_record)
+            return bool(admitted)
+
+        if not self._update_running(team, update, namespace=namespace):
+            return []
+        for pending_record in admitted:
+            self.dequeue(team, pending_record, namespace=namespace)
+        return admitted
+
+    def update_queue_status(
+        self, workflow_record: WorkflowRecord, namespace: str = DEFAULT_NAMESPACE
+    ) -> WorkflowRecord:
+        # Fills in the queue position and wait time of a record still waiting to run
+        admission = workflow_record.admission
+        if workflow_record.status != "pending":
+            return workflow_record
+        pending_records = self.list_pending(
+            workflow_record.spec.team, namespace=namespace
+        )
+        admission.queue_position = next(
+            (
+                i + 1
+                for i, pending_record in enumerate(pending_records)
+                if pending_record.record_id == workflow_record.id
+            ),
+            0,
+        )
+        admission.wait_time = time.time() - admission.queued_at
+        return workflow_record
@@ -10,6 +10,31 @@ SERVER_LOG = env.str("SERVER_LOG", "app.log")
 SERVER_LOG_LEVEL = getattr(logging, env.str("SERVER_LOG_LEVEL", "DEBUG"), "DEBUG")
 
 WORKSPACE_DIR = env.str("WORKSPACE_DIR", "/tmp/roster-workspace")
+# Waiting longer than this (seconds) for a repository's lock logs a warning
+WORKSPACE_LOCK_SLOW_WAIT = env.float("WORKSPACE_LOCK_SLOW_WAIT", 1.0)
+# Threads running blocking git operations, so they never stall the event loop
+WORKSPACE_GIT_WORKERS = env.int("WORKSPACE_GIT_WORKERS", 4)
+# Seconds before a git operation (clone, fetch, push etc.) is abandoned
+WORKSPACE_GIT_TIMEOUT = env.float("WORKSPACE_GIT_TIMEOUT", 300.0)
+# Partial clone filter for new clones (e.g. blob:none, tree:0), "" clones everything.
+#   Filtered clones download missing objects whenever they are checked out or read.
+WORKSPACE_CLONE_FILTER = env.str("WORKSPACE_CLONE_FILTER", "")
+# Transfers from origin slower than 1KB/s for this many seconds are abandoned,
+#   this also bounds downloads made by long-lived processes (e.g. file reads)
+WORKSPACE_GIT_STALL_TIMEOUT = env.int("WORKSPACE_GIT_STALL_TIMEOUT", 60)
+# Seconds after a fetch during which a branch is considered up to date
+WORKSPACE_FETCH_FRESHNESS = env.float("WORKSPACE_FETCH_FRESHNESS", 30.0)
+# Bytes of disk local clones may use before the least recently used are removed
+#   (0 disables eviction), checked every WORKSPACE_EVICTION_INTERVAL seconds
+WORKSPACE_DISK_BUDGET = env.int("WORKSPACE_DISK_BUDGET", 10 * 1024**3)
+WORKSPACE_EVICTION_INTERVAL = env.float("WORKSPACE_EVICTION_INTERVAL", 60.0)
+# Seconds between background fetches of repositories active within the window
+#   (0 disables them), codebase trees are cached for this many recent commits
+WORKSPACE_PREWARM_INTERVAL = env.float("WORKSPACE_PREWARM_INTERVAL", 300.0)
+WORKSPACE_PREWARM_ACTIVE_WINDOW = env.float("WORKSPACE_PREWARM_ACTIVE_WINDOW", 86400.0)
+WORKSPACE_CODEBASE_TREE_CACHE_SIZE = env.int("WORKSPACE_CODEBASE_TREE_CACHE_SIZE", 100)
+# Number of file contents (and path lookups) cached per repository for file reads
+WORKSPACE_BLOB_CACHE_SIZE = env.int("WORKSPACE_BLOB_CACHE_SIZE", 2000)
 
 PORT = env.int("PORT", 7888)
 
@@ -27,11 +52,39 @@ RABBITMQ_PASSWORD = env.str("RABBITMQ_PASSWORD", "guest")
 RABBITMQ_HOST = env.str("RABBITMQ_HOST", "localhost")
 RABBITMQ_PORT = env.int("RABBITMQ_PORT", 5672)
 RABBITMQ_VHOST = env.str("RABBITMQ_VHOST", "/")
+# Compression applied to message bodies above the threshold (bytes), "" disables
+# NOTE: only applies to queues consumed by the API itself (e.g. workflow routers)
+RABBITMQ_COMPRESSION = env.str("RABBITMQ_COMPRESSION", "zstd")
+RABBITMQ_COMPRESSION_THRESHOLD = env.int("RABBITMQ_COMPRESSION_THRESHOLD", 16384)
+
+# Workflow messages are partitioned by record ID across this many router queues
+WORKFLOW_ROUTER_SHARDS = env.int("WORKFLOW_ROUTER_SHARDS", 1)
+# Shards consumed by this process (empty means all shards)
+WORKFLOW_ROUTER_OWNED_SHARDS = env.list("WORKFLOW_ROUTER_OWNED_SHARDS", [], subcast=int)
+
+# Number of recently applied action reports remembered to drop duplicates cheaply
+WORKFLOW_REPORT_DEDUPE_WINDOW = env.int("WORKFLOW_REPORT_DEDUPE_WINDOW", 10000)
+# Number of active workflow records each router keeps in memory
+WORKFLOW_RECORD_CACHE_SIZE = env.int("WORKFLOW_RECORD_CACHE_SIZE", 1000)
+# Seconds to coalesce record changes before writing them to etcd
+#   (changes are always written before downstream steps are triggered)
+WORKFLOW_RECORD_FLUSH_DELAY = env.float("WORKFLOW_RECORD_FLUSH_DELAY", 0.05)
+# Resolution (seconds) of the timer wheel which tracks step timeouts
+STEP_TIMER_TICK = env.float("STEP_TIMER_TICK", 1.0)
+
+# Only the elected leader runs controllers (workflow router, workspace manager etc.)
+LEADER_ELECTION = env.bool("LEADER_ELECTION", False)
+LEADER_LEASE_TTL = env.int("LEADER_LEASE_TTL", 10)
 
 QDRANT_HOST = env.str("QDRANT_HOST", "localhost")
 QDRANT_PORT = env.int("QDRANT_PORT", 6333)
 
 GITHUB_APP_PRIVATE_KEY = env.str("GITHUB_APP_PRIVATE_KEY", "private_key.pem")
 GITHUB_APP_ID = env.int("GITHUB_APP_ID", 123456)
+# Webhook signatures (X-Hub-Signature-256) are verified with this secret, "" disables
 GITHUB_APP_WEBHOOK_SECRET = env.str("GITHUB_APP_WEBHOOK_SECRET", "turquoise")
+# Seconds a handled webhook delivery ID is remembered (in etcd) to drop redeliveries,
+#   the most recent GITHUB_WEBHOOK_DEDUPE_WINDOW are also remembered in memory
+GITHUB_WEBHOOK_DEDUPE_TTL = env.int("GITHUB_WEBHOOK_DEDUPE_TTL", 3 * 86400)
+GITHUB_WEBHOOK_DEDUPE_WINDOW = env.int("GITHUB_WEBHOOK_DEDUPE_WINDOW", 10000)
 GITHUB_APP_NAME = env.str("GITHUB_APP_NAME", "roster-ai")
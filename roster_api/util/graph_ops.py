@@ -1,4 +1,5 @@
 from graphlib import CycleError, TopologicalSorter
+from typing import Optional
 
 
 def sort_dependencies(graph: dict[str, set[str]]) -> list[str]:
@@ -7,3 +8,16 @@ def sort_dependencies(graph: dict[str, set[str]]) -> list[str]:
         return list(sorter.static_order())
     except CycleError as e:
         raise ValueError(f"Could not sort workflow steps. Cycle detected! {e.args[1]}")
+
+
+def reverse_dependencies(
+    graph: dict[str, set[str]], order: Optional[list[str]] = None
+) -> dict[str, list[str]]:
+    # Maps each node to the nodes which depend on it, following the given order
+    order = order or sort_dependencies(graph)
+    dependents = {node: [] for node in graph}
+    for node in order:
+        for dependency in graph.get(node, ()):
+            if dependency in dependents:
+                dependents[dependency].append(node)
+    return dependents
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Generic, Hashable, TypeVar
+
+from roster_api import constants
+
+logger = logging.getLogger(constants.LOGGER_NAME)
+
+K = TypeVar("K", bound=Hashable)
+
+
+@dataclass
+class LockWaitStats:
+    acquisitions: int = 0
+    contended: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    def record(self, wait: float, contended: bool):
+        self.acquisitions += 1
+        self.contended += int(contended)
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.acquisitions if self.acquisitions else 0.0
+
+
+class KeyedLock(Generic[K]):
+    # One asyncio.Lock per key, created on demand and dropped once nobody
+    #   holds or waits for it, so unrelated keys never block each other.
+    #   Stats for a key are dropped along with its lock, overall stats are kept.
+    def __init__(self, name: str = "keyed-lock", slow_wait: float = 1.0):
+        self.name = name
+        self.slow_wait = slow_wait
+        self.stats = LockWaitStats()
+        # Stats for the keys currently held or waited on
+        self.key_stats: dict[K, LockWaitStats] = {}
+        self._locks: dict[K, asyncio.Lock] = {}
+        self._users: dict[K, int] = {}
+
+    def locked(self, key: K) -> bool:
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    def in_use(self) -> set[K]:
+        # Keys which are currently held or waited on
+        return set(self._locks)
+
+    @asynccontextmanager
+    async def acquire(self, key: K) -> AsyncIterator[None]:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            contended = lock.locked()
+            started_at = time.perf_counter()
+            async with lock:
+                wait = time.perf_counter() - started_at
+                self._record_wait(key, wait, contended)
+                yield
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+                self.key_stats.pop(key, None)
+
+    def _record_wait(self, key: K, wait: float, contended: bool):
+        self.stats.record(wait, contended)
+        self.key_stats.setdefault(key, LockWaitStats()).record(wait, contended)
+        if wait >= self.slow_wait:
+            logger.warning("(%s) Waited %.2fs for lock on %s", self.name, wait, key)
+        elif contended:
+            logger.debug("(%s) Waited %.3fs for lock on %s", self.name, wait, key)
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+from typing import Generic, Hashable, Iterator, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._data: OrderedDict[K, V] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self._data)
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def put(self, key: K, value: V) -> list[tuple[K, V]]:
+        # Returns the entries evicted to make room, oldest first
+        self._data[key] = value
+        self._data.move_to_end(key)
+        evicted = []
+        while len(self._data) > self.capacity:
+            evicted.append(self._data.popitem(last=False))
+        return evicted
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        return self._data.pop(key, default)
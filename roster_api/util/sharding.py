@@ -0,0 +1,40 @@
+import hashlib
+
+from roster_api import settings
+from roster_api.constants import WORKFLOW_ROUTER_QUEUE
+
+
+def jump_consistent_hash(key: int, num_buckets: int) -> int:
+    # Lamping & Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm"
+    #   only ~1/n of keys move when the number of buckets changes from n-1 to n
+    bucket, next_bucket = -1, 0
+    while next_bucket < num_buckets:
+        bucket = next_bucket
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        next_bucket = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def get_shard(key: str, num_shards: int) -> int:
+    if num_shards <= 1:
+        return 0
+    # NOTE: must be stable across processes (and languages), so no builtin hash()
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return jump_consistent_hash(int.from_bytes(digest, "big"), num_shards)
+
+
+def get_workflow_router_queue(
+    shard: int, num_shards: int = settings.WORKFLOW_ROUTER_SHARDS
+) -> str:
+    # A single shard keeps the original queue name for compatibility
+    if num_shards <= 1:
+        return WORKFLOW_ROUTER_QUEUE
+    return f"{WORKFLOW_ROUTER_QUEUE}:shard-{shard}"
+
+
+def get_workflow_router_queue_for_record(
+    record_id: str, num_shards: int = settings.WORKFLOW_ROUTER_SHARDS
+) -> str:
+    return get_workflow_router_queue(
+        get_shard(record_id, num_shards), num_shards=num_shards
+    )
@@ -0,0 +1,91 @@
+import math
+from typing import Optional
+
+
+class HierarchicalTimerWheel:
+    # Timers are bucketed by deadline tick into levels of `slots` buckets,
+    #   where each level covers `slots` times the span of the level below.
+    #   Scheduling and cancelling are O(1), and advancing by a tick only touches
+    #   the buckets which are due (plus an occasional cascade from higher levels).
+    def __init__(
+        self,
+        tick: float = 1.0,
+        slots: int = 64,
+        levels: int = 4,
+        now: float = 0.0,
+    ):
+        self.tick = tick
+        self.slots = slots
+        self.levels: list[list[set[str]]] = [
+            [set() for _ in range(slots)] for _ in range(levels)
+        ]
+        self.current_tick = math.floor(now / tick)
+        self.deadlines: dict[str, float] = {}
+        self._locations: dict[str, tuple[int, int]] = {}
+        self._due: set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.deadlines
+
+    def schedule(self, key: str, deadline: float):
+        self.cancel(key)
+        self.deadlines[key] = deadline
+        self._place(key)
+
+    def cancel(self, key: str) -> Optional[float]:
+        deadline = self.deadlines.pop(key, None)
+        location = self._locations.pop(key, None)
+        if location is not None:
+            level, slot = location
+            self.levels[level][slot].discard(key)
+        self._due.discard(key)
+        return deadline
+
+    def advance(self, now: float) -> list[str]:
+        target_tick = math.floor(now / self.tick)
+        while self.current_tick < target_tick:
+            self.current_tick += 1
+            # Move timers down from higher levels when their bucket comes around
+            for level in range(len(self.levels) - 1, 0, -1):
+                span = self.slots**level
+                if self.current_tick % span == 0:
+                    slot = (self.current_tick // span) % self.slots
+                    cascading = self.levels[level][slot]
+                    self.levels[level][slot] = set()
+                    for key in cascading:
+                        self._place(key)
+            slot = self.current_tick % self.slots
+            expiring = self.levels[0][slot]
+            self.levels[0][slot] = set()
+            for key in expiring:
+                self._locations.pop(key, None)
+                self._due.add(key)
+
+        expired = sorted(self._due, key=self.deadlines.__getitem__)
+        self._due = set()
+        for key in expired:
+            self.deadlines.pop(key, None)
+        return expired
+
+    def _place(self, key: str):
+        target_tick = math.ceil(self.deadlines[key] / self.tick)
+        delay = target_tick - self.current_tick
+        if delay <= 0:
+            self._locations.pop(key, None)
+            self._due.add(key)
+            return
+
+        top_level = len(self.levels) - 1
+        for level in range(len(self.levels)):
+            if delay < self.slots ** (level + 1) or level == top_level:
+                break
+        if delay >= self.slots ** (level + 1):
+            # Beyond the range of the wheel, park it in the furthest bucket
+            #   and place it again once that bucket cascades
+            target_tick = self.current_tick + self.slots ** (level + 1) - 1
+        slot = (target_tick // self.slots**level) % self.slots
+        self.levels[level][slot].add(key)
+        self._locations[key] = (level, slot)
@@ -1,14 +1,75 @@
+import asyncio
+import functools
 import logging
-import subprocess
+import posixpath
+import threading
+from concurrent.futures import Executor
+from io import BytesIO
 from pathlib import Path, PurePath
 from shutil import rmtree
+from typing import Callable, Optional, TypeVar
 
-from roster_api import constants, settings
+from roster_api import constants, errors, settings
 
 import git
+from git.objects.fun import tree_entries_from_data, tree_to_stream
+from gitdb.base import IStream
+from gitdb.util import bin_to_hex
 
 logger = logging.getLogger(constants.LOGGER_NAME)
 
+T = TypeVar("T")
+
+CREDENTIAL_HELPER = (
+    '!f() { echo "username=$GIT_USERNAME"; echo "password=$GIT_PASSWORD"; }; f'
+)
+
+
+def _write_tree(
+    repo: git.Repo, tree_sha: Optional[bytes], files: dict[str, bytes]
+) -> bytes:
+    # Writes the tree (and any subtrees) with the given files replaced,
+    #   returning its binary SHA. Untouched subtrees are reused as they are,
+    #   so only the trees along the changed paths are read and written.
+    entries: dict[str, tuple[bytes, int]] = {}
+    if tree_sha is not None:
+        data = repo.odb.stream(tree_sha).read()
+        entries = {
+            name: (sha, mode) for sha, mode, name in tree_entries_from_data(data)
+        }
+
+    subtrees: dict[str, dict[str, bytes]] = {}
+    for path, content in files.items():
+        name, _, rest = path.partition("/")
+        if rest:
+            subtrees.setdefault(name, {})[rest] = content
+            continue
+        blob = repo.odb.store(IStream(git.Blob.type, len(content), BytesIO(content)))
+        # Existing files keep their mode (e.g. executable)
+        _, mode = entries.get(name, (None, git.Blob.file_mode))
+        if mode >> 12 == git.Tree.tree_id:
+            mode = git.Blob.file_mode
+        entries[name] = (blob.binsha, mode)
+    for name, subtree_files in subtrees.items():
+        sha, mode = entries.get(name, (None, 0))
+        subtree_sha = sha if mode >> 12 == git.Tree.tree_id else None
+        entries[name] = (
+            _write_tree(repo, subtree_sha, subtree_files),
+            git.Tree.tree_id << 12,
+        )
+
+    # Git orders tree entries by name, comparing trees as if they ended with '/'
+    ordered = sorted(
+        entries.items(),
+        key=lambda item: item[0] + "/"
+        if item[1][1] >> 12 == git.Tree.tree_id
+        else item[0],
+    )
+    stream = BytesIO()
+    tree_to_stream([(sha, mode, name) for name, (sha, mode) in ordered], stream.write)
+    data = stream.getvalue()
+    return repo.odb.store(IStream(git.Tree.type, len(data), BytesIO(data))).binsha
+
 
 class GitWorkspace:
     def __init__(
@@ -17,11 +78,15 @@ class GitWorkspace:
         username: str = "",
         password: str = "",
         token: str = "",
+        timeout: Optional[float] = None,
     ):
         self.root_dir = PurePath(root_dir)
         self.username = username
         self.password = password
         self.token = token
+        # Network commands (fetch, push) are killed after this many seconds
+        self.timeout = timeout
+        self.interrupted = threading.Event()
 
     @classmethod
     def build(
@@ -31,12 +96,14 @@ class GitWorkspace:
         username: str = "",
         password: str = "",
         token: str = "",
+        timeout: Optional[float] = None,
     ) -> "GitWorkspace":
         return cls(
             root_dir=f"{settings.WORKSPACE_DIR}/{installation_id}/{repository_name}",
             username=username,
             password=password,
             token=token,
+            timeout=timeout,
         )
 
     @classmethod
@@ -48,6 +115,7 @@ class GitWorkspace:
         username: str = "",
         password: str = "",
         token: str = "",
+        timeout: Optional[float] = None,
     ):
         workspace = cls.build(
             installation_id=installation_id,
@@ -55,45 +123,60 @@ class GitWorkspace:
             username=username,
             password=password,
             token=token,
+            timeout=timeout,
         )
         workspace.setup_repo(repo_url)
         return workspace
 
+    def interrupt(self):
+        # Called from another thread, the running operation stops before its next git command
+        self.interrupted.set()
+
+    def _check_interrupted(self):
+        if self.interrupted.is_set():
+            raise errors.WorkspaceInterruptedError(workspace=str(self.root_dir))
+
     @property
     def auth_env(self) -> dict[str, str]:
-        if self.token:
-            return {
-                "GIT_PASSWORD": self.token,
-            }
-
+        # Credentials are only passed through the environment of each git command,
+        #   with the credential helper configured by GIT_CONFIG_* (git >= 2.31).
+        #   Nothing is written to the global git config, so concurrent operations
+        #   with different credentials don't interfere and setup costs nothing.
+        #   Stalled transfers are abandoned even where a command has no timeout.
         return {
-            "GIT_PASSWORD": self.password,
+            "GIT_USERNAME": self.username or "x-access-token",
+            "GIT_PASSWORD": self.token or self.password,
+            "GIT_TERMINAL_PROMPT": "0",
+            "GIT_HTTP_LOW_SPEED_LIMIT": "1000",
+            "GIT_HTTP_LOW_SPEED_TIME": str(settings.WORKSPACE_GIT_STALL_TIMEOUT),
+            "GIT_CONFIG_COUNT": "2",
+            # An empty helper clears any helpers configured elsewhere
+            "GIT_CONFIG_KEY_0": "credential.helper",
+            "GIT_CONFIG_VALUE_0": "",
+            "GIT_CONFIG_KEY_1": "credential.helper",
+            "GIT_CONFIG_VALUE_1": CREDENTIAL_HELPER,
         }
 
-    def setup_credentials(self, repo_url: str):
-        subprocess.run(
-            [
-                "git",
-                "config",
-                "--global",
-                f"credential.{repo_url}.username",
-                self.username or "x-access-token",
-            ],
-            cwd=str(self.root_dir),
-        )
-        subprocess.run(
-            [
-                "git",
-                "config",
-                "--global",
-                "credential.helper",
-                '!f() { echo "password=$GIT_PASSWORD"; }; f',
-            ],
-            cwd=str(self.root_dir),
-        )
+    def open_repo(self) -> git.Repo:
+        # Every command run through the repo gets the credentials,
+        #   any of them may need to reach origin (e.g. to fill in a partial clone)
+        repo = git.Repo(str(self.root_dir))
+        repo.git.update_environment(**self.auth_env)
+        return repo
 
     def clone_repo(self, repo_url: str):
-        git.Repo.clone_from(repo_url, str(self.root_dir), env=self.auth_env)
+        # Only the default branch is cloned, other branches are fetched when needed.
+        #   With a filter (e.g. blob:none) file contents are only downloaded
+        #   when they are checked out or read, later fetches reuse the filter.
+        multi_options = ["--single-branch"]
+        if settings.WORKSPACE_CLONE_FILTER:
+            multi_options.append(f"--filter={settings.WORKSPACE_CLONE_FILTER}")
+        git.Repo.clone_from(
+            repo_url,
+            str(self.root_dir),
+            env=self.auth_env,
+            multi_options=multi_options,
+        )
 
     def clean_repo_dir(self, repo_dir: Path, repo_url: str) -> bool:
         # If the directory doesn't exist, create it
@@ -103,7 +186,7 @@ class GitWorkspace:
 
         # Verify current state of root_dir is OK if not empty
         try:
-            repo = git.Repo(str(self.root_dir))
+            repo = self.open_repo()
             if repo.remote().url != repo_url:
                 raise ValueError("Directory contains a different git repository.")
             # If we reach this point, the repo is OK
@@ -128,103 +211,211 @@ class GitWorkspace:
     def setup_repo(self, repo_url: str):
         repo_dir = Path(self.root_dir)
         repo_exists = self.clean_repo_dir(repo_dir, repo_url)
-        self.setup_credentials(repo_url)
         if not repo_exists:
+            self._check_interrupted()
             self.clone_repo(repo_url)
 
-    def force_to_latest(self, branch: str = "main"):
-        repo = git.Repo(str(self.root_dir))
+    def fetch_branch(self, branch: str = "main", missing_ok: bool = False) -> bool:
+        # Returns whether the branch was fetched, i.e. whether it exists on origin
+        self._check_interrupted()
+        repo = self.open_repo()
 
-        # Fetch latest HEAD for origin/main
+        # Only the requested branch is fetched
         try:
             origin = repo.remote(name="origin")
-            origin.fetch(env=self.auth_env)
+            origin.fetch(
+                f"+refs/heads/{branch}:refs/remotes/origin/{branch}",
+                kill_after_timeout=self.timeout,
+            )
         except git.exc.GitCommandError as e:
+            if missing_ok and "couldn't find remote ref" in str(e.stderr):
+                return False
             raise ValueError("Failed to fetch latest changes from origin.") from e
+        return True
+
+    def fetch_branch_unless_local(self, branch: str) -> bool:
+        # After a (re-)clone only the default branch exists locally,
+        #   a branch with earlier commits on origin is fetched so new commits build on them
+        repo = self.open_repo()
+        if branch in repo.heads:
+            return True
+        return self.fetch_branch(branch, missing_ok=True)
+
+    def force_to_latest(self, branch: str = "main", fetch: bool = True):
+        if fetch:
+            self.fetch_branch(branch)
+        self._check_interrupted()
+        repo = self.open_repo()
 
         # Forcefully remove all dirty state
-        repo.git.reset("--hard", "HEAD")
+        self._check_interrupted()
+        # With a partial clone, checkouts download the files they are missing
+        repo.git.reset("--hard", "HEAD", kill_after_timeout=self.timeout)
         repo.git.clean("-fd")
         logger.debug("(git-workspace) Removed all dirty git status from repo")
 
         # Switch to the branch and reset to latest origin
+        self._check_interrupted()
         try:
-            repo.git.checkout(branch)
-            repo.git.reset("--hard", f"origin/{branch}")
+            # Branches other than the cloned one aren't in the fetch refspec,
+            #   so the local branch is (re)created from origin explicitly
+            repo.git.checkout(
+                "-B", branch, f"origin/{branch}", kill_after_timeout=self.timeout
+            )
             logger.info("(git-workspace) Checked out latest origin/%s", branch)
         except git.exc.GitCommandError as e:
             raise ValueError(f"Failed to update to latest origin/{branch}: {e}") from e
 
-    def open(self, file: str, mode: str = "r", **kwargs):
-        relative_file = PurePath(self.root_dir) / file
-        return open(str(relative_file), mode=mode, **kwargs)
+    def get_current_head_sha(self) -> str:
+        repo = self.open_repo()
+        return repo.head.commit.hexsha
 
-    def create_branch(self, branch: str):
-        repo = git.Repo(str(self.root_dir))
+    def commit_files(
+        self, branch: str, files: dict[str, str], commit_msg: str, base_sha: str
+    ) -> str:
+        # Builds a commit straight in the object database, without touching a
+        #   working tree: blobs for the files, trees from the parent's tree with
+        #   those files replaced, then the commit, which the branch is moved to.
+        #   The branch continues from its local (or fetched) tip, or starts at base_sha.
+        self._check_interrupted()
+        contents = {}
+        for filepath, content in files.items():
+            path = posixpath.normpath(filepath).lstrip("/")
+            # Every file must be somewhere inside the repository
+            if path in ("", ".", "..") or path.startswith("../"):
+                raise errors.WorkspaceError(
+                    f"Invalid file path: {filepath!r}", workspace=str(self.root_dir)
+                )
+            contents[path] = content.encode("utf-8")
+        repo = self.open_repo()
+        ref = f"refs/heads/{branch}"
+        try:
+            parent = repo.commit(ref)
+            old_sha = parent.hexsha
+        except (git.exc.BadName, ValueError):
+            try:
+                parent = repo.commit(f"refs/remotes/origin/{branch}")
+            except (git.exc.BadName, ValueError):
+                parent = repo.commit(base_sha)
+            # The branch must not have been created in the meantime
+            old_sha = "0" * 40
+
+        tree = _write_tree(repo, parent.tree.binsha, contents)
+        commit = git.Commit.create_from_tree(
+            repo,
+            bin_to_hex(tree).decode("ascii"),
+            commit_msg,
+            parent_commits=[parent],
+            head=False,
+        )
 
         try:
-            return repo.create_head(branch)
+            # Only moves the branch if nothing else moved it since it was read
+            repo.git.update_ref(ref, commit.hexsha, old_sha)
         except git.exc.GitCommandError as e:
-            raise ValueError(f"Failed to create branch {branch}.") from e
-
-    def checkout_branch(self, branch: str):
-        repo = git.Repo(str(self.root_dir))
-
+            raise ValueError(f"Failed to update branch {branch}: {e}") from e
+        logger.debug("(git-workspace) Committed %s to %s", commit.hexsha, branch)
+        return commit.hexsha
+
+    def push_branch(self, branch: str, force: bool = False):
+        self._check_interrupted()
+        repo = self.open_repo()
+        ref = f"refs/heads/{branch}"
         try:
-            # Try to checkout the branch
-            repo.git.checkout(branch)
-        except git.exc.GitCommandError:
-            self.create_branch(branch)
-            repo.git.checkout(branch)
+            repo.git.push(
+                "--force" if force else "--no-force",
+                "origin",
+                f"{ref}:{ref}",
+                kill_after_timeout=self.timeout,
+            )
+        except git.GitCommandError as e:
+            raise ValueError(f"Push operation failed for branch {branch}.") from e
+
+
+# NOTE: a thread running git can't be killed, so when an operation times out or
+#   the awaiting task is cancelled, the workspace is interrupted (it stops before
+#   its next git command) and the caller waits for the thread to finish before
+#   unwinding. Locks held by the caller therefore still cover the working tree.
+class AsyncGitWorkspace:
+    def __init__(
+        self,
+        workspace: GitWorkspace,
+        executor: Executor,
+        timeout: Optional[float] = settings.WORKSPACE_GIT_TIMEOUT,
+    ):
+        self.workspace = workspace
+        self.executor = executor
+        self.timeout = timeout
 
-        repo.git.reset("--hard", "HEAD")
-        repo.git.clean("-fd")
+    @classmethod
+    async def setup(
+        cls,
+        executor: Executor,
+        installation_id: int,
+        repository_name: str,
+        repo_url: str,
+        token: str = "",
+        timeout: Optional[float] = settings.WORKSPACE_GIT_TIMEOUT,
+    ) -> "AsyncGitWorkspace":
+        workspace = GitWorkspace.build(
+            installation_id=installation_id,
+            repository_name=repository_name,
+            token=token,
+            timeout=timeout,
+        )
+        async_workspace = cls(workspace, executor=executor, timeout=timeout)
+        await async_workspace.run(workspace.setup_repo, repo_url)
+        return async_workspace
 
-    def checkout_sha(self, sha: str):
-        repo = git.Repo(str(self.root_dir))
+    @property
+    def root_dir(self) -> PurePath:
+        return self.workspace.root_dir
 
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.executor, functools.partial(self._call, func, *args, **kwargs)
+        )
         try:
-            repo.git.checkout(sha)
-        except git.exc.GitCommandError as e:
-            raise ValueError(f"Failed to checkout SHA {sha}.") from e
-
-    def get_current_head_sha(self) -> str:
-        repo = git.Repo(str(self.root_dir))
-        return repo.head.commit.hexsha
-
-    def commit(self, commit_msg: str):
-        repo = git.Repo(str(self.root_dir))
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            await self._interrupt(future)
+            raise errors.WorkspaceTimeoutError(
+                f"Git operation timed out after {self.timeout}s.",
+                workspace=str(self.root_dir),
+            )
+        except asyncio.CancelledError:
+            await self._interrupt(future)
+            raise
+
+    def _call(self, func: Callable[..., T], *args, **kwargs) -> T:
+        # Work still queued when the workspace was interrupted never starts
+        self.workspace._check_interrupted()
+        return func(*args, **kwargs)
+
+    async def _interrupt(self, future: asyncio.Future):
+        self.workspace.interrupt()
+        try:
+            await asyncio.shield(future)
+        except Exception:
+            pass
+        logger.warning("(git-workspace) Interrupted git operation in %s", self.root_dir)
 
-        # Stage all changes
-        repo.git.add(A=True)
+    async def force_to_latest(self, branch: str = "main", fetch: bool = True):
+        await self.run(self.workspace.force_to_latest, branch, fetch)
 
-        # Commit
-        repo.index.commit(commit_msg)
+    async def fetch_branch_unless_local(self, branch: str) -> bool:
+        return await self.run(self.workspace.fetch_branch_unless_local, branch)
 
-    def push(self, force: bool = False):
-        repo = git.Repo(str(self.root_dir))
-        if "origin" in [remote.name for remote in repo.remotes]:
-            origin = repo.remotes.origin
-        else:
-            raise ValueError("No remote named 'origin' found.")
+    async def get_current_head_sha(self) -> str:
+        return await self.run(self.workspace.get_current_head_sha)
 
-        # Get the current branch name
-        current_branch = repo.active_branch.name
-        logger.debug("(git-workspace) About to push from branch: %s", current_branch)
+    async def commit_files(
+        self, branch: str, files: dict[str, str], commit_msg: str, base_sha: str
+    ) -> str:
+        return await self.run(
+            self.workspace.commit_files, branch, files, commit_msg, base_sha
+        )
 
-        # Check if current branch is tracking an upstream branch
-        if repo.active_branch.tracking_branch() is None:
-            try:
-                # Set upstream branch and push
-                repo.git.push(
-                    "--set-upstream", "origin", current_branch, env=self.auth_env
-                )
-            except git.GitCommandError as e:
-                raise ValueError("Push operation failed while setting upstream.") from e
-        else:
-            try:
-                push_option = "--force" if force else ""
-                # Perform the push
-                origin.push(push_option, env=self.auth_env)
-            except git.GitCommandError as e:
-                raise ValueError("Push operation failed.") from e
+    async def push_branch(self, branch: str, force: bool = False):
+        await self.run(self.workspace.push_branch, branch, force)
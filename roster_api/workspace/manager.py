@@ -1,70 +1,285 @@
 import asyncio
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import PurePath
 from typing import Optional
 
 import pydantic
-from roster_api import constants
+from roster_api import constants, errors, settings
 from roster_api.github.codebase_tools.tree import build_codebase_tree
 from roster_api.github.service import GithubService
 from roster_api.messaging.inbox import AgentInbox
-from roster_api.messaging.rabbitmq import RabbitMQClient, get_rabbitmq
+from roster_api.messaging.rabbitmq import RabbitMQClient, get_rabbitmq, loads_json
 from roster_api.models.tool import ToolMessage
+from roster_api.models.workflow import WorkflowRecord
 from roster_api.models.workspace import WorkflowCodeReportPayload, WorkspaceMessage
 from roster_api.services.workflow import WorkflowRecordService
 from roster_api.services.workspace import WorkspaceService
+from roster_api.util.keyed_lock import KeyedLock
+from roster_api.util.lru import LRUCache
 
-from .git import GitWorkspace
+from .git import AsyncGitWorkspace, GitWorkspace
+from .objects import GitObjectReader, GitObjectReaders
+from .pool import RepoKey, WorkspacePool
 
 logger = logging.getLogger(constants.LOGGER_NAME)
 
 
+@dataclass
+class WorkspaceSnapshot:
+    # The latest commit on main and the codebase tree built from that same commit
+    base_hash: str
+    codebase_tree: str
+
+
 class WorkspaceManager:
     def __init__(self, rmq_client: Optional[RabbitMQClient] = None):
         self.rmq = rmq_client or get_rabbitmq()
-        self._fs_lock = asyncio.Lock()
+        # Git operations are serialized per checkout, keyed by
+        #   (installation, repository) for the shared clone and
+        #   (installation, repository, branch) for updates to a branch,
+        #   so work on one repository or workspace never waits for another
+        self.repo_locks: KeyedLock[tuple] = KeyedLock(
+            name="workspace-mgr", slow_wait=settings.WORKSPACE_LOCK_SLOW_WAIT
+        )
+        # Bounds the number of git operations running at once across all repositories
+        self.git_executor = self._build_git_executor()
+        self.object_readers = GitObjectReaders()
+        # When each (installation, repository, branch) was last fetched
+        self.fetched_at: dict[tuple[int, str, str], float] = {}
+        self.workspace_pool = WorkspacePool(on_evict=self._forget_repo)
+        self._eviction_task: Optional[asyncio.Task] = None
+        # Snapshots being prepared, shared by everyone who asks for the same repository
+        self._snapshot_tasks: dict[RepoKey, asyncio.Task] = {}
+        self.codebase_trees: LRUCache[tuple[int, str, str], str] = LRUCache(
+            settings.WORKSPACE_CODEBASE_TREE_CACHE_SIZE
+        )
+        # When each repository was last prepared, active ones are kept fetched
+        self.active_repos: dict[RepoKey, float] = {}
+        self._prewarm_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _build_git_executor() -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=settings.WORKSPACE_GIT_WORKERS,
+            thread_name_prefix="git-workspace",
+        )
 
     async def setup(self):
         await self.rmq.register_callback(
             constants.WORKSPACE_QUEUE, self._handle_incoming_message
         )
+        if settings.WORKSPACE_DISK_BUDGET:
+            await asyncio.get_running_loop().run_in_executor(
+                self.git_executor, self.workspace_pool.scan
+            )
+            self._eviction_task = asyncio.create_task(self._run_eviction())
+        if settings.WORKSPACE_PREWARM_INTERVAL:
+            self._prewarm_task = asyncio.create_task(self._run_prewarm())
 
     async def teardown(self):
         await self.rmq.deregister_callback(
             constants.WORKSPACE_QUEUE, self._handle_incoming_message
         )
+        for task in (self._eviction_task, self._prewarm_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._eviction_task = None
+        self._prewarm_task = None
+        # Threads and cat-file processes are released, the fresh (idle) ones left
+        #   in their place let the manager be set up again, e.g. on re-election
+        self.git_executor.shutdown(wait=False, cancel_futures=True)
+        self.git_executor = self._build_git_executor()
+        self.object_readers.close()
 
-    async def build_codebase_tree(self, github_service: GithubService) -> str:
-        async with self._fs_lock:
-            git_workspace = GitWorkspace.setup(
-                installation_id=github_service.installation_id,
-                repository_name=github_service.repository_name,
-                repo_url=github_service.get_repo_url(),
-                token=github_service.get_installation_token(),
-            )
-            git_workspace.force_to_latest()
-            return build_codebase_tree(git_workspace.root_dir)
-
-    async def get_base_hash(
-        self, github_service: GithubService, branch: str = "main"
-    ) -> str:
-        async with self._fs_lock:
-            git_workspace = GitWorkspace.setup(
-                installation_id=github_service.installation_id,
-                repository_name=github_service.repository_name,
-                repo_url=github_service.get_repo_url(),
-                token=github_service.get_installation_token(),
-            )
-            git_workspace.force_to_latest()
-            if branch != "main":
-                # TODO: should have a way to pull local branch up to origin if it exists
-                #   (internal to GitWorkspace)
-                git_workspace.checkout_branch(branch=branch)
-            return git_workspace.get_current_head_sha()
-
-    async def _handle_incoming_message(self, message: str):
+    async def _run_eviction(self):
+        while True:
+            await asyncio.sleep(settings.WORKSPACE_EVICTION_INTERVAL)
+            try:
+                await self.workspace_pool.enforce_budget(self.git_executor)
+            except Exception as e:
+                logger.error("(workspace-mgr) Failed to evict workspaces: %s", e)
+
+    async def _run_prewarm(self):
+        # Keeps the clones of recently active repositories fetched,
+        #   so preparing a workspace for them rarely waits on the network
+        while True:
+            await asyncio.sleep(settings.WORKSPACE_PREWARM_INTERVAL)
+            cutoff = time.time() - settings.WORKSPACE_PREWARM_ACTIVE_WINDOW
+            for key, last_active in list(self.active_repos.items()):
+                if last_active < cutoff:
+                    del self.active_repos[key]
+                    continue
+                if key not in self.workspace_pool.repos:
+                    # Evicted (or never cloned), don't bring it back just to keep it warm
+                    continue
+                installation_id, repository_name = key
+                try:
+                    await self._fetch_latest(
+                        GithubService(
+                            installation_id=installation_id,
+                            repository_name=repository_name,
+                        )
+                    )
+                except Exception as e:
+                    logger.warning(
+                        "(workspace-mgr) Failed to pre-warm %s: %s", repository_name, e
+                    )
+
+    async def _fetch_latest(self, github_service: GithubService):
+        async with self._use_repo(github_service):
+            async with self._repo_lock(github_service):
+                git_workspace = await self._setup_git_workspace(github_service)
+                await self._force_to_latest(github_service, git_workspace)
+
+    def _forget_repo(self, key: RepoKey, root_dir: PurePath):
+        # Called just before an evicted repository is removed from disk
+        self.object_readers.discard(root_dir)
+        for fetched_key in [k for k in self.fetched_at if k[:2] == key]:
+            del self.fetched_at[fetched_key]
+
+    def _use_repo(self, github_service: GithubService):
+        # Held for the whole of every operation on a repository's clone,
+        #   so the repository can't be evicted from under it
+        root_dir = GitWorkspace.build(
+            installation_id=github_service.installation_id,
+            repository_name=github_service.repository_name,
+        ).root_dir
+        return self.workspace_pool.use(
+            (github_service.installation_id, github_service.repository_name),
+            root_dir,
+        )
+
+    def _repo_lock(self, github_service: GithubService):
+        return self.repo_locks.acquire(
+            (github_service.installation_id, github_service.repository_name)
+        )
+
+    def _branch_lock(self, github_service: GithubService, branch: str):
+        return self.repo_locks.acquire(
+            (github_service.installation_id, github_service.repository_name, branch)
+        )
+
+    async def _setup_git_workspace(
+        self, github_service: GithubService
+    ) -> AsyncGitWorkspace:
+        # Looking up the repo URL and token also makes blocking calls to Github
+        loop = asyncio.get_running_loop()
+        repo_url, token = await loop.run_in_executor(
+            self.git_executor,
+            lambda: (
+                github_service.get_repo_url(),
+                github_service.get_installation_token(),
+            ),
+        )
+        return await AsyncGitWorkspace.setup(
+            executor=self.git_executor,
+            installation_id=github_service.installation_id,
+            repository_name=github_service.repository_name,
+            repo_url=repo_url,
+            token=token,
+        )
+
+    async def _force_to_latest(
+        self,
+        github_service: GithubService,
+        git_workspace: AsyncGitWorkspace,
+        branch: str = "main",
+    ):
+        # Branches fetched within the freshness window are only reset,
+        #   so operations called back to back share a single fetch
+        key = (github_service.installation_id, github_service.repository_name, branch)
+        fetched_at = self.fetched_at.get(key)
+        fetch = (
+            fetched_at is None
+            or time.monotonic() - fetched_at >= settings.WORKSPACE_FETCH_FRESHNESS
+        )
+        await git_workspace.force_to_latest(branch, fetch=fetch)
+        if fetch:
+            self.fetched_at[key] = time.monotonic()
+
+    async def _get_object_reader(
+        self, github_service: GithubService
+    ) -> GitObjectReader:
+        loop = asyncio.get_running_loop()
+        # Reads from a partial clone may download objects, which needs a current token
+        token = await loop.run_in_executor(
+            self.git_executor, github_service.get_installation_token
+        )
+        git_workspace = GitWorkspace.build(
+            installation_id=github_service.installation_id,
+            repository_name=github_service.repository_name,
+            token=token,
+        )
+        if git_workspace.root_dir not in self.object_readers.readers:
+            # The repository needs to be cloned before its objects can be read
+            async with self._repo_lock(github_service):
+                await self._setup_git_workspace(github_service)
+        return await loop.run_in_executor(
+            self.git_executor,
+            self.object_readers.get,
+            git_workspace.root_dir,
+            git_workspace.auth_env,
+        )
+
+    def prewarm(self, github_service: GithubService) -> asyncio.Task:
+        # Starts preparing a snapshot of main (one fetch for both the base hash
+        #   and the codebase tree) and returns the task, which callers share.
+        #   Await it with asyncio.shield so a cancelled caller doesn't cancel it for others.
+        key = (github_service.installation_id, github_service.repository_name)
+        self.active_repos[key] = time.time()
+        task = self._snapshot_tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(self._build_snapshot(github_service))
+            self._snapshot_tasks[key] = task
+
+            def _done(done_task: asyncio.Task):
+                if self._snapshot_tasks.get(key) is done_task:
+                    del self._snapshot_tasks[key]
+                if not done_task.cancelled() and done_task.exception() is not None:
+                    logger.debug(
+                        "(workspace-mgr) Failed to pre-warm %s: %s",
+                        key,
+                        done_task.exception(),
+                    )
+
+            task.add_done_callback(_done)
+        return task
+
+    async def get_snapshot(self, github_service: GithubService) -> WorkspaceSnapshot:
+        return await asyncio.shield(self.prewarm(github_service))
+
+    async def _build_snapshot(self, github_service: GithubService) -> WorkspaceSnapshot:
+        async with self._use_repo(github_service):
+            async with self._repo_lock(github_service):
+                git_workspace = await self._setup_git_workspace(github_service)
+                await self._force_to_latest(github_service, git_workspace)
+                base_hash = await git_workspace.get_current_head_sha()
+                # Trees are cached by commit, main often hasn't moved between issues
+                tree_key = (
+                    github_service.installation_id,
+                    github_service.repository_name,
+                    base_hash,
+                )
+                codebase_tree = self.codebase_trees.get(tree_key)
+                if codebase_tree is None:
+                    codebase_tree = await git_workspace.run(
+                        build_codebase_tree, str(git_workspace.root_dir)
+                    )
+                    self.codebase_trees.put(tree_key, codebase_tree)
+        return WorkspaceSnapshot(base_hash=base_hash, codebase_tree=codebase_tree)
+
+    async def _handle_incoming_message(self, message: bytes):
         try:
-            message_data = json.loads(message)
+            message_data = loads_json(message)
         except json.JSONDecodeError as e:
             logger.error("(workspace-mgr) Failed to decode message: %s", e)
             return
@@ -113,33 +328,33 @@ class WorkspaceManager:
             repository_name=github_info.repository_name,
         )
 
-        async with self._fs_lock:
-            git_workspace = GitWorkspace.setup(
-                installation_id=github_service.installation_id,
-                repository_name=github_service.repository_name,
-                repo_url=github_service.get_repo_url(),
-                token=github_service.get_installation_token(),
-            )
-            git_workspace.force_to_latest()
-            # TODO: should have a way to pull local branch up to origin if it exists
-            #   (internal to GitWorkspace)
-            git_workspace.checkout_branch(github_info.branch_name)
-
-            for code_output in message_payload.code_outputs:
-                with git_workspace.open(code_output.filepath, "w") as f:
-                    # TODO: support other code_output kinds
-                    f.write(code_output.content)
-
-            git_workspace.commit(
-                f"Committing changes from workflow {message_payload.workflow_name} ({message_payload.workflow_record})"
-            )
-            git_workspace.push()
+        # The commit is built in the object database on top of the base commit,
+        #   so only updates to the branch itself need to be serialized
+        async with self._use_repo(github_service):
+            async with self._repo_lock(github_service):
+                git_workspace = await self._setup_git_workspace(github_service)
+                await git_workspace.fetch_branch_unless_local(github_info.branch_name)
+            async with self._branch_lock(github_service, github_info.branch_name):
+                # TODO: support other code_output kinds
+                await git_workspace.commit_files(
+                    branch=github_info.branch_name,
+                    files={
+                        code_output.filepath: code_output.content
+                        for code_output in message_payload.code_outputs
+                    },
+                    commit_msg=f"Committing changes from workflow {message_payload.workflow_name} ({message_payload.workflow_record})",
+                    base_sha=github_info.base_hash,
+                )
+                await git_workspace.push_branch(github_info.branch_name)
 
         # TODO: send better metadata for PRs, commit messages through message payload
-        pr_url = github_service.create_pull_request(
-            title=f"[roster-ai] {message_payload.workflow_name} ({message_payload.workflow_record})",
-            body="This Pull Request was generated by Roster! :star:",
-            head=github_info.branch_name,
+        pr_url = await asyncio.get_running_loop().run_in_executor(
+            self.git_executor,
+            lambda: github_service.create_pull_request(
+                title=f"[roster-ai] {message_payload.workflow_name} ({message_payload.workflow_record})",
+                body="This Pull Request was generated by Roster! :star:",
+                head=github_info.branch_name,
+            ),
         )
         logger.info("Created PR for %s: %s", github_info.repository_name, pr_url)
 
@@ -153,9 +368,18 @@ class WorkspaceManager:
         agent_inbox = AgentInbox(
             name=message.sender.name, namespace=message.sender.namespace
         )
+        # The invoking workflow's record is read once, for the priority and the tool
+        workflow_record = self._get_workflow_record(message=message)
+        priority = (
+            workflow_record.spec.priorities.tool_response
+            if workflow_record is not None
+            else constants.DEFAULT_TOOL_RESPONSE_PRIORITY
+        )
         try:
             if message.tool == "workspace-file-reader":
-                result = await self._tool_workspace_file_reader(message=message)
+                result = await self._tool_workspace_file_reader(
+                    message=message, workflow_record=workflow_record
+                )
             else:
                 logger.debug(
                     "(workspace-mgr) Unknown tool for WorkspaceManager: %s",
@@ -167,29 +391,43 @@ class WorkspaceManager:
                 invocation_id=message.id,
                 tool=message.tool,
                 error=f"Failed to run tool: {e}",
+                priority=priority,
             )
         else:
             await agent_inbox.send_tool_response(
-                invocation_id=message.id, tool=message.tool, data=result
+                invocation_id=message.id,
+                tool=message.tool,
+                data=result,
+                priority=priority,
             )
 
-    async def _tool_workspace_file_reader(self, message: ToolMessage) -> dict:
+    @staticmethod
+    def _get_workflow_record(message: ToolMessage) -> Optional[WorkflowRecord]:
+        # Tool messages name the invoking workflow record in their inputs, if any
+        try:
+            inputs = message.data["inputs"]
+            return WorkflowRecordService().get_workflow_record(
+                record_id=inputs["record_id"], workflow_name=inputs["workflow"]
+            )
+        except (KeyError, TypeError, errors.RosterAPIError) as e:
+            logger.debug("(workspace-mgr) No workflow record for tool message: %s", e)
+            return None
+
+    async def _tool_workspace_file_reader(
+        self, message: ToolMessage, workflow_record: Optional[WorkflowRecord]
+    ) -> dict:
         # NOTE: input format is data={inputs: {record_id: ..., workflow: ..., filepaths: ...}}
         #   and output format is data={files: [{filename: ..., text: ..., metadata: ...}, ...]}
         try:
-            inputs = message.data["inputs"]
-            record_id = inputs["record_id"]
-            workflow = inputs["workflow"]
-            filepaths = inputs["filepaths"]
+            filepaths = message.data["inputs"]["filepaths"]
         except KeyError as e:
             logger.debug(
                 "(workspace-mgr) Missing key in workspace file reader message: %s", e
             )
             raise KeyError("Missing key in workspace file reader message")
 
-        workflow_record = WorkflowRecordService().get_workflow_record(
-            record_id=record_id, workflow_name=workflow
-        )
+        if workflow_record is None:
+            raise ValueError("No workflow record found for tool invocation")
         if not workflow_record.workspace:
             logger.debug(
                 "(workspace-mgr) Workflow record %s has no workspace", workflow_record
@@ -210,17 +448,20 @@ class WorkspaceManager:
             installation_id=github_info.installation_id,
             repository_name=github_info.repository_name,
         )
-        output_files = []
-        async with self._fs_lock:
-            git_workspace = GitWorkspace.setup(
-                installation_id=github_service.installation_id,
-                repository_name=github_service.repository_name,
-                repo_url=github_service.get_repo_url(),
-                token=github_service.get_installation_token(),
+        # Files are read from the object database at the base commit,
+        #   so no checkout (or lock) is needed
+        async with self._use_repo(github_service):
+            object_reader = await self._get_object_reader(github_service)
+            file_contents = await asyncio.get_running_loop().run_in_executor(
+                self.git_executor,
+                object_reader.read_files,
+                github_info.base_hash,
+                filepaths,
             )
-            git_workspace.checkout_sha(github_info.base_hash)
-            for filepath in filepaths:
-                with git_workspace.open(filepath, "r") as f:
-                    output_files.append({"filename": filepath, "text": f.read()})
 
-        return {"files": output_files}
+        return {
+            "files": [
+                {"filename": filepath, "text": text}
+                for filepath, text in file_contents.items()
+            ]
+        }
@@ -0,0 +1,116 @@
+import logging
+import posixpath
+import re
+import threading
+from pathlib import PurePath
+from typing import Optional
+
+from roster_api import constants, settings
+from roster_api.util.lru import LRUCache
+
+import git
+
+logger = logging.getLogger(constants.LOGGER_NAME)
+
+COMMIT_SHA_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+
+
+# NOTE: reads go straight to the object database through the persistent
+#   `git cat-file --batch` process GitPython keeps for the repo, so they never
+#   touch a working tree and don't need the repository's lock.
+#   Objects are immutable, so cached content never goes stale.
+#   With a partial clone the process downloads missing objects from origin,
+#   using the credentials in env.
+class GitObjectReader:
+    def __init__(
+        self,
+        root_dir: str,
+        env: Optional[dict[str, str]] = None,
+        cache_size: int = settings.WORKSPACE_BLOB_CACHE_SIZE,
+    ):
+        self.root_dir = PurePath(root_dir)
+        self.repo = git.Repo(str(self.root_dir))
+        self.env = env or {}
+        self.repo.git.update_environment(**self.env)
+        # (commit SHA, path) -> blob SHA, and blob SHA -> text
+        #   so unchanged files are shared between commits
+        self.paths: LRUCache[tuple[str, str], str] = LRUCache(cache_size)
+        self.blobs: LRUCache[str, str] = LRUCache(cache_size)
+        # The cat-file process serves one request at a time
+        self._lock = threading.Lock()
+
+    def set_env(self, env: dict[str, str]):
+        # The cat-file process keeps the environment it was started with,
+        #   so it is restarted to pick up new credentials
+        with self._lock:
+            if env == self.env:
+                return
+            self.env = env
+            self.repo.git.update_environment(**env)
+            self.repo.git.clear_cache()
+
+    def read_files(self, sha: str, filepaths: list[str]) -> dict[str, str]:
+        with self._lock:
+            return {filepath: self._read_file(sha, filepath) for filepath in filepaths}
+
+    def _read_file(self, sha: str, filepath: str) -> str:
+        path = posixpath.normpath(filepath).lstrip("/")
+        blob_sha = self.paths.get((sha, path))
+        text = self.blobs.get(blob_sha) if blob_sha is not None else None
+        if text is not None:
+            return text
+
+        try:
+            blob_sha, kind, _, data = self.repo.git.get_object_data(f"{sha}:{path}")
+        except ValueError as e:
+            raise FileNotFoundError(f"{filepath} not found at {sha}") from e
+        # GitPython returns the header fields as bytes
+        blob_sha, kind = blob_sha.decode("ascii"), kind.decode("ascii")
+        if kind != "blob":
+            raise IsADirectoryError(f"{filepath} is a {kind} at {sha}, not a file")
+
+        text = data.decode("utf-8", errors="replace")
+        if COMMIT_SHA_PATTERN.match(sha):
+            # Branch names and other refs can move, so only SHAs are remembered
+            self.paths.put((sha, path), blob_sha)
+        self.blobs.put(blob_sha, text)
+        return text
+
+    def close(self):
+        # Stops the persistent cat-file processes
+        with self._lock:
+            self.repo.close()
+
+
+class GitObjectReaders:
+    # One reader per clone, shared by every workspace of the repository
+    def __init__(self):
+        self.readers: dict[PurePath, GitObjectReader] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self, root_dir: PurePath, env: Optional[dict[str, str]] = None
+    ) -> GitObjectReader:
+        with self._lock:
+            reader = self.readers.get(root_dir)
+            if reader is None:
+                reader = self.readers[root_dir] = GitObjectReader(
+                    str(root_dir), env=env
+                )
+                return reader
+        if env is not None:
+            reader.set_env(env)
+        return reader
+
+    def discard(self, root_dir: PurePath) -> Optional[GitObjectReader]:
+        with self._lock:
+            reader = self.readers.pop(root_dir, None)
+        if reader is not None:
+            reader.close()
+        return reader
+
+    def close(self):
+        with self._lock:
+            readers, self.readers = self.readers, {}
+        for reader in readers.values():
+            reader.close()
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path, PurePath
+from shutil import rmtree
+from typing import AsyncIterator, Callable, Optional
+
+from roster_api import constants, settings
+
+logger = logging.getLogger(constants.LOGGER_NAME)
+
+RepoKey = tuple[int, str]
+
+
+def disk_usage(path: Path) -> int:
+    # Bytes allocated on disk for everything under path
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+            except OSError:
+                continue
+    return total
+
+
+def remove_repo(root_dir: PurePath):
+    if Path(root_dir).exists():
+        rmtree(str(root_dir))
+
+
+@dataclass
+class RepoUsage:
+    root_dir: PurePath
+    last_access: float
+    size: int = 0
+    # Sizes are measured again after the repository is used
+    measured: bool = False
+
+
+# NOTE: clones live at WORKSPACE_DIR/{installation}/{repository}
+#   (repository names are owner/name)
+class WorkspacePool:
+    def __init__(
+        self,
+        budget: int = settings.WORKSPACE_DISK_BUDGET,
+        on_evict: Optional[Callable[[RepoKey, PurePath], None]] = None,
+    ):
+        self.budget = budget
+        self.on_evict = on_evict
+        self.repos: dict[RepoKey, RepoUsage] = {}
+        self.in_flight: Counter[RepoKey] = Counter()
+        self._evicting: dict[RepoKey, asyncio.Future] = {}
+
+    def scan(self, workspace_dir: str = settings.WORKSPACE_DIR):
+        # Picks up clones left on disk by earlier runs, last used when last modified
+        root = Path(workspace_dir)
+        if not root.is_dir():
+            return
+        for installation_dir in root.iterdir():
+            if not installation_dir.is_dir() or not installation_dir.name.isdigit():
+                continue
+            for owner_dir in installation_dir.iterdir():
+                if not owner_dir.is_dir():
+                    continue
+                for repo_dir in owner_dir.iterdir():
+                    git_dir = repo_dir / ".git"
+                    if not git_dir.exists():
+                        continue
+                    key = (
+                        int(installation_dir.name),
+                        f"{owner_dir.name}/{repo_dir.name}",
+                    )
+                    self.repos.setdefault(
+                        key,
+                        RepoUsage(
+                            root_dir=PurePath(repo_dir),
+                            last_access=git_dir.stat().st_mtime,
+                        ),
+                    )
+        logger.debug("(workspace-pool) Found %s repositories on disk", len(self.repos))
+
+    @property
+    def total_size(self) -> int:
+        return sum(usage.size for usage in self.repos.values())
+
+    def _touch(self, key: RepoKey, root_dir: PurePath):
+        usage = self.repos.get(key)
+        if usage is None:
+            usage = self.repos[key] = RepoUsage(root_dir=root_dir, last_access=0.0)
+        usage.last_access = time.time()
+        usage.measured = False
+
+    @asynccontextmanager
+    async def use(self, key: RepoKey, root_dir: PurePath) -> AsyncIterator[None]:
+        # Repositories are never evicted while in use,
+        #   and using one which is being evicted waits until it is gone
+        while key in self._evicting:
+            await asyncio.shield(self._evicting[key])
+        self.in_flight[key] += 1
+        self._touch(key, root_dir)
+        try:
+            yield
+        finally:
+            self.in_flight[key] -= 1
+            if self.in_flight[key] <= 0:
+                del self.in_flight[key]
+            self._touch(key, root_dir)
+
+    async def enforce_budget(self, executor: Executor) -> list[RepoKey]:
+        # Evicts the least recently used repositories until usage fits the budget
+        loop = asyncio.get_running_loop()
+        for usage in list(self.repos.values()):
+            if not usage.measured:
+                usage.measured = True
+                usage.size = await loop.run_in_executor(
+                    executor, disk_usage, Path(usage.root_dir)
+                )
+
+        total = self.total_size
+        evicted = []
+        by_last_access = sorted(
+            self.repos.items(), key=lambda item: item[1].last_access
+        )
+        for key, usage in by_last_access:
+            if total <= self.budget:
+                break
+            if self.in_flight[key] or key not in self.repos:
+                continue
+            future = loop.create_future()
+            self._evicting[key] = future
+            try:
+                if self.on_evict is not None:
+                    self.on_evict(key, usage.root_dir)
+                await loop.run_in_executor(executor, remove_repo, usage.root_dir)
+            except Exception as e:
+                logger.error("(workspace-pool) Failed to evict %s: %s", key, e)
+            else:
+                del self.repos[key]
+                total -= usage.size
+                evicted.append(key)
+                logger.info(
+                    "(workspace-pool) Evicted %s (%s bytes), %s bytes in use",
+                    key,
+                    usage.size,
+                    total,
+                )
+            finally:
+                del self._evicting[key]
+                future.set_result(None)
+        if total > self.budget:
+            logger.warning(
+                "(workspace-pool) %s bytes in use is over the budget of %s bytes",
+                total,
+                self.budget,
+            )
+        return evicted
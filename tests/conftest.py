@@ -0,0 +1,19 @@
+import pytest
+from benchmarks.fakes import FakeEtcdClient, FakeRabbitMQClient
+from roster_api.db import etcd
+from roster_api.messaging import rabbitmq
+
+
+@pytest.fixture
+def etcd_client(monkeypatch) -> FakeEtcdClient:
+    # The services resolve their clients through these module-level singletons
+    etcd_client = FakeEtcdClient()
+    monkeypatch.setattr(etcd, "ETCD_CLIENT", etcd_client)
+    return etcd_client
+
+
+@pytest.fixture
+def rmq_client(monkeypatch) -> FakeRabbitMQClient:
+    rmq_client = FakeRabbitMQClient()
+    monkeypatch.setattr(rabbitmq, "RABBITMQ_CLIENT", rmq_client)
+    return rmq_client
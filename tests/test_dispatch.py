@@ -0,0 +1,67 @@
+from roster_api.messaging.dispatch import AgentDispatcher
+from roster_api.models.team import Member
+
+
+def build_member(dispatch: str = "least_loaded") -> Member:
+    return Member(identity="Worker", agent="a0", pool=["a1", "a2"], dispatch=dispatch)
+
+
+def test_round_robin_cycles_through_pool():
+    dispatcher = AgentDispatcher()
+    member = build_member("round_robin")
+
+    agents = [dispatcher.choose(member, f"r{i}", "step") for i in range(6)]
+
+    assert agents == ["a0", "a1", "a2", "a0", "a1", "a2"]
+
+
+def test_least_loaded_prefers_idle_agents():
+    dispatcher = AgentDispatcher()
+    member = build_member()
+
+    first = [dispatcher.choose(member, f"r{i}", "step") for i in range(3)]
+    assert sorted(first) == ["a0", "a1", "a2"]
+
+    # Only a1 reports, so it gets the next step
+    dispatcher.release("r1", "step")
+    assert dispatcher.choose(member, "r3", "step") == "a1"
+    assert dispatcher.outstanding == {"a0": 1, "a1": 1, "a2": 1}
+
+
+def test_retried_step_is_only_outstanding_once():
+    dispatcher = AgentDispatcher()
+    member = build_member()
+
+    dispatcher.choose(member, "r0", "step")
+    dispatcher.choose(member, "r0", "step")
+
+    assert sum(dispatcher.outstanding.values()) == 1
+    dispatcher.release_record("r0")
+    assert dispatcher.outstanding == {}
+    assert dispatcher.assignments == {}
+
+
+def test_sticky_keeps_a_record_on_one_agent():
+    member = build_member()
+    dispatcher = AgentDispatcher()
+
+    agents = {
+        dispatcher.choose(member, "r0", f"step{i}", sticky=True) for i in range(5)
+    }
+    assert len(agents) == 1
+    # Stable across processes, and records are spread over the pool
+    assert AgentDispatcher().choose(member, "r0", "other", sticky=True) in agents
+    assert (
+        len(
+            {dispatcher.choose(member, f"r{i}", "step", sticky=True) for i in range(30)}
+        )
+        == 3
+    )
+
+
+def test_single_agent_members():
+    dispatcher = AgentDispatcher()
+    member = Member(identity="Worker", agent="a0", dispatch="round_robin")
+
+    assert dispatcher.choose(member, "r0", "step") == "a0"
+    assert dispatcher.choose(member, "r0", "step", sticky=True) == "a0"
@@ -0,0 +1,86 @@
+import asyncio
+
+from benchmarks.fakes import FakeEtcdClient
+from roster_api.controllers.election import LeaderElection
+
+
+class Controllers:
+    def __init__(self):
+        self.events = []
+
+    async def on_elected(self):
+        self.events.append("elected")
+
+    async def on_demoted(self):
+        self.events.append("demoted")
+
+
+def build_election(
+    etcd_client, candidate_id: str
+) -> tuple[LeaderElection, Controllers]:
+    controllers = Controllers()
+    election = LeaderElection(
+        name="controllers",
+        on_elected=controllers.on_elected,
+        on_demoted=controllers.on_demoted,
+        candidate_id=candidate_id,
+        # Campaigns every 10ms
+        ttl=0.03,
+        etcd_client=etcd_client,
+    )
+    return election, controllers
+
+
+async def wait_for(condition, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.005)
+
+
+def test_leadership_moves_when_lease_is_lost():
+    asyncio.run(_test_leadership_moves_when_lease_is_lost())
+
+
+async def _test_leadership_moves_when_lease_is_lost():
+    etcd_client = FakeEtcdClient()
+    first, first_controllers = build_election(etcd_client, "first")
+    second, second_controllers = build_election(etcd_client, "second")
+
+    await first.start()
+    await wait_for(lambda: first.is_leader)
+    await second.start()
+    await asyncio.sleep(0.05)
+    assert not second.is_leader
+    assert etcd_client.get(first.key)[0] == b"first"
+
+    # The lease expires, e.g. the leader couldn't reach etcd in time
+    first._lease.expire()
+    await wait_for(lambda: second.is_leader)
+    await wait_for(lambda: not first.is_leader)
+    assert first_controllers.events == ["elected", "demoted"]
+    assert second_controllers.events == ["elected"]
+    assert etcd_client.get(first.key)[0] == b"second"
+
+    await first.stop()
+    await second.stop()
+    assert second_controllers.events == ["elected", "demoted"]
+    # Stepping down revokes the lease, so the next candidate needn't wait for it
+    assert etcd_client.get(first.key) == (None, None)
+
+
+def test_stop_without_leadership():
+    asyncio.run(_test_stop_without_leadership())
+
+
+async def _test_stop_without_leadership():
+    etcd_client = FakeEtcdClient()
+    election, controllers = build_election(etcd_client, "candidate")
+    etcd_client.put(election.key, "someone else")
+
+    await election.start()
+    await asyncio.sleep(0.05)
+    await election.stop()
+
+    assert controllers.events == []
+    assert etcd_client.get(election.key)[0] == b"someone else"
@@ -0,0 +1,159 @@
+import git
+import pytest
+from roster_api import errors, settings
+from roster_api.workspace.git import CREDENTIAL_HELPER, GitWorkspace, _write_tree
+from roster_api.workspace.objects import GitObjectReaders
+
+
+def commit_file(repo: git.Repo, path: str, content: str, message: str) -> str:
+    with open(f"{repo.working_tree_dir}/{path}", "w") as f:
+        f.write(content)
+    repo.index.add([path])
+    return repo.index.commit(message).hexsha
+
+
+@pytest.fixture
+def origin(tmp_path) -> git.Repo:
+    # main has two commits, feature has one more on top of main
+    source = git.Repo.init(str(tmp_path / "source"), initial_branch="main")
+    commit_file(source, "README.md", "first\n", "First")
+    commit_file(source, "README.md", "second\n", "Second")
+    source.create_head("feature").checkout()
+    commit_file(source, "feature.py", "print('feature')\n", "Feature")
+    source.heads.main.checkout()
+
+    origin = source.clone(str(tmp_path / "origin.git"), bare=True)
+    # Lets partial clones be made from it
+    origin.git.config("uploadpack.allowFilter", "true")
+    return origin
+
+
+def setup_workspace(origin: git.Repo) -> GitWorkspace:
+    return GitWorkspace.setup(
+        installation_id=1,
+        repository_name="owner/repo",
+        repo_url=f"file://{origin.git_dir}",
+        timeout=30,
+    )
+
+
+@pytest.fixture(autouse=True)
+def workspace_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "WORKSPACE_DIR", str(tmp_path / "workspaces"))
+
+
+def test_commit_builds_on_branch_from_origin(origin):
+    # A fresh clone (e.g. after eviction) only has main
+    workspace = setup_workspace(origin)
+    base_sha = origin.commit("main").hexsha
+
+    assert workspace.fetch_branch_unless_local("feature")
+    commit_sha = workspace.commit_files(
+        "feature", {"feature.py": "print('changed')\n"}, "Change", base_sha
+    )
+    workspace.push_branch("feature")
+
+    pushed = origin.commit("feature")
+    assert pushed.hexsha == commit_sha
+    assert pushed.parents[0].message == "Feature"
+
+
+def test_new_branch_starts_at_base_sha(origin):
+    workspace = setup_workspace(origin)
+    base_sha = origin.commit("main").hexsha
+
+    assert not workspace.fetch_branch_unless_local("new-branch")
+    workspace.commit_files("new-branch", {"new.py": "\n"}, "New", base_sha)
+    workspace.push_branch("new-branch")
+
+    assert origin.commit("new-branch").parents[0].hexsha == base_sha
+
+
+def test_partial_clone_reads_missing_objects(monkeypatch, origin):
+    monkeypatch.setattr(settings, "WORKSPACE_CLONE_FILTER", "blob:none")
+    workspace = setup_workspace(origin)
+    first_sha = origin.commit("main~1").hexsha
+    readers = GitObjectReaders()
+
+    # Only the checked out blobs were downloaded with the clone
+    reader = readers.get(workspace.root_dir, workspace.auth_env)
+    assert reader.read_files(first_sha, ["README.md"]) == {"README.md": "first\n"}
+
+    workspace.force_to_latest("main")
+    assert workspace.get_current_head_sha() == origin.commit("main").hexsha
+    readers.close()
+
+
+def test_every_command_gets_credentials(origin):
+    workspace = setup_workspace(origin)
+    workspace.token = "secret"
+    repo = workspace.open_repo()
+
+    # The credential helper is configured through the environment of the command
+    helpers = repo.git.config("--get-all", "credential.helper").splitlines()
+    assert helpers[-1] == CREDENTIAL_HELPER
+    assert repo.git.environment()["GIT_PASSWORD"] == "secret"
+
+
+def test_write_tree_replaces_only_changed_paths(tmp_path):
+    repo = git.Repo.init(str(tmp_path / "repo"))
+    (tmp_path / "repo" / "src").mkdir()
+    (tmp_path / "repo" / "docs").mkdir()
+    commit_file(repo, "src/main.py", "main\n", "Main")
+    commit_file(repo, "docs/index.md", "docs\n", "Docs")
+    commit_file(repo, "run.sh", "run\n", "Run")
+    repo.git.update_index("--chmod=+x", "run.sh")
+    parent = repo.index.commit("Executable")
+
+    tree_sha = _write_tree(
+        repo,
+        parent.tree.binsha,
+        {
+            "src/main.py": b"changed\n",
+            "src/new/module.py": b"new\n",
+            "src.py": b"sorted before the src tree\n",
+            "run.sh": b"run again\n",
+        },
+    )
+
+    tree = git.Tree(repo, tree_sha, path="")
+    assert tree["src/main.py"].data_stream.read() == b"changed\n"
+    assert tree["src/new/module.py"].data_stream.read() == b"new\n"
+    # Untouched subtrees are reused, existing files keep their mode
+    assert tree["docs"].binsha == parent.tree["docs"].binsha
+    assert tree["run.sh"].mode == parent.tree["run.sh"].mode
+    # Entries are written in git's order, so the tree is valid
+    repo.git.fsck("--strict")
+    assert repo.git.ls_tree("-r", "--name-only", tree.hexsha).splitlines() == [
+        "docs/index.md",
+        "run.sh",
+        "src.py",
+        "src/main.py",
+        "src/new/module.py",
+    ]
+
+
+def test_commit_files_continues_local_branch(origin):
+    workspace = setup_workspace(origin)
+    base_sha = origin.commit("main").hexsha
+
+    first_sha = workspace.commit_files("branch", {"a.py": "a\n"}, "First", base_sha)
+    second_sha = workspace.commit_files("branch", {"b.py": "b\n"}, "Second", base_sha)
+
+    repo = workspace.open_repo()
+    second = repo.commit(second_sha)
+    assert second.parents[0].hexsha == first_sha
+    assert {blob.path for blob in second.tree.traverse()} >= {"a.py", "b.py"}
+    # The working tree is never touched
+    assert repo.head.commit.hexsha == base_sha
+    assert not repo.is_dirty(untracked_files=True)
+
+
+@pytest.mark.parametrize("filepath", ["", ".", "/", "..", "../outside.py", "a/../.."])
+def test_commit_files_rejects_paths_outside_repo(origin, filepath):
+    workspace = setup_workspace(origin)
+    base_sha = origin.commit("main").hexsha
+
+    with pytest.raises(errors.WorkspaceError):
+        workspace.commit_files("branch", {filepath: "\n"}, "Escape", base_sha)
+    assert "branch" not in workspace.open_repo().heads
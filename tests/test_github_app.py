@@ -0,0 +1,159 @@
+import asyncio
+from types import SimpleNamespace
+
+from benchmarks.fakes import FakeRabbitMQClient
+from roster_api import constants, errors
+from roster_api.github.app import RosterGithubApp
+from roster_api.messaging.workflow import WorkflowRouter
+from roster_api.services.workflow import WorkflowService
+from roster_api.workspace.manager import WorkspaceManager, WorkspaceSnapshot
+
+
+class Handler:
+    # Stands in for handle_webhook_payload, failing the first `failures` calls
+    def __init__(self, failures: int = 0, error: Exception = RuntimeError("boom")):
+        self.failures = failures
+        self.error = error
+        self.payloads = []
+
+    async def __call__(self, payload: dict):
+        self.payloads.append(payload)
+        if len(self.payloads) <= self.failures:
+            raise self.error
+
+
+def build_app(etcd_client, rmq_client, handler: Handler) -> RosterGithubApp:
+    app = RosterGithubApp(
+        workflow_router=WorkflowRouter(rmq_client=rmq_client),
+        workspace_manager=WorkspaceManager(rmq_client=rmq_client),
+        rmq_client=rmq_client,
+        etcd_client=etcd_client,
+    )
+    app.handle_webhook_payload = handler
+    return app
+
+
+async def deliver(app: RosterGithubApp, rmq_client, delivery_id: str):
+    await app.enqueue_webhook({"n": delivery_id}, delivery_id=delivery_id)
+    await rmq_client.queues[constants.GITHUB_WEBHOOK_QUEUE].join()
+
+
+def test_failed_webhook_is_retried_once(etcd_client):
+    asyncio.run(_test_failed_webhook_is_retried_once(etcd_client))
+
+
+async def _test_failed_webhook_is_retried_once(etcd_client):
+    rmq_client = FakeRabbitMQClient()
+    handler = Handler(failures=1)
+    app = build_app(etcd_client, rmq_client, handler)
+    await app.setup()
+
+    await deliver(app, rmq_client, "retried")
+    assert len(handler.payloads) == 2
+    # Handled on the retry, so a redelivery is dropped
+    await deliver(app, rmq_client, "retried")
+    assert len(handler.payloads) == 2
+
+    handler.failures = 4
+    await deliver(app, rmq_client, "failing")
+    assert len(handler.payloads) == 4
+    # Never handled, so it isn't remembered
+    assert etcd_client.get(app._get_delivery_key("failing")) == (None, None)
+    await app.teardown()
+
+
+def test_handled_deliveries_are_shared(etcd_client):
+    asyncio.run(_test_handled_deliveries_are_shared(etcd_client))
+
+
+async def _test_handled_deliveries_are_shared(etcd_client):
+    # Another process (or this one after a restart) drops the redelivery
+    rmq_client = FakeRabbitMQClient()
+    handler = Handler()
+    await build_app(etcd_client, rmq_client, handler)._handle_webhook_message(
+        b'{"delivery_id": "shared", "payload": {}}'
+    )
+    await build_app(etcd_client, rmq_client, handler)._handle_webhook_message(
+        b'{"delivery_id": "shared", "payload": {}}'
+    )
+
+    assert len(handler.payloads) == 1
+    assert etcd_client.ops["lease"] == 1
+
+
+def test_invalid_payload_is_not_retried(etcd_client):
+    asyncio.run(_test_invalid_payload_is_not_retried(etcd_client))
+
+
+async def _test_invalid_payload_is_not_retried(etcd_client):
+    rmq_client = FakeRabbitMQClient()
+    handler = Handler(failures=1, error=errors.GithubWebhookError("invalid"))
+    app = build_app(etcd_client, rmq_client, handler)
+    await app.setup()
+
+    await deliver(app, rmq_client, "invalid")
+    await deliver(app, rmq_client, "invalid")
+
+    assert len(handler.payloads) == 1
+    await app.teardown()
+
+
+def test_redelivery_while_handling_is_dropped(etcd_client):
+    asyncio.run(_test_redelivery_while_handling_is_dropped(etcd_client))
+
+
+async def _test_redelivery_while_handling_is_dropped(etcd_client):
+    rmq_client = FakeRabbitMQClient()
+    handled = asyncio.Event()
+    payloads = []
+
+    async def handler(payload: dict):
+        payloads.append(payload)
+        await handled.wait()
+
+    first, second = [build_app(etcd_client, rmq_client, handler) for _ in range(2)]
+    message = b'{"delivery_id": "slow", "payload": {}}'
+    handling = asyncio.create_task(first._handle_webhook_message(message))
+    await asyncio.sleep(0)
+    await second._handle_webhook_message(message)
+    handled.set()
+    await handling
+
+    assert len(payloads) == 1
+
+
+def test_issue_is_not_retried_once_workflow_started(monkeypatch, etcd_client):
+    asyncio.run(
+        _test_issue_is_not_retried_once_workflow_started(monkeypatch, etcd_client)
+    )
+
+
+async def _test_issue_is_not_retried_once_workflow_started(monkeypatch, etcd_client):
+    rmq_client = FakeRabbitMQClient()
+    app = build_app(etcd_client, rmq_client, Handler())
+    initiated = []
+
+    async def get_snapshot(github_service):
+        return WorkspaceSnapshot(base_hash="abc", codebase_tree="tree")
+
+    async def initiate_workflow(self, workflow_name: str, inputs: dict, **kwargs):
+        initiated.append(workflow_name)
+        return "record"
+
+    async def handle_issue_created(payload: dict):
+        raise RuntimeError("Github is down")
+
+    monkeypatch.setattr(app.workspace_manager, "get_snapshot", get_snapshot)
+    monkeypatch.setattr(WorkflowService, "initiate_workflow", initiate_workflow)
+    github_service = SimpleNamespace(
+        installation_id=1,
+        repository_name="owner/repo",
+        handle_issue_created=handle_issue_created,
+    )
+
+    # Commenting on the issue fails, but the workflow has already started
+    await app.handle_issue_created(
+        github_service,
+        {"issue": {"title": "Title", "number": 1, "body": "Body"}},
+    )
+    assert initiated == ["ImplementFeature"]
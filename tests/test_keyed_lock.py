@@ -0,0 +1,54 @@
+import asyncio
+
+from roster_api.util.keyed_lock import KeyedLock
+
+
+async def hold(lock: KeyedLock, key: str, events: list, delay: float = 0.01):
+    async with lock.acquire(key):
+        events.append(f"{key} start")
+        await asyncio.sleep(delay)
+        events.append(f"{key} end")
+
+
+def test_same_key_is_exclusive():
+    lock = KeyedLock()
+    events = []
+
+    async def run():
+        await asyncio.gather(hold(lock, "a", events), hold(lock, "a", events))
+
+    asyncio.run(run())
+    assert events == ["a start", "a end", "a start", "a end"]
+    assert lock.stats.acquisitions == 2
+    assert lock.stats.contended == 1
+
+
+def test_different_keys_run_concurrently():
+    lock = KeyedLock()
+    events = []
+
+    async def run():
+        await asyncio.gather(hold(lock, "a", events), hold(lock, "b", events))
+
+    asyncio.run(run())
+    assert events[:2] == ["a start", "b start"]
+    assert lock.stats.contended == 0
+
+
+def test_idle_keys_are_dropped():
+    lock = KeyedLock()
+
+    async def run():
+        async with lock.acquire("a"):
+            assert lock.locked("a")
+            assert lock.in_use() == {"a"}
+            assert lock.key_stats["a"].acquisitions == 1
+        for i in range(100):
+            async with lock.acquire(f"branch-{i}"):
+                pass
+
+    asyncio.run(run())
+    assert not lock.locked("a")
+    assert lock.in_use() == set()
+    assert lock.key_stats == {}
+    assert lock.stats.acquisitions == 101
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+from roster_api import errors
+from roster_api.messaging import rabbitmq
+from roster_api.messaging.rabbitmq import MessageCodec, dumps_json, loads_json
+
+MESSAGE = {"kind": "report", "data": {"text": "é" * 100, "values": [1, 2.5, None]}}
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_round_trip(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(rabbitmq, "orjson", None)
+
+    body = dumps_json(MESSAGE)
+
+    assert isinstance(body, bytes)
+    assert loads_json(body) == MESSAGE
+    assert loads_json(body.decode()) == MESSAGE
+    with pytest.raises(json.JSONDecodeError):
+        loads_json(b"{not json")
+
+
+@pytest.mark.parametrize("compression", ["zstd", "gzip"])
+def test_compressed_round_trip(compression):
+    codec = MessageCodec(compression=compression, compression_threshold=100)
+    body = dumps_json(MESSAGE)
+
+    encoded, content_encoding = codec.encode(body)
+
+    assert content_encoding == compression
+    assert encoded != body
+    assert codec.decode(encoded, content_encoding) == body
+
+
+def test_small_bodies_are_not_compressed():
+    codec = MessageCodec(compression="zstd", compression_threshold=1000)
+    body = dumps_json({"kind": "small"})
+
+    assert codec.encode(body) == (body, None)
+    assert codec.decode(body, None) == body
+
+
+def test_disabled_compression():
+    codec = MessageCodec(compression="", compression_threshold=0)
+    body = dumps_json(MESSAGE)
+
+    assert codec.encode(body) == (body, None)
+    # Compressed messages from other publishers can still be read
+    encoded, content_encoding = MessageCodec(
+        compression="gzip", compression_threshold=0
+    ).encode(body)
+    assert codec.decode(encoded, content_encoding) == body
+
+
+def test_unknown_content_encoding_is_rejected():
+    codec = MessageCodec(compression="zstd", compression_threshold=0)
+
+    with pytest.raises(errors.RosterAPIError):
+        codec.decode(b"body", "br")
+
+
+def test_unavailable_compression_falls_back_to_gzip(monkeypatch):
+    monkeypatch.setattr(rabbitmq, "zstandard", None)
+    codec = MessageCodec(compression="zstd", compression_threshold=0)
+
+    assert codec.encode(b"body")[1] == "gzip"
+    with pytest.raises(errors.RosterAPIError):
+        codec.decode(b"body", "zstd")
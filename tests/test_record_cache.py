@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from benchmarks.fakes import FakeEtcdClient
+from roster_api import errors
+from roster_api.messaging.record_cache import WorkflowRecordCache
+from roster_api.models.workflow import (
+    WorkflowActionReportPayload,
+    WorkflowMessage,
+    WorkflowSpec,
+)
+from roster_api.services.workflow import WorkflowRecordService
+
+
+class Reports:
+    def __init__(self):
+        self.written = []
+        self.conflicted = []
+
+    def on_written(self, record, reports):
+        self.written.extend(key for key, _ in reports)
+
+    def on_conflict(self, record, reports):
+        self.conflicted.extend(key for key, _ in reports)
+
+
+def build_cache() -> tuple[WorkflowRecordCache, WorkflowRecordService, Reports]:
+    record_service = WorkflowRecordService(etcd_client=FakeEtcdClient())
+    reports = Reports()
+    cache = WorkflowRecordCache(
+        capacity=10,
+        flush_delay=0,
+        record_service=record_service,
+        on_written=reports.on_written,
+        on_conflict=reports.on_conflict,
+    )
+    return cache, record_service, reports
+
+
+def create_record(record_service: WorkflowRecordService):
+    spec = WorkflowSpec(name="Workflow", description="A workflow.", team="Team")
+    return record_service.create_workflow_record(workflow_spec=spec)
+
+
+def report(record, key: str) -> tuple[str, WorkflowMessage]:
+    return key, WorkflowMessage(
+        id=record.id,
+        workflow=record.name,
+        kind=WorkflowActionReportPayload.KEY,
+        data={},
+    )
+
+
+def test_reports_written_with_record():
+    cache, record_service, reports = build_cache()
+    record = cache.get("Workflow", create_record(record_service).id)
+
+    record.workspace = "changed"
+    cache.mark_dirty(record, report=report(record, "step:attempt:1"))
+
+    assert reports.written == ["step:attempt:1"]
+    assert reports.conflicted == []
+    assert record_service.get_workflow_record("Workflow", record.id).workspace == (
+        "changed"
+    )
+
+
+def test_reports_handed_back_on_conflict():
+    asyncio.run(_test_reports_handed_back_on_conflict())
+
+
+async def _test_reports_handed_back_on_conflict():
+    cache, record_service, reports = build_cache()
+    cache.flush_delay = 60
+    record = cache.get("Workflow", create_record(record_service).id)
+
+    record.workspace = "changed"
+    cache.mark_dirty(record, report=report(record, "step:attempt:1"))
+    # Written elsewhere before the cached copy is flushed
+    record_service.update_workflow_record(
+        record_service.get_workflow_record("Workflow", record.id)
+    )
+
+    with pytest.raises(errors.WorkflowRecordConflictError):
+        cache.flush(record.id)
+    assert reports.written == []
+    assert reports.conflicted == ["step:attempt:1"]
+    assert record.id not in cache
+
+
+def test_reports_dropped_when_record_deleted():
+    asyncio.run(_test_reports_dropped_when_record_deleted())
+
+
+async def _test_reports_dropped_when_record_deleted():
+    cache, record_service, reports = build_cache()
+    cache.flush_delay = 60
+    record = cache.get("Workflow", create_record(record_service).id)
+
+    cache.mark_dirty(record, report=report(record, "step:attempt:1"))
+    record_service.delete_workflow_record("Workflow", record.id)
+
+    with pytest.raises(errors.WorkflowRecordNotFoundError):
+        cache.flush(record.id)
+    assert reports.written == []
+    assert reports.conflicted == []
@@ -0,0 +1,60 @@
+from roster_api.constants import WORKFLOW_ROUTER_QUEUE
+from roster_api.util.sharding import (
+    get_shard,
+    get_workflow_router_queue,
+    get_workflow_router_queue_for_record,
+    jump_consistent_hash,
+)
+
+KEYS = [f"record-{i}" for i in range(2000)]
+
+
+def test_jump_consistent_hash_in_range():
+    for key in range(1000):
+        for num_buckets in (1, 2, 7, 64):
+            assert 0 <= jump_consistent_hash(key, num_buckets) < num_buckets
+
+
+def test_jump_consistent_hash_only_moves_keys_to_new_bucket():
+    for key in range(1000):
+        for num_buckets in range(1, 16):
+            before = jump_consistent_hash(key, num_buckets)
+            after = jump_consistent_hash(key, num_buckets + 1)
+            assert after in (before, num_buckets)
+
+
+def test_get_shard_moves_about_one_nth_of_keys():
+    moved = sum(get_shard(key, 4) != get_shard(key, 5) for key in KEYS)
+    assert 0.1 * len(KEYS) < moved < 0.3 * len(KEYS)
+
+
+def test_get_shard_balanced():
+    counts = [0] * 4
+    for key in KEYS:
+        counts[get_shard(key, 4)] += 1
+    assert min(counts) > 0.2 * len(KEYS)
+
+
+def test_get_shard_stable():
+    assert [get_shard(key, 8) for key in KEYS[:50]] == [
+        get_shard(key, 8) for key in KEYS[:50]
+    ]
+    assert get_shard("anything", 1) == 0
+    assert get_shard("anything", 0) == 0
+
+
+def test_single_shard_keeps_original_queue():
+    assert get_workflow_router_queue(0, num_shards=1) == WORKFLOW_ROUTER_QUEUE
+    assert (
+        get_workflow_router_queue_for_record("record-1", num_shards=1)
+        == WORKFLOW_ROUTER_QUEUE
+    )
+
+
+def test_record_queue_matches_shard():
+    for key in KEYS[:50]:
+        shard = get_shard(key, 3)
+        assert (
+            get_workflow_router_queue_for_record(key, num_shards=3)
+            == f"{WORKFLOW_ROUTER_QUEUE}:shard-{shard}"
+        )
@@ -0,0 +1,68 @@
+from roster_api.util.timer_wheel import HierarchicalTimerWheel
+
+
+def test_expires_in_deadline_order():
+    wheel = HierarchicalTimerWheel(tick=1.0, slots=8, levels=2)
+    wheel.schedule("late", 5.0)
+    wheel.schedule("early", 2.0)
+    wheel.schedule("middle", 3.5)
+
+    assert wheel.advance(1.0) == []
+    assert wheel.advance(4.0) == ["early", "middle"]
+    assert len(wheel) == 1
+    assert wheel.advance(5.0) == ["late"]
+    assert len(wheel) == 0
+
+
+def test_past_deadlines_expire_on_next_advance():
+    wheel = HierarchicalTimerWheel(tick=1.0, now=10.0)
+    wheel.schedule("overdue", 3.0)
+
+    assert "overdue" in wheel
+    assert wheel.advance(10.0) == ["overdue"]
+
+
+def test_cancel_and_reschedule():
+    wheel = HierarchicalTimerWheel(tick=1.0, slots=8, levels=2)
+    wheel.schedule("a", 2.0)
+    wheel.schedule("b", 2.0)
+
+    assert wheel.cancel("a") == 2.0
+    assert wheel.cancel("missing") is None
+    wheel.schedule("b", 6.0)
+
+    assert wheel.advance(3.0) == []
+    assert wheel.advance(6.0) == ["b"]
+
+
+def test_cascades_from_higher_levels():
+    # 8 slots per level, so deadlines beyond 8 ticks start on level 1
+    wheel = HierarchicalTimerWheel(tick=1.0, slots=8, levels=3)
+    deadlines = {f"timer-{i}": float(i) for i in range(1, 200, 7)}
+    for key, deadline in deadlines.items():
+        wheel.schedule(key, deadline)
+
+    expired = {}
+    for now in range(1, 201):
+        for key in wheel.advance(float(now)):
+            expired[key] = now
+    assert expired == {key: int(deadline) for key, deadline in deadlines.items()}
+
+
+def test_deadlines_beyond_range_are_parked():
+    # The wheel only spans 4**2 = 16 ticks
+    wheel = HierarchicalTimerWheel(tick=1.0, slots=4, levels=2)
+    wheel.schedule("far", 50.0)
+
+    for now in range(1, 50):
+        assert wheel.advance(float(now)) == []
+    assert wheel.advance(50.0) == ["far"]
+
+
+def test_advancing_in_large_steps():
+    wheel = HierarchicalTimerWheel(tick=0.5, slots=8, levels=3)
+    wheel.schedule("a", 10.2)
+    wheel.schedule("b", 30.0)
+
+    assert wheel.advance(20.0) == ["a"]
+    assert wheel.advance(100.0) == ["b"]
@@ -0,0 +1,206 @@
+import asyncio
+
+from benchmarks.fakes import FakeRabbitMQClient
+from roster_api.messaging import rabbitmq
+from roster_api.messaging.workflow import WorkflowRouter
+from roster_api.models.workflow import (
+    WorkflowAdmissionState,
+    WorkflowAdmitPayload,
+    WorkflowMessage,
+    WorkflowRecordAdmission,
+    WorkflowSpec,
+)
+from roster_api.services.workflow import (
+    WorkflowAdmissionService,
+    WorkflowRecordService,
+    WorkflowService,
+)
+from roster_api.util.serialization import deserialize_from_etcd
+
+TEAM = "Team"
+
+
+def running(admission_service: WorkflowAdmissionService) -> dict[str, list[str]]:
+    state_data, _ = admission_service.etcd_client.get(
+        admission_service._get_running_key(TEAM)
+    )
+    if not state_data:
+        return {}
+    state = deserialize_from_etcd(WorkflowAdmissionState, state_data)
+    return {
+        workflow: sorted(record_ids) for workflow, record_ids in state.running.items()
+    }
+
+
+def pending(workflow: str, record_id: str, priority: int = 0, **limits):
+    # Later record IDs in these tests sort later in the queue
+    admission = WorkflowRecordAdmission(
+        controlled=True, priority=priority, queued_at=float(len(record_id))
+    )
+    pending_record = admission.get_pending_record(workflow, record_id)
+    pending_record.workflow_limit = limits.get("workflow_limit", 0)
+    pending_record.team_limit = limits.get("team_limit", 0)
+    return pending_record
+
+
+def test_try_admit_respects_limits(etcd_client):
+    admission_service = WorkflowAdmissionService()
+
+    assert admission_service.try_admit(TEAM, "A", "a1", workflow_limit=1)
+    assert not admission_service.try_admit(TEAM, "A", "a2", workflow_limit=1)
+    assert admission_service.try_admit(TEAM, "B", "b1", team_limit=2)
+    assert not admission_service.try_admit(TEAM, "B", "b2", team_limit=2)
+    # Admitting the same record again is a no-op which still succeeds
+    assert admission_service.try_admit(TEAM, "A", "a1", workflow_limit=1)
+    assert running(admission_service) == {"A": ["a1"], "B": ["b1"]}
+
+
+def test_release_frees_slot(etcd_client):
+    admission_service = WorkflowAdmissionService()
+    admission_service.try_admit(TEAM, "A", "a1", workflow_limit=1)
+
+    assert admission_service.release(TEAM, "A", "a1")
+    assert not admission_service.release(TEAM, "A", "a1")
+    assert running(admission_service) == {}
+    assert admission_service.try_admit(TEAM, "A", "a2", workflow_limit=1)
+
+
+def test_admit_pending_in_queue_order(etcd_client):
+    admission_service = WorkflowAdmissionService()
+    admission_service.try_admit(TEAM, "A", "a0", workflow_limit=1, team_limit=3)
+    for pending_record in [
+        pending("A", "a1", workflow_limit=1, team_limit=3),
+        pending("B", "b1-low", team_limit=3),
+        pending("B", "b2-high", priority=5, team_limit=3),
+    ]:
+        admission_service.enqueue(TEAM, pending_record)
+
+    # Higher priorities go first, and a1 is held back by its workflow limit
+    assert [record.record_id for record in admission_service.list_pending(TEAM)] == [
+        "b2-high",
+        "a1",
+        "b1-low",
+    ]
+    admitted = admission_service.admit_pending(TEAM)
+
+    assert [record.record_id for record in admitted] == ["b2-high", "b1-low"]
+    assert [record.record_id for record in admission_service.list_pending(TEAM)] == [
+        "a1"
+    ]
+    assert admission_service.admit_pending(TEAM) == []
+
+
+def test_dequeue(etcd_client):
+    admission_service = WorkflowAdmissionService()
+    pending_record = pending("A", "a1")
+    admission_service.enqueue(TEAM, pending_record)
+
+    assert admission_service.dequeue(TEAM, pending_record)
+    assert not admission_service.dequeue(TEAM, pending_record)
+    assert admission_service.list_pending(TEAM) == []
+
+
+def create_record(record_id: str, status: str, admission_service):
+    spec = WorkflowSpec(
+        name="A", description="A workflow.", team=TEAM, max_concurrent_records=1
+    )
+    admission = WorkflowRecordAdmission(controlled=True, queued_at=1.0)
+    WorkflowRecordService().create_workflow_record(
+        workflow_spec=spec, record_id=record_id, status=status, admission=admission
+    )
+    if status == "pending":
+        pending_record = admission.get_pending_record("A", record_id)
+        pending_record.workflow_limit = 1
+        admission_service.enqueue(TEAM, pending_record)
+    else:
+        admission_service.try_admit(TEAM, "A", record_id, workflow_limit=1)
+
+
+def published_admissions(rmq_client: FakeRabbitMQClient) -> list[tuple[str, str]]:
+    admissions = []
+    for queue in rmq_client.queues.values():
+        for _, _, body, content_encoding in queue._queue:
+            message = WorkflowMessage(
+                **rabbitmq.loads_json(rmq_client.codec.decode(body, content_encoding))
+            )
+            if message.kind == WorkflowAdmitPayload.KEY:
+                admissions.append((message.id, message.data["team"]))
+    return admissions
+
+
+def test_deleting_running_record_releases_slot(etcd_client, rmq_client):
+    admission_service = WorkflowAdmissionService()
+    create_record("running", "running", admission_service)
+    create_record("waiting", "pending", admission_service)
+
+    deleted = asyncio.run(WorkflowService().delete_workflow_record("A", "running"))
+
+    assert deleted
+    assert running(admission_service) == {"A": ["waiting"]}
+    assert admission_service.list_pending(TEAM) == []
+    assert published_admissions(rmq_client) == [("waiting", TEAM)]
+
+
+def test_deleting_pending_record_leaves_queue(etcd_client, rmq_client):
+    admission_service = WorkflowAdmissionService()
+    create_record("running", "running", admission_service)
+    create_record("waiting", "pending", admission_service)
+
+    deleted = asyncio.run(WorkflowService().delete_workflow_record("A", "waiting"))
+
+    assert deleted
+    assert running(admission_service) == {"A": ["running"]}
+    assert admission_service.list_pending(TEAM) == []
+    assert published_admissions(rmq_client) == []
+    assert not asyncio.run(WorkflowService().delete_workflow_record("A", "waiting"))
+
+
+def test_admitting_deleted_record_releases_slot(etcd_client, rmq_client):
+    # The record was admitted from the queue, then deleted before the router started it
+    admission_service = WorkflowAdmissionService()
+    admission_service.try_admit(TEAM, "A", "deleted", workflow_limit=1)
+    admission_service.enqueue(TEAM, pending("A", "next", workflow_limit=1))
+
+    router = WorkflowRouter(rmq_client=rmq_client)
+    message = WorkflowMessage(
+        id="deleted",
+        workflow="A",
+        kind=WorkflowAdmitPayload.KEY,
+        data=WorkflowAdmitPayload(team=TEAM).dict(),
+    )
+    asyncio.run(router._handle_admit_workflow(message, message.read_contents()))
+
+    assert running(admission_service) == {"A": ["next"]}
+    assert published_admissions(rmq_client) == [("next", TEAM)]
+
+
+def test_release_between_admit_and_enqueue_admits_record(
+    monkeypatch, etcd_client, rmq_client
+):
+    admission_service = WorkflowAdmissionService()
+    WorkflowService().create_workflow(
+        WorkflowSpec(
+            name="A", description="A workflow.", team=TEAM, max_concurrent_records=1
+        )
+    )
+    create_record("running", "running", admission_service)
+
+    # Another shard releases the only slot right after this one is refused, and
+    #   finds nothing queued yet
+    try_admit = WorkflowAdmissionService.try_admit
+
+    def racing_try_admit(self, *args, **kwargs):
+        admitted = try_admit(self, *args, **kwargs)
+        self.release(TEAM, "A", "running")
+        return admitted
+
+    monkeypatch.setattr(WorkflowAdmissionService, "try_admit", racing_try_admit)
+    router = WorkflowRouter(rmq_client=rmq_client)
+    message = WorkflowMessage(
+        id="new", workflow="A", kind="initiate_workflow", data={"inputs": {}}
+    )
+    asyncio.run(router._handle_initiate_workflow(message, message.read_contents()))
+
+    assert running(admission_service) == {"A": ["new"]}
+    assert admission_service.list_pending(TEAM) == []
+    assert published_admissions(rmq_client) == [("new", TEAM)]
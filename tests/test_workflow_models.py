@@ -0,0 +1,59 @@
+import json
+import random
+
+from roster_api.models.workflow import StepMapConfig, StepRunConfig
+
+
+def test_retry_delay_doubles_up_to_max():
+    config = StepRunConfig(backoff_base=1.0, backoff_max=10.0, jitter=0)
+
+    assert [config.get_retry_delay(attempt) for attempt in range(1, 7)] == [
+        1.0,
+        2.0,
+        4.0,
+        8.0,
+        10.0,
+        10.0,
+    ]
+    # Huge attempt counts don't overflow
+    assert config.get_retry_delay(10_000) == 10.0
+
+
+def test_retry_delay_disabled():
+    assert StepRunConfig(backoff_base=0).get_retry_delay(3) == 0.0
+    assert StepRunConfig().get_retry_delay(0) == 0.0
+
+
+def test_retry_delay_jitter_only_shortens():
+    random.seed(0)
+    config = StepRunConfig(backoff_base=4.0, backoff_max=100.0, jitter=0.5)
+    delays = [config.get_retry_delay(2) for _ in range(200)]
+
+    assert all(4.0 <= delay <= 8.0 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_split_json_list_one_item_per_chunk():
+    config = StepMapConfig(input="files")
+
+    assert config.split('["a.py", "b.py", {"path": "c.py"}]') == [
+        "a.py",
+        "b.py",
+        '{"path": "c.py"}',
+    ]
+
+
+def test_split_lines_when_not_a_json_list():
+    config = StepMapConfig(input="files")
+
+    assert config.split("a.py\n\n  \nb.py\n") == ["a.py", "b.py"]
+    assert config.split('"just a string"') == ['"just a string"']
+    assert config.split("") == []
+
+
+def test_split_into_chunks():
+    config = StepMapConfig(input="files", chunk_size=2)
+
+    chunks = config.split('["a", "b", "c", "d", "e"]')
+
+    assert [json.loads(chunk) for chunk in chunks] == [["a", "b"], ["c", "d"], ["e"]]
@@ -0,0 +1,143 @@
+import asyncio
+
+from benchmarks.workflow_router import ROLE, TEAM, build_team
+from roster_api.messaging.rabbitmq import loads_json
+from roster_api.messaging.workflow import WorkflowRouter
+from roster_api.models.common import TypedArgument
+from roster_api.models.workflow import (
+    WorkflowActionReportPayload,
+    WorkflowCancelPayload,
+    WorkflowMessage,
+    WorkflowStepRetryPayload,
+    WorkflowSpec,
+    WorkflowStep,
+)
+from roster_api.services.team import TeamService
+from roster_api.services.workflow import WorkflowRecordService, WorkflowService
+from roster_api.util.sharding import get_workflow_router_queue_for_record
+
+AGENT_QUEUE = "default:actor:agent:benchmark-agent-0"
+
+
+def create_record(**run_config):
+    # a -> b -> out, with the given run config for a
+    spec = WorkflowSpec(
+        name="Chain",
+        description="Two steps in a row.",
+        team=TEAM,
+        inputs=[TypedArgument(name="text", type="text")],
+        outputs=[TypedArgument(name="out", type="text")],
+        steps={
+            "a": WorkflowStep(
+                role=ROLE, action="A", inputMap={"text": "workflow.text"}
+            ),
+            "b": WorkflowStep(
+                role=ROLE,
+                action="B",
+                inputMap={"text": "a.text"},
+                outputMap={"text": "out"},
+            ),
+        },
+    )
+    for key, value in run_config.items():
+        setattr(spec.steps["a"].runConfig, key, value)
+    TeamService().create_team(build_team(1))
+    WorkflowService().create_workflow(spec)
+    spec.update_derived_state()
+    return WorkflowRecordService().create_workflow_record(
+        workflow_spec=spec, inputs={"text": "hello"}
+    )
+
+
+async def report(router: WorkflowRouter, record, step: str, attempt: int = 1):
+    payload = WorkflowActionReportPayload(
+        step=step,
+        action=step.upper(),
+        outputs={"text": {"type": "text", "value": step}},
+        attempt=attempt,
+    )
+    message = WorkflowMessage(
+        id=record.id, workflow=record.name, kind=payload.KEY, data=payload.dict()
+    )
+    await router._handle_action_report(message, payload)
+
+
+def test_duplicate_report_is_ignored(etcd_client, rmq_client):
+    asyncio.run(_test_duplicate_report_is_ignored(rmq_client))
+
+
+async def _test_duplicate_report_is_ignored(rmq_client):
+    record = create_record()
+    router = WorkflowRouter(rmq_client=rmq_client)
+
+    await report(router, record, "a")
+    await report(router, record, "a")
+
+    # b was triggered once, and a only counts one run
+    assert rmq_client.queues[AGENT_QUEUE].qsize() == 1
+    cached_record = router.records.get(record.name, record.id)
+    assert cached_record.run_status["a"].runs == 1
+
+    # Another router (e.g. after a restart) recognizes it from the stored record
+    router.records.flush(record.id)
+    restarted_router = WorkflowRouter(rmq_client=rmq_client)
+    await report(restarted_router, record, "a")
+    assert rmq_client.queues[AGENT_QUEUE].qsize() == 1
+
+
+def agent_messages(rmq_client) -> list[str]:
+    queue = rmq_client.queues[AGENT_QUEUE]
+    kinds = []
+    while not queue.empty():
+        _, _, body, content_encoding = queue.get_nowait()
+        kinds.append(
+            WorkflowMessage(
+                **loads_json(rmq_client.codec.decode(body, content_encoding))
+            ).kind
+        )
+    return kinds
+
+
+def test_messages_after_cancel_are_ignored(etcd_client, rmq_client):
+    asyncio.run(_test_messages_after_cancel_are_ignored(rmq_client))
+
+
+async def _test_messages_after_cancel_are_ignored(rmq_client):
+    record = create_record(timeout=60, num_retries=1, backoff_base=30)
+    router = WorkflowRouter(rmq_client=rmq_client)
+    await router._trigger_actions(router.records.get(record.name, record.id), ["a"])
+    (timer,) = router.step_timers.timers.values()
+
+    message = WorkflowMessage(
+        id=record.id,
+        workflow=record.name,
+        kind=WorkflowCancelPayload.KEY,
+        data=WorkflowCancelPayload().dict(),
+    )
+    await router._handle_cancel_workflow(message, WorkflowCancelPayload())
+
+    # Cancellations jump the queue
+    assert agent_messages(rmq_client) == ["cancel_workflow", "trigger_action"]
+    assert router.step_timers.timers == {}
+
+    # A report, a retry and a timer which was already firing all arrive late
+    await report(router, record, "a")
+    retry = WorkflowStepRetryPayload(step="a")
+    await router._handle_step_retry(
+        WorkflowMessage(
+            id=record.id, workflow=record.name, kind=retry.KEY, data=retry.dict()
+        ),
+        retry,
+    )
+    await router._handle_step_timer(timer)
+    shard_queue = rmq_client.queues[
+        get_workflow_router_queue_for_record(record.id, num_shards=router.num_shards)
+    ]
+    _, _, body, content_encoding = shard_queue.get_nowait()
+    await router.route(rmq_client.codec.decode(body, content_encoding))
+
+    stored_record = WorkflowRecordService().get_workflow_record(record.name, record.id)
+    assert stored_record.status == "cancelled"
+    assert stored_record.run_status == {}
+    assert agent_messages(rmq_client) == []
+    assert router.step_timers.timers == {}
@@ -0,0 +1,178 @@
+import json
+
+from roster_api.messaging.workflow import (
+    _downstream_output_names,
+    _gather_map_step,
+    _record_step_result,
+    _workflow_is_finished,
+)
+from roster_api.models.common import TypedArgument, TypedResult
+from roster_api.models.workflow import (
+    MapStepProgress,
+    StepMapConfig,
+    WorkflowRecord,
+    WorkflowSpec,
+    WorkflowStep,
+    map_step_key,
+)
+
+
+def build_spec() -> WorkflowSpec:
+    # Two independent branches: a -> b -> out_b and c -> out_c
+    spec = WorkflowSpec(
+        name="Branches",
+        description="Two independent branches.",
+        team="Team",
+        inputs=[TypedArgument(name="text", type="text")],
+        outputs=[
+            TypedArgument(name="out_b", type="text"),
+            TypedArgument(name="out_c", type="text"),
+        ],
+        steps={
+            "a": WorkflowStep(
+                role="Role", action="A", inputMap={"text": "workflow.text"}
+            ),
+            "b": WorkflowStep(
+                role="Role",
+                action="B",
+                inputMap={"text": "a.text"},
+                outputMap={"text": "out_b"},
+            ),
+            "c": WorkflowStep(
+                role="Role",
+                action="C",
+                inputMap={"text": "workflow.text"},
+                outputMap={"text": "out_c"},
+            ),
+        },
+    )
+    spec.update_derived_state()
+    return spec
+
+
+def build_record() -> WorkflowRecord:
+    spec = build_spec()
+    return WorkflowRecord(
+        name=spec.name,
+        spec=spec,
+        context={"workflow.text": TypedResult(type="text", value="hello")},
+    )
+
+
+def test_downstream_output_names():
+    spec = build_spec()
+    assert _downstream_output_names(spec, "a") == {"out_b"}
+    assert _downstream_output_names(spec, "b") == {"out_b"}
+    assert _downstream_output_names(spec, "c") == {"out_c"}
+
+
+def test_failed_step_only_errors_its_own_branch():
+    record = build_record()
+    step_failed = _record_step_result(
+        record, "a", record.spec.steps["a"], outputs={}, error="boom"
+    )
+
+    assert step_failed
+    assert set(record.errors) == {"out_b"}
+    assert not _workflow_is_finished(record)
+
+    # The independent branch can still finish the workflow
+    _record_step_result(
+        record,
+        "c",
+        record.spec.steps["c"],
+        outputs={"text": TypedResult(type="text", value="done")},
+    )
+    assert record.outputs["out_c"].value == "done"
+    assert "out_c" not in record.errors
+    assert _workflow_is_finished(record)
+
+
+def test_failed_step_with_retries_left_records_no_errors():
+    record = build_record()
+    record.spec.steps["a"].runConfig.num_retries = 1
+
+    step_failed = _record_step_result(
+        record, "a", record.spec.steps["a"], outputs={}, error="boom"
+    )
+
+    assert not step_failed
+    assert not record.errors
+    assert record.run_status["a"].runs == 1
+
+
+def build_map_record(files: str) -> WorkflowRecord:
+    spec = WorkflowSpec(
+        name="Map",
+        description="Maps over a list of files.",
+        team="Team",
+        inputs=[TypedArgument(name="files", type="list")],
+        outputs=[TypedArgument(name="summaries", type="list")],
+        steps={
+            "summarize": WorkflowStep(
+                role="Role",
+                action="Summarize",
+                inputMap={"file": "workflow.files"},
+                outputMap={"summary": "summaries"},
+                map=StepMapConfig(input="file"),
+            ),
+        },
+    )
+    spec.update_derived_state()
+    return WorkflowRecord(
+        name=spec.name,
+        spec=spec,
+        context={"workflow.files": TypedResult(type="list", value=files)},
+    )
+
+
+def report_chunk(record: WorkflowRecord, chunk: int, summary: str, error: str = ""):
+    step_details = record.spec.steps["summarize"]
+    outputs = {} if error else {"summary": TypedResult(type="text", value=summary)}
+    _record_step_result(
+        record,
+        map_step_key("summarize", chunk),
+        step_details,
+        outputs=outputs,
+        error=error,
+        chunk=chunk,
+    )
+
+
+def test_gather_map_step_in_chunk_order():
+    record = build_map_record(json.dumps(["a.py", "b.py", "c.py"]))
+    step_details = record.spec.steps["summarize"]
+    record.map_progress["summarize"] = MapStepProgress(chunks=3)
+
+    report_chunk(record, 2, "c")
+    report_chunk(record, 0, "a")
+    assert _gather_map_step(record, "summarize", step_details) is None
+
+    report_chunk(record, 1, "", error="boom")
+    assert _gather_map_step(record, "summarize", step_details) is None
+
+    report_chunk(record, 1, "b")
+    gathered = _gather_map_step(record, "summarize", step_details)
+    assert json.loads(gathered["summary"].value) == ["a", "b", "c"]
+
+
+def test_gather_map_step_uses_dispatched_chunk_count():
+    # The recorded chunk count wins over the current value of the input
+    record = build_map_record(json.dumps(["a.py", "b.py", "c.py"]))
+    step_details = record.spec.steps["summarize"]
+    record.map_progress["summarize"] = MapStepProgress(chunks=1)
+
+    report_chunk(record, 0, "a")
+    gathered = _gather_map_step(record, "summarize", step_details)
+    assert json.loads(gathered["summary"].value) == ["a"]
+
+
+def test_gather_map_step_without_progress_splits_input():
+    record = build_map_record("a.py\nb.py")
+    step_details = record.spec.steps["summarize"]
+
+    report_chunk(record, 0, "a")
+    assert _gather_map_step(record, "summarize", step_details) is None
+    report_chunk(record, 1, "b")
+    gathered = _gather_map_step(record, "summarize", step_details)
+    assert json.loads(gathered["summary"].value) == ["a", "b"]
@@ -0,0 +1,162 @@
+import asyncio
+from pathlib import Path, PurePath
+from types import SimpleNamespace
+
+import git
+from benchmarks.fakes import FakeRabbitMQClient
+from roster_api import settings
+from roster_api.messaging.rabbitmq import loads_json
+from roster_api.models.tool import Sender, ToolMessage
+from roster_api.models.workflow import WorkflowSpec
+from roster_api.services.workflow import WorkflowRecordService
+from roster_api.workspace import manager as workspace_manager
+from roster_api.workspace.manager import WorkspaceManager
+
+
+def init_repo(path) -> git.Repo:
+    repo = git.Repo.init(str(path))
+    (path / "README.md").write_text("hello\n")
+    repo.index.add(["README.md"])
+    repo.index.commit("Initial commit")
+    return repo
+
+
+def test_setup_again_after_teardown(monkeypatch, tmp_path):
+    asyncio.run(_test_setup_again_after_teardown(monkeypatch, tmp_path))
+
+
+async def _test_setup_again_after_teardown(monkeypatch, tmp_path):
+    # Leader election tears the manager down and sets the same instance up again
+    monkeypatch.setattr(settings, "WORKSPACE_PREWARM_INTERVAL", 0)
+    head_sha = init_repo(tmp_path).head.commit.hexsha
+    manager = WorkspaceManager(rmq_client=FakeRabbitMQClient())
+    loop = asyncio.get_running_loop()
+
+    await manager.setup()
+    reader = await loop.run_in_executor(
+        manager.git_executor, manager.object_readers.get, PurePath(tmp_path)
+    )
+    assert reader.read_files(head_sha, ["README.md"]) == {"README.md": "hello\n"}
+    await manager.teardown()
+    assert manager._eviction_task is None
+
+    await manager.setup()
+    reader = await loop.run_in_executor(
+        manager.git_executor, manager.object_readers.get, PurePath(tmp_path)
+    )
+    assert reader.read_files(head_sha, ["README.md"]) == {"README.md": "hello\n"}
+    assert manager._eviction_task is not None
+    await manager.teardown()
+
+
+def test_tool_message_reads_record_once(etcd_client, rmq_client):
+    asyncio.run(_test_tool_message_reads_record_once(etcd_client, rmq_client))
+
+
+async def _test_tool_message_reads_record_once(etcd_client, rmq_client):
+    spec = WorkflowSpec(name="Workflow", description="A workflow.", team="Team")
+    spec.priorities.tool_response = 7
+    record = WorkflowRecordService().create_workflow_record(workflow_spec=spec)
+    manager = WorkspaceManager(rmq_client=rmq_client)
+    gets = etcd_client.ops["get"]
+
+    await manager.handle_tool_message(
+        ToolMessage(
+            id="invocation",
+            tool="workspace-file-reader",
+            kind="tool_invocation",
+            data={
+                "inputs": {
+                    "record_id": record.id,
+                    "workflow": "Workflow",
+                    "filepaths": ["README.md"],
+                }
+            },
+            sender=Sender(name="Agent"),
+        )
+    )
+
+    assert etcd_client.ops["get"] - gets == 1
+    priority, _, body, _ = rmq_client.queues["default:actor:agent:Agent"].get_nowait()
+    # The record has no workspace, the error is sent with the workflow's priority
+    assert priority == -7
+    assert "No workspace found" in ToolMessage(**loads_json(body)).error
+
+
+def test_eviction_skips_repos_in_use(monkeypatch, tmp_path):
+    asyncio.run(_test_eviction_skips_repos_in_use(monkeypatch, tmp_path))
+
+
+async def _test_eviction_skips_repos_in_use(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "WORKSPACE_DIR", str(tmp_path / "workspaces"))
+    manager = WorkspaceManager(rmq_client=FakeRabbitMQClient())
+    # Only the repository's identity is needed to use its clone
+    services = {
+        name: SimpleNamespace(installation_id=1, repository_name=f"owner/{name}")
+        for name in ["busy", "idle", "recent"]
+    }
+    for name, github_service in services.items():
+        async with manager._use_repo(github_service):
+            repo_dir = Path(settings.WORKSPACE_DIR) / "1" / "owner" / name
+            repo_dir.mkdir(parents=True)
+            (repo_dir / "data").write_bytes(b"x" * 64 * 1024)
+    manager.workspace_pool.budget = 0
+
+    async with manager._use_repo(services["busy"]):
+        evicted = await manager.workspace_pool.enforce_budget(manager.git_executor)
+        assert (Path(settings.WORKSPACE_DIR) / "1" / "owner" / "busy").exists()
+
+    assert evicted == [(1, "owner/idle"), (1, "owner/recent")]
+    assert list(manager.workspace_pool.repos) == [(1, "owner/busy")]
+    assert not (Path(settings.WORKSPACE_DIR) / "1" / "owner" / "idle").exists()
+    manager.git_executor.shutdown()
+
+
+def test_prewarmed_snapshot_is_reused_until_stale(monkeypatch, tmp_path):
+    asyncio.run(_test_prewarmed_snapshot_is_reused_until_stale(monkeypatch, tmp_path))
+
+
+async def _test_prewarmed_snapshot_is_reused_until_stale(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "WORKSPACE_DIR", str(tmp_path / "workspaces"))
+    monkeypatch.setattr(settings, "WORKSPACE_FETCH_FRESHNESS", 60.0)
+    built = []
+
+    def build_codebase_tree(root_dir: str) -> str:
+        built.append(root_dir)
+        return f"tree {len(built)}"
+
+    monkeypatch.setattr(workspace_manager, "build_codebase_tree", build_codebase_tree)
+    source = init_repo(tmp_path / "source")
+    source.git.branch("-M", "main")
+    origin = source.clone(str(tmp_path / "origin.git"), bare=True)
+    github_service = SimpleNamespace(
+        installation_id=1,
+        repository_name="owner/repo",
+        get_repo_url=lambda: f"file://{origin.git_dir}",
+        get_installation_token=lambda: "",
+    )
+    manager = WorkspaceManager(rmq_client=FakeRabbitMQClient())
+
+    # Callers arriving while the snapshot is pre-warming share it
+    prewarm = manager.prewarm(github_service)
+    snapshot = await manager.get_snapshot(github_service)
+    assert snapshot is await prewarm
+    assert snapshot.base_hash == origin.commit("main").hexsha
+    assert len(built) == 1
+
+    # Within the freshness window main isn't fetched again
+    (tmp_path / "source" / "README.md").write_text("changed\n")
+    source.index.add(["README.md"])
+    source.index.commit("Change")
+    source.git.push(origin.git_dir, "main")
+    assert (await manager.get_snapshot(github_service)) == snapshot
+    assert len(built) == 1
+
+    # Once it has passed, the new commit is fetched and gets its own tree
+    for key in manager.fetched_at:
+        manager.fetched_at[key] -= settings.WORKSPACE_FETCH_FRESHNESS
+    latest = await manager.get_snapshot(github_service)
+    assert latest.base_hash == origin.commit("main").hexsha != snapshot.base_hash
+    assert latest.codebase_tree == "tree 2"
+    manager.git_executor.shutdown()
+    manager.object_readers.close()